@@ -0,0 +1,141 @@
+/* Microbenchmark of zbx_module_get_value() path of native module: loads
+ * module like Zabbix does and calls item function in a loop.
+ *
+ * Usage:
+ *     python-zabbix-modules-bench <module.so> <key> <calls> [<param>...]
+ *
+ * Module needs the same environment as in agent process (configuration
+ * file in PYTHON_ZABBIX_<TYPE>_MODULES_CONF and running loader of module).
+ * Use key of asynchronous item published into value plane to measure
+ * overhead of the bridge itself, e.g. "zpm.test.collections".
+ */
+
+#if !defined(_POSIX_C_SOURCE)
+#define _POSIX_C_SOURCE 200809L
+#elif _POSIX_C_SOURCE < 200809L
+#undef _POSIX_C_SOURCE
+#define _POSIX_C_SOURCE 200809L
+#endif
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include <dlfcn.h>
+#include <time.h>
+
+/* zabbix/module.h */
+#include "module.h"
+
+
+static double get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+
+static void free_result(AGENT_RESULT *result)
+{
+    if (result->type & AR_STRING) {
+        free(result->str);
+    }
+    if (result->type & AR_TEXT) {
+        free(result->text);
+    }
+    if (result->type & AR_MESSAGE) {
+        free(result->msg);
+    }
+}
+
+
+static ZBX_METRIC *find_item(ZBX_METRIC *items, const char *key)
+{
+    for (ZBX_METRIC *item = items; item->key != NULL; ++item) {
+        if (strcmp(item->key, key) == 0) {
+            return item;
+        }
+    }
+    return NULL;
+}
+
+
+int main(int argc, char **argv)
+{
+    if (argc < 4) {
+        fprintf(stderr, "Usage: %s <module.so> <key> <calls> [<param>...]\n",
+                argv[0]);
+        return 2;
+    }
+
+    const char *key = argv[2];
+    long calls = atol(argv[3]);
+    if (calls < 1) {
+        fprintf(stderr, "Invalid number of calls: \"%s\"\n", argv[3]);
+        return 2;
+    }
+
+    void *module = dlopen(argv[1], RTLD_NOW);
+    if (module == NULL) {
+        fprintf(stderr, "Unable to load module: %s\n", dlerror());
+        return 1;
+    }
+
+    /* Function pointers are assigned through object pointers as suggested
+     * by POSIX, direct conversion is not allowed by ISO C. */
+    int (*module_init)(void);
+    ZBX_METRIC *(*module_item_list)(void);
+    int (*module_uninit)(void);
+    *(void **) &module_init = dlsym(module, "zbx_module_init");
+    *(void **) &module_item_list = dlsym(module, "zbx_module_item_list");
+    *(void **) &module_uninit = dlsym(module, "zbx_module_uninit");
+    if ((module_init == NULL) || (module_item_list == NULL) ||
+            (module_uninit == NULL)) {
+        fprintf(stderr, "Unable to find module functions: %s\n", dlerror());
+        return 1;
+    }
+
+    if (module_init() != ZBX_MODULE_OK) {
+        fprintf(stderr, "Unable to initialize module\n");
+        return 1;
+    }
+
+    ZBX_METRIC *item = find_item(module_item_list(), key);
+    if (item == NULL) {
+        fprintf(stderr, "Unknown key: \"%s\"\n", key);
+        module_uninit();
+        return 1;
+    }
+
+    AGENT_REQUEST request;
+    memset(&request, 0, sizeof(request));
+    request.key = (char *) key;
+    request.nparam = argc - 4;
+    request.params = argv + 4;
+
+    long failures = 0;
+    AGENT_RESULT result;
+    memset(&result, 0, sizeof(result));
+
+    double start_time = get_time();
+    for (long call_n = 0; call_n < calls; ++call_n) {
+        free_result(&result);
+        memset(&result, 0, sizeof(result));
+        if (item->function(&request, &result) != SYSINFO_RET_OK) {
+            ++failures;
+        }
+    }
+    double duration = get_time() - start_time;
+
+    printf("%s: %ld calls, %ld failed, %.0f calls/s, %.2f us/call\n",
+            key, calls, failures, calls / duration, duration / calls * 1e6);
+    if (result.type & AR_MESSAGE) {
+        printf("last message: %s\n", result.msg);
+    }
+    free_result(&result);
+
+    module_uninit();
+    return failures == 0 ? 0 : 1;
+}
@@ -6,15 +6,25 @@
 #endif
 
 #include <stdint.h>
+#include <stdio.h>
 #include <stdbool.h>
+#include <stddef.h>
 #include <stdlib.h>
 #include <string.h>
 
 #include <syslog.h>
 
 #include <dlfcn.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
 #include <pthread.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
 #include <sys/types.h>
+#include <sys/un.h>
+#include <time.h>
 #include <unistd.h>
 
 #include <Python.h>
@@ -45,16 +55,113 @@ static bool on_python_exception = false;
 
 static ZBX_METRIC *item_list = NULL;
 
+/* Python objects for item keys, sorted by key, created once in
+ * zbx_module_item_list(). */
+typedef struct
+{
+    const char *key;
+    PyObject *py_key;
+    /* Index in native_modules or -1 if item is requested through python. */
+    int module_n;
+    /* Item is requested from module's socket. */
+    bool native_rpc;
+    /* Value of asynchronous item is read from value plane first. */
+    bool published;
+} ItemKey;
+
+static ItemKey *item_keys = NULL;
+static int n_item_keys = 0;
+
+/* Memory mapped file with values of asynchronous items, written by loader,
+ * see zabbix_modules/valueplane.py. */
+typedef struct
+{
+    /* NULL if value plane is disabled. */
+    char *path;
+    /* NULL if file is not mapped. */
+    const char *data;
+    size_t size;
+    ino_t inode;
+    uint32_t n_slots;
+    uint32_t slot_size;
+    double next_check_time;
+} ValuePlane;
+
+/* Connections used to request items without calling python, see
+ * wrapper.get_native_routes(). */
+typedef struct
+{
+    char *name;
+    char *sock_path;
+    /* Exists while circuit breaker of python has failures recorded. */
+    char *breaker_state_path;
+    int fd;
+    uint32_t last_call_id;
+    /* Module does not support "struct" codec. */
+    bool disabled;
+    ValuePlane value_plane;
+} NativeModule;
+
+static NativeModule *native_modules = NULL;
+static int n_native_modules = 0;
+static double native_timeout = 0.0;
+
+#define NATIVE_MAX_FRAME_SIZE (16 * 1024 * 1024)
+#define NATIVE_MAX_STRING_LENGTH 0xffff
+
+/* Must match zabbix_modules/rpc.py. */
+enum {
+    NATIVE_TAG_UI64 = 2,
+    NATIVE_TAG_DBL = 3,
+    NATIVE_TAG_STRING = 4,
+    NATIVE_TAG_GET_VALUE_DEADLINE = 5,
+};
+
+enum {
+    NATIVE_STRING_STR,
+    NATIVE_STRING_TEXT,
+    NATIVE_STRING_MSG,
+};
+
+/* Must match zabbix_modules/valueplane.py. */
+#define VALUE_PLANE_VERSION 1
+#define VALUE_PLANE_HEADER_SIZE 24
+#define VALUE_PLANE_SLOT_HEADER_SIZE 29
+#define VALUE_PLANE_MAX_PROBES 16
+#define VALUE_PLANE_MAX_READ_RETRIES 4
+#define VALUE_PLANE_REOPEN_INTERVAL 1.0
+
+/* Longer keys are requested through socket. */
+#define VALUE_PLANE_MAX_KEY_SIZE 4096
+
+enum {
+    VALUE_KIND_NONE,
+    VALUE_KIND_UI64,
+    VALUE_KIND_DBL,
+    VALUE_KIND_STR,
+    VALUE_KIND_TEXT,
+    VALUE_KIND_MSG,
+};
+
+static const char native_handshake[] =
+        "{\"name\": \"rpc.handshake\", \"args\": [[\"struct\"]], "
+        "\"kwargs\": {}}";
+
 
 static const char *const item_attr_key = "key";
 static const char *const item_attr_flags = "flags";
 static const char *const item_attr_test_param = "test_param";
 
-static const char *const result_attr_ui64 = "ui64";
-static const char *const result_attr_dbl = "dbl";
-static const char *const result_attr_str = "str";
-static const char *const result_attr_text = "text";
-static const char *const result_attr_msg = "msg";
+/* Fields of tuple returned by get_value_fast(). */
+enum {
+    RESULT_FIELD_RET,
+    RESULT_FIELD_UI64,
+    RESULT_FIELD_DBL,
+    RESULT_FIELD_STR,
+    RESULT_FIELD_TEXT,
+    RESULT_FIELD_MSG,
+    RESULT_N_FIELDS,
+};
 
 
 typedef struct
@@ -87,19 +194,19 @@ static struct {
 } mod_traceback = {0};
 
 static struct {
-    PyObject *request_type;
-    PyObject *result_type;
-
     PyObject *init_fn;
     PyObject *after_fork_fn;
     PyObject *item_list_fn;
-    PyObject *get_value_fn;
+    PyObject *get_value_fast_fn;
+    PyObject *get_native_routes_fn;
+    PyObject *decode_native_reply_fn;
+    PyObject *history_types_fn;
+    PyObject *history_write_fn;
     PyObject *uninit_fn;
 } mod_zabbix = {0};
 
 
 static PyObject *get_py_mod(PyObject *, const char *name);
-static PyObject *get_py_type(PyObject *py_module, const char *name);
 static PyObject *get_py_fn(PyObject *py_module, const char *name);
 
 static const ObjectNames object_names[] = {
@@ -118,16 +225,6 @@ static const ObjectNames object_names[] = {
         .py_parent_ptr = NULL,
         .name          = "zabbix_modules.wrapper",
         .py_ptr        = &mod.zabbix,
-    }, {
-        .fn            = get_py_type,
-        .py_parent_ptr = &mod.zabbix,
-        .name          = "AgentRequest",
-        .py_ptr        = &mod_zabbix.request_type,
-    }, {
-        .fn            = get_py_type,
-        .py_parent_ptr = &mod.zabbix,
-        .name          = "AgentResult",
-        .py_ptr        = &mod_zabbix.result_type,
     }, {
         .fn            = get_py_fn,
         .py_parent_ptr = &mod.zabbix,
@@ -146,8 +243,28 @@ static const ObjectNames object_names[] = {
     }, {
         .fn            = get_py_fn,
         .py_parent_ptr = &mod.zabbix,
-        .name          = "get_value",
-        .py_ptr        = &mod_zabbix.get_value_fn,
+        .name          = "get_value_fast",
+        .py_ptr        = &mod_zabbix.get_value_fast_fn,
+    }, {
+        .fn            = get_py_fn,
+        .py_parent_ptr = &mod.zabbix,
+        .name          = "get_native_routes",
+        .py_ptr        = &mod_zabbix.get_native_routes_fn,
+    }, {
+        .fn            = get_py_fn,
+        .py_parent_ptr = &mod.zabbix,
+        .name          = "decode_native_reply",
+        .py_ptr        = &mod_zabbix.decode_native_reply_fn,
+    }, {
+        .fn            = get_py_fn,
+        .py_parent_ptr = &mod.zabbix,
+        .name          = "history_types",
+        .py_ptr        = &mod_zabbix.history_types_fn,
+    }, {
+        .fn            = get_py_fn,
+        .py_parent_ptr = &mod.zabbix,
+        .name          = "history_write",
+        .py_ptr        = &mod_zabbix.history_write_fn,
     }, {
         .fn            = get_py_fn,
         .py_parent_ptr = &mod.zabbix,
@@ -170,6 +287,7 @@ static const ModuleConstantNames module_constant_names[] = {
 
 
 static void log_python_exception();
+static void close_native_modules();
 
 
 int zbx_module_api_version()
@@ -178,6 +296,14 @@ int zbx_module_api_version()
 }
 
 
+static double get_time()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+
 static void after_fork_parent()
 {
     forked_parent = true;
@@ -247,28 +373,6 @@ static PyObject *get_py_attr(PyObject *py_obj, const char *name)
 }
 
 
-static PyObject *get_py_type(PyObject *py_module, const char *name)
-{
-    PyObject *py_type = get_py_attr(py_module, name);
-    if (!py_type) {
-        goto on_error;
-    }
-    if (!PyType_Check(py_type)) {
-        log(LOG_ERR, "Unable to get type %s: object is not a type",
-                name);
-        goto on_error;
-    }
-
-on_exit:
-    return py_type;
-
-on_error:
-    log_python_exception();
-    Py_CLEAR(py_type);
-    goto on_exit;
-}
-
-
 static PyObject *get_py_fn(PyObject *py_module, const char *name)
 {
     PyObject *py_fn = get_py_attr(py_module, name);
@@ -839,6 +943,8 @@ int zbx_module_init()
     log(LOG_INFO, "Initializing (zabbix_%s, python %s)...",
             MODULE_TYPE, PY_VERSION);
 
+    double start_time = get_time();
+
     if (!set_after_fork_handler()) {
         goto on_error;
     }
@@ -849,10 +955,12 @@ int zbx_module_init()
 
     Py_SetProgramName(program_name);
     Py_Initialize();
+    double initialized_time = get_time();
 
     if (!load_objects()) {
         goto on_error;
     }
+    double loaded_time = get_time();
 
     if (!set_module_constants()) {
         goto on_error;
@@ -863,7 +971,12 @@ int zbx_module_init()
     }
 
     if (ret_code == ZBX_MODULE_OK) {
-        log(LOG_INFO, "Initialization finished successfully");
+        double finished_time = get_time();
+        log(LOG_INFO,
+                "Initialization finished successfully in %.3f seconds "
+                "(interpreter %.3f, imports %.3f, init() %.3f)",
+                finished_time - start_time, initialized_time - start_time,
+                loaded_time - initialized_time, finished_time - loaded_time);
     } else {
         log(LOG_ERR, "Initialization failed");
     }
@@ -912,6 +1025,9 @@ static bool check_if_forked()
             PyOS_AfterFork();
         }
 
+        /* Connections of parent process must not be shared. */
+        close_native_modules();
+
         if (!call_after_fork_fn(false)) {
             return false;
         }
@@ -958,20 +1074,6 @@ static bool get_uint64_attr_from_py(PyObject *py_obj, const char *name,
 }
 
 
-static bool get_double_attr_from_py(PyObject *py_obj, const char *name,
-        double *result, bool *has_value)
-{
-    PyObject *py_attr = get_py_attr(py_obj, name);
-    if (!py_attr) {
-        return false;
-    }
-
-    bool ret = get_double_from_py(py_attr, result, has_value);
-    Py_DECREF(py_attr);
-    return ret;
-}
-
-
 static void set_failure_result(AGENT_RESULT *result)
 {
     if (result->type & AR_STRING) {
@@ -1039,98 +1141,74 @@ static PyObject *convert_request_params(const AGENT_REQUEST *request)
 }
 
 
-static PyObject *convert_request(const AGENT_REQUEST *request)
+static const ItemKey *find_item_key(const char *key)
 {
-    PyObject *py_arg_key = NULL;
-    PyObject *py_arg_params = NULL;
-    PyObject *py_arg_mtime = NULL;
-    PyObject *py_request_args = NULL;
-    PyObject *py_request = NULL;
-
-    py_arg_key = PyUnicode_FromString(request->key);
-    if (!py_arg_key) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "PyUnicode_FromString() failed for key",
-                request->key);
-        goto on_error;
+    int first = 0;
+    int last = n_item_keys - 1;
+
+    /* Binary search, as keys are sorted. */
+    while (first <= last) {
+        int middle = first + (last - first) / 2;
+        int cmp = strcmp(key, item_keys[middle].key);
+        if (cmp == 0) {
+            return &item_keys[middle];
+        }
+        if (cmp < 0) {
+            last = middle - 1;
+        } else {
+            first = middle + 1;
+        }
     }
 
-    py_arg_params = convert_request_params(request);
+    return NULL;
+}
 
-    py_arg_mtime = create_py_long(request->mtime);
-    if (!py_arg_mtime) {
-        log(LOG_ERR, "Unable to get value '%s': create_py_long() failed",
-                request->key);
-        goto on_error;
+
+static PyObject *get_py_key(const ItemKey *item_key, const char *key)
+{
+    if (item_key) {
+        Py_INCREF(item_key->py_key);
+        return item_key->py_key;
     }
 
-    py_request_args = PyTuple_Pack(3, py_arg_key, py_arg_params, py_arg_mtime);
-    if (!py_request_args) {
+    /* Should not happen: zabbix requests only keys from item list. */
+    PyObject *py_key = PyUnicode_FromString(key);
+    if (!py_key) {
         log(LOG_ERR,
                 "Unable to get value '%s': "
-                "PyTuple_Pack() for request failed",
-                request->key);
-        goto on_error;
-    }
-
-    py_request = call_py_fn(mod_zabbix.request_type, py_request_args);
-    if (!py_request) {
-        log(LOG_ERR, "Unable to get value '%s': can not create request object",
-                request->key);
-        goto on_error;
+                "PyUnicode_FromString() failed for key",
+                key);
+        log_python_exception();
+        return NULL;
     }
-
-on_exit:
-    Py_XDECREF(py_request_args);
-    Py_XDECREF(py_arg_mtime);
-    Py_XDECREF(py_arg_params);
-    Py_XDECREF(py_arg_key);
-    return py_request;
-
-on_error:
-    log_python_exception();
-    Py_CLEAR(py_request);
-    goto on_exit;
+    return py_key;
 }
 
 
-static bool call_get_value_fn(PyObject *py_request, PyObject *py_result,
-        int *rc, const char *request_key)
+static bool convert_result(PyObject *py_ret, AGENT_RESULT *result, int *rc,
+        const char *request_key)
 {
-    PyObject *py_args = PyTuple_Pack(2, py_request, py_result);
-    if (!py_args) {
+    if (!PyTuple_Check(py_ret) || (PyTuple_GET_SIZE(py_ret) != RESULT_N_FIELDS)) {
         log(LOG_ERR,
                 "Unable to get value '%s': "
-                "PyTuple_Pack() for call failed",
+                "get_value_fast() returned invalid result",
                 request_key);
-        log_python_exception();
         return false;
     }
 
-    bool ret = call_py_fn_with_int_rc(mod_zabbix.get_value_fn, py_args, rc);
-    Py_DECREF(py_args);
-    if (!ret) {
-        log(LOG_ERR, "Unable to get value '%s': call to get_value() failed",
+    if (!get_int_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_RET),
+            rc, NULL)) {
+        log(LOG_ERR, "Unable to get value '%s': unable to get return code",
                 request_key);
         return false;
     }
 
-    return true;
-}
-
-
-static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
-        const char *request_key)
-{
     uint64_t ui64;
     bool has_ui64_val;
-    if (!get_uint64_attr_from_py(py_result, result_attr_ui64,
+    if (!get_uint64_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_UI64),
             &ui64, &has_ui64_val)) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "unable to get attribute '%s'",
-                request_key, result_attr_ui64);
+        log(LOG_ERR, "Unable to get value '%s': unable to get ui64",
+                request_key);
         return false;
     }
     if (has_ui64_val) {
@@ -1139,12 +1217,10 @@ static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
 
     double dbl;
     bool has_dbl_val;
-    if (!get_double_attr_from_py(py_result, result_attr_dbl,
+    if (!get_double_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_DBL),
             &dbl, &has_dbl_val)) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "unable to get attribute '%s'",
-                request_key, result_attr_dbl);
+        log(LOG_ERR, "Unable to get value '%s': unable to get dbl",
+                request_key);
         return false;
     }
     if (has_dbl_val) {
@@ -1152,11 +1228,10 @@ static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
     }
 
     char *str = NULL;
-    if (!get_string_attr_from_py(py_result, result_attr_str, &str, true)) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "unable to get attribute '%s'",
-                request_key, result_attr_str);
+    if (!get_string_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_STR),
+            &str, true)) {
+        log(LOG_ERR, "Unable to get value '%s': unable to get str",
+                request_key);
         return false;
     }
     if (str) {
@@ -1164,11 +1239,10 @@ static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
     }
 
     char *text = NULL;
-    if (!get_string_attr_from_py(py_result, result_attr_text, &text, true)) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "unable to get attribute '%s'",
-                request_key, result_attr_text);
+    if (!get_string_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_TEXT),
+            &text, true)) {
+        log(LOG_ERR, "Unable to get value '%s': unable to get text",
+                request_key);
         return false;
     }
     if (text) {
@@ -1176,11 +1250,10 @@ static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
     }
 
     char *msg = NULL;
-    if (!get_string_attr_from_py(py_result, result_attr_msg, &msg, true)) {
-        log(LOG_ERR,
-                "Unable to get value '%s': "
-                "unable to get attribute '%s'",
-                request_key, result_attr_msg);
+    if (!get_string_from_py(PyTuple_GET_ITEM(py_ret, RESULT_FIELD_MSG),
+            &msg, true)) {
+        log(LOG_ERR, "Unable to get value '%s': unable to get msg",
+                request_key);
         return false;
     }
     if (msg) {
@@ -1191,144 +1264,943 @@ static bool convert_result(PyObject *py_result, AGENT_RESULT *result,
 }
 
 
-static int zbx_module_get_value(AGENT_REQUEST *request, AGENT_RESULT *result)
+static void native_close(NativeModule *module)
 {
-    int ret = SYSINFO_RET_OK;
+    if (module->fd != -1) {
+        close(module->fd);
+        module->fd = -1;
+    }
+}
 
-    PyObject *py_request = NULL;
-    PyObject *py_result = NULL;
 
-    if (!check_if_forked()) {
-        goto on_error;
-    }
+static bool native_wait(int fd, short events, double deadline)
+{
+    while (true) {
+        double timeout = deadline - get_time();
+        if (timeout <= 0.0) {
+            errno = ETIMEDOUT;
+            return false;
+        }
 
-    py_request = convert_request(request);
-    if (!py_request) {
-        goto on_error;
+        struct pollfd poll_fd = {
+            .fd     = fd,
+            .events = events,
+        };
+        int ret = poll(&poll_fd, 1, (int) (timeout * 1000.0) + 1);
+        if (ret > 0) {
+            return true;
+        }
+        if (ret == 0) {
+            errno = ETIMEDOUT;
+            return false;
+        }
+        if (errno != EINTR) {
+            return false;
+        }
     }
+}
 
-    py_result = call_py_fn(mod_zabbix.result_type, NULL);
-    if (!py_request) {
-        log(LOG_ERR, "Unable to get value '%s': can not create result object",
-                request->key);
-        goto on_error;
-    }
 
-    if (!call_get_value_fn(py_request, py_result, &ret, request->key)) {
-        goto on_error;
+static bool native_send_all(int fd, const char *data, size_t size,
+        double deadline)
+{
+    while (size) {
+        ssize_t sent = send(fd, data, size, MSG_NOSIGNAL);
+        if (sent < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            if ((errno == EAGAIN) || (errno == EWOULDBLOCK)) {
+                if (!native_wait(fd, POLLOUT, deadline)) {
+                    return false;
+                }
+                continue;
+            }
+            return false;
+        }
+        data += sent;
+        size -= (size_t) sent;
     }
+    return true;
+}
 
-    if (!convert_result(py_result, result, request->key)) {
-        goto on_error;
+
+static bool native_recv_all(int fd, char *data, size_t size, double deadline)
+{
+    while (size) {
+        ssize_t received = recv(fd, data, size, 0);
+        if (received < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            if ((errno == EAGAIN) || (errno == EWOULDBLOCK)) {
+                if (!native_wait(fd, POLLIN, deadline)) {
+                    return false;
+                }
+                continue;
+            }
+            return false;
+        }
+        if (received == 0) {
+            errno = ECONNRESET;
+            return false;
+        }
+        data += received;
+        size -= (size_t) received;
     }
+    return true;
+}
 
-on_exit:
-    Py_XDECREF(py_result);
-    Py_XDECREF(py_request);
-    return ret;
 
-on_error:
-    set_failure_result(result);
-    ret = SYSINFO_RET_FAIL;
-    goto on_exit;
+static void put_uint16(char *buf, uint16_t value)
+{
+    buf[0] = (char) (value >> 8);
+    buf[1] = (char) value;
 }
 
 
-static void free_item(ZBX_METRIC *item)
+static void put_uint32(char *buf, uint32_t value)
 {
-    free(item->key);
-    free(item->test_param);
+    put_uint16(buf, (uint16_t) (value >> 16));
+    put_uint16(buf + 2, (uint16_t) value);
 }
 
 
-static bool add_item(
-        int *n_items_ptr,
-        ZBX_METRIC **item_list_ptr,
-        PyObject *py_items_iterator)
+static void put_uint64(char *buf, uint64_t value)
 {
-    bool continue_flag = true;
+    put_uint32(buf, (uint32_t) (value >> 32));
+    put_uint32(buf + 4, (uint32_t) value);
+}
 
-    ZBX_METRIC *new_item_list = NULL;
-    PyObject *py_item = NULL;
-    ZBX_METRIC item = {0};
 
-    py_item = PyIter_Next(py_items_iterator);
-    if (py_item) {
-        item.function = zbx_module_get_value;
+static uint32_t get_uint32(const char *buf)
+{
+    const unsigned char *ubuf = (const unsigned char *) buf;
+    return ((uint32_t) ubuf[0] << 24) | ((uint32_t) ubuf[1] << 16) |
+            ((uint32_t) ubuf[2] << 8) | (uint32_t) ubuf[3];
+}
 
-        if (!get_string_attr_from_py(py_item, item_attr_key,
-                &item.key, false)) {
-            log(LOG_ERR,
-                    "Unable to add new item: "
-                    "unable to get attribute '%s'",
-                    item_attr_key);
-            goto on_error;
-        }
 
-        uint64_t flags;
-        bool has_flags;
-        if (!get_uint64_attr_from_py(py_item, item_attr_flags,
-                &flags, &has_flags)) {
-            log(LOG_ERR,
-                    "Unable to add new item: "
-                    "unable to get attribute '%s'",
-                    item_attr_flags);
-            goto on_error;
-        }
-        if (has_flags) {
-            item.flags = (unsigned int) flags;
-        }
+static uint64_t get_uint64(const char *buf)
+{
+    return ((uint64_t) get_uint32(buf) << 32) | get_uint32(buf + 4);
+}
 
-        if (!get_string_attr_from_py(py_item, item_attr_test_param,
-                &item.test_param, true)) {
-            log(LOG_ERR,
-                    "Unable to add new item: "
-                    "unable to get attribute '%s'",
-                    item_attr_test_param);
-            goto on_error;
-        }
-    } else {
-        continue_flag = false;
-        if (PyErr_Occurred()) {
-            log(LOG_ERR,
-                    "Unable to add new item: "
-                    "python exception occured in PyIter_Next()");
-            goto on_error;
-        }
-    }
 
-append_item:
-    /* TODO: Allocate space for multiple items at once. */
-    new_item_list = realloc(
-            *item_list_ptr,
-            (*n_items_ptr + 1) * sizeof(**item_list_ptr));
-    if (new_item_list) {
-        new_item_list[*n_items_ptr] = item;
-        *item_list_ptr = new_item_list;
-        if (continue_flag) {
-            ++*n_items_ptr;
-        }
-    } else {
-        log(LOG_ERR,
-                "Unable to add new item: "
-                "realloc() failed");
-        continue_flag = false;
-        *n_items_ptr = -1;
+static bool native_send_frame(int fd, char *frame, size_t size,
+        double deadline)
+{
+    /* First four bytes are reserved for length. */
+    put_uint32(frame, (uint32_t) (size - 4));
+    return native_send_all(fd, frame, size, deadline);
+}
 
-        free_item(&item);
-    }
 
-on_exit:
-    Py_XDECREF(py_item);
+static char *native_recv_frame(int fd, uint32_t *size, double deadline)
+{
+    char header[4];
+    if (!native_recv_all(fd, header, sizeof(header), deadline)) {
+        return NULL;
+    }
 
-    return continue_flag;
+    *size = get_uint32(header);
+    if (*size > NATIVE_MAX_FRAME_SIZE) {
+        log(LOG_ERR, "Received frame is too large: %u bytes",
+                (unsigned) *size);
+        errno = EPROTO;
+        return NULL;
+    }
 
-on_error:
-    log_python_exception();
+    char *packet = malloc(*size ? *size : 1);
+    if (!packet) {
+        log(LOG_ERR, "Unable to receive frame: malloc() failed");
+        return NULL;
+    }
+    if (!native_recv_all(fd, packet, *size, deadline)) {
+        free(packet);
+        return NULL;
+    }
+    return packet;
+}
 
-    free_item(&item);
 
-    if (continue_flag) {
+static bool native_handshake_send(NativeModule *module, double deadline)
+{
+    char frame[4 + sizeof(native_handshake) - 1];
+    memcpy(frame + 4, native_handshake, sizeof(native_handshake) - 1);
+    if (!native_send_frame(module->fd, frame, sizeof(frame), deadline)) {
+        return false;
+    }
+
+    uint32_t size;
+    char *packet = native_recv_frame(module->fd, &size, deadline);
+    if (!packet) {
+        return false;
+    }
+
+    static const char accepted[] = "{\"result\": {\"codec\": \"struct\"}}";
+    if ((size != sizeof(accepted) - 1) || memcmp(packet, accepted, size)) {
+        log(LOG_WARNING,
+                "Module '%s' does not support binary RPC, "
+                "requesting its items through python",
+                module->name);
+        module->disabled = true;
+    }
+    free(packet);
+    return !module->disabled;
+}
+
+
+static bool native_connect(NativeModule *module, double deadline)
+{
+    struct sockaddr_un address = {
+        .sun_family = AF_UNIX,
+    };
+    if (strlen(module->sock_path) >= sizeof(address.sun_path)) {
+        log(LOG_ERR, "Socket path is too long: '%s'", module->sock_path);
+        module->disabled = true;
+        return false;
+    }
+    strcpy(address.sun_path, module->sock_path);
+
+    module->fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (module->fd == -1) {
+        log(LOG_ERR, "Unable to connect to '%s': socket() failed",
+                module->sock_path);
+        return false;
+    }
+
+    /* Should not be inherited by processes spawned by zabbix, and should
+     * not block longer than item timeout. */
+    if ((fcntl(module->fd, F_SETFD, FD_CLOEXEC) == -1) ||
+            (fcntl(module->fd, F_SETFL, O_NONBLOCK) == -1)) {
+        log(LOG_ERR, "Unable to connect to '%s': fcntl() failed",
+                module->sock_path);
+        native_close(module);
+        return false;
+    }
+
+    /* Local socket either connects immediately or fails, EAGAIN means
+     * that backlog is full. */
+    if (connect(module->fd, (const struct sockaddr *) &address,
+            sizeof(address)) == -1) {
+        native_close(module);
+        return false;
+    }
+
+    if (!native_handshake_send(module, deadline)) {
+        int error = errno;
+        native_close(module);
+        errno = error;
+        return false;
+    }
+
+    return true;
+}
+
+
+static char *native_encode_call(const NativeModule *module,
+        const AGENT_REQUEST *request, uint32_t call_id, double deadline,
+        size_t *size)
+{
+    /* Frame length, tag, call ID, deadline and number of strings. */
+    size_t frame_size = 4 + 1 + 4 + 8 + 2;
+    int n_strings = request->nparam + 1;
+    for (int i = 0; i < n_strings; ++i) {
+        const char *string = i? get_rparam(request, i - 1) : request->key;
+        size_t length = strlen(string);
+        if (length > NATIVE_MAX_STRING_LENGTH) {
+            return NULL;
+        }
+        frame_size += 2 + length;
+    }
+
+    char *frame = malloc(frame_size);
+    if (!frame) {
+        log(LOG_ERR, "Unable to get value '%s' from module '%s': "
+                "malloc() failed",
+                request->key, module->name);
+        return NULL;
+    }
+
+    char *pos = frame + 4;
+    *pos++ = NATIVE_TAG_GET_VALUE_DEADLINE;
+    put_uint32(pos, call_id);
+    pos += 4;
+    uint64_t deadline_bits;
+    memcpy(&deadline_bits, &deadline, sizeof(deadline_bits));
+    put_uint64(pos, deadline_bits);
+    pos += 8;
+    put_uint16(pos, (uint16_t) n_strings);
+    pos += 2;
+    for (int i = 0; i < n_strings; ++i) {
+        const char *string = i? get_rparam(request, i - 1) : request->key;
+        size_t length = strlen(string);
+        put_uint16(pos, (uint16_t) length);
+        pos += 2;
+        memcpy(pos, string, length);
+        pos += length;
+    }
+
+    *size = frame_size;
+    return frame;
+}
+
+
+static char *copy_string(const char *data, size_t length)
+{
+    char *string = malloc(length + 1);
+    if (!string) {
+        log(LOG_ERR, "Unable to copy string: malloc() failed");
+        return NULL;
+    }
+    memcpy(string, data, length);
+    string[length] = '\0';
+    return string;
+}
+
+
+static bool decode_json_reply(const ItemKey *item_key, const char *packet,
+        uint32_t size, AGENT_RESULT *result, int *ret)
+{
+    bool no_errors = false;
+
+    PyObject *py_packet = PyBytes_FromStringAndSize(packet, size);
+    if (!py_packet) {
+        log(LOG_ERR, "Unable to get value '%s': "
+                "PyBytes_FromStringAndSize() failed",
+                item_key->key);
+        log_python_exception();
+        return false;
+    }
+
+    PyObject *py_ret = PyObject_CallFunctionObjArgs(
+            mod_zabbix.decode_native_reply_fn, item_key->py_key, py_packet,
+            NULL);
+    if (!py_ret) {
+        log(LOG_ERR,
+                "Unable to get value '%s': "
+                "call to decode_native_reply() failed",
+                item_key->key);
+        log_python_exception();
+    } else {
+        no_errors = convert_result(py_ret, result, ret, item_key->key);
+    }
+
+    Py_XDECREF(py_ret);
+    Py_DECREF(py_packet);
+    return no_errors;
+}
+
+
+static bool decode_reply(const ItemKey *item_key, uint32_t call_id,
+        const char *packet, uint32_t size, AGENT_RESULT *result, int *ret)
+{
+    if (size && (packet[0] == '{')) {
+        /* Results which have no binary representation and errors. */
+        return decode_json_reply(item_key, packet, size, result, ret);
+    }
+
+    if ((size < 5) || (get_uint32(packet + 1) != call_id)) {
+        log(LOG_ERR, "Unable to get value '%s': unexpected reply",
+                item_key->key);
+        return false;
+    }
+
+    *ret = SYSINFO_RET_OK;
+    switch (packet[0]) {
+    case NATIVE_TAG_UI64:
+        if (size < 5 + 8) {
+            break;
+        }
+        SET_UI64_RESULT(result, get_uint64(packet + 5));
+        return true;
+
+    case NATIVE_TAG_DBL:
+        if (size < 5 + 8) {
+            break;
+        }
+        uint64_t dbl_bits = get_uint64(packet + 5);
+        double dbl;
+        memcpy(&dbl, &dbl_bits, sizeof(dbl));
+        SET_DBL_RESULT(result, dbl);
+        return true;
+
+    case NATIVE_TAG_STRING:
+        if (size < 5 + 1 + 1 + 4) {
+            break;
+        }
+        uint32_t length = get_uint32(packet + 7);
+        if (length > size - 11) {
+            break;
+        }
+        char *string = copy_string(packet + 11, length);
+        if (!string) {
+            return false;
+        }
+        switch (packet[5]) {
+        case NATIVE_STRING_STR:
+            SET_STR_RESULT(result, string);
+            return true;
+        case NATIVE_STRING_TEXT:
+            SET_TEXT_RESULT(result, string);
+            return true;
+        case NATIVE_STRING_MSG:
+            SET_MSG_RESULT(result, string);
+            *ret = SYSINFO_RET_FAIL;
+            return true;
+        }
+        free(string);
+        break;
+    }
+
+    log(LOG_ERR, "Unable to get value '%s': invalid reply",
+            item_key->key);
+    return false;
+}
+
+
+static void set_timeout_result(AGENT_RESULT *result, const char *key,
+        const NativeModule *module)
+{
+    static const char format[] = "Timed out getting item \"%s\" from "
+            "module \"%s\"";
+    size_t size = sizeof(format) + strlen(key) + strlen(module->name);
+    char *message = malloc(size);
+    if (!message) {
+        log(LOG_ERR, "Unable to allocate memory for error message: "
+                "malloc() failed");
+        return;
+    }
+    snprintf(message, size, format, key, module->name);
+    SET_MSG_RESULT(result, message);
+}
+
+
+static uint32_t get_crc32(const char *data, size_t size)
+{
+    /* Same as zlib.crc32(). */
+    uint32_t crc = 0xffffffff;
+    for (size_t i = 0; i < size; ++i) {
+        crc ^= (unsigned char) data[i];
+        for (int bit = 0; bit < 8; ++bit) {
+            crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1));
+        }
+    }
+    return ~crc;
+}
+
+
+static void value_plane_close(ValuePlane *value_plane)
+{
+    if (value_plane->data) {
+        munmap((void *) value_plane->data, value_plane->size);
+        value_plane->data = NULL;
+    }
+}
+
+
+static void value_plane_open(ValuePlane *value_plane, ino_t inode)
+{
+    int fd = open(value_plane->path, O_RDONLY | O_CLOEXEC);
+    if (fd == -1) {
+        return;
+    }
+
+    struct stat file_stat;
+    if ((fstat(fd, &file_stat) != 0) ||
+            (file_stat.st_size < VALUE_PLANE_HEADER_SIZE)) {
+        close(fd);
+        return;
+    }
+    size_t size = (size_t) file_stat.st_size;
+    void *data = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) {
+        return;
+    }
+
+    uint32_t version;
+    uint32_t n_slots;
+    uint32_t slot_size;
+    memcpy(&version, (char *) data + 4, sizeof(version));
+    memcpy(&n_slots, (char *) data + 8, sizeof(n_slots));
+    memcpy(&slot_size, (char *) data + 12, sizeof(slot_size));
+    /* Sequence numbers are read atomically, so they have to be aligned. */
+    if ((memcmp(data, "ZPMV", 4) != 0) ||
+            (version != VALUE_PLANE_VERSION) || (n_slots == 0) ||
+            (slot_size < VALUE_PLANE_SLOT_HEADER_SIZE) ||
+            (slot_size % sizeof(uint32_t) != 0) ||
+            (size < VALUE_PLANE_HEADER_SIZE +
+                    (uint64_t) n_slots * slot_size)) {
+        log(LOG_WARNING, "Invalid value plane file '%s', ignoring",
+                value_plane->path);
+        munmap(data, size);
+        return;
+    }
+
+    value_plane->data = data;
+    value_plane->size = size;
+    value_plane->inode = inode;
+    value_plane->n_slots = n_slots;
+    value_plane->slot_size = slot_size;
+}
+
+
+/* Maps file again if it was replaced by restarted loader, not more often
+ * than once per VALUE_PLANE_REOPEN_INTERVAL. */
+static void value_plane_check(ValuePlane *value_plane)
+{
+    double cur_time = get_time();
+    if (cur_time < value_plane->next_check_time) {
+        return;
+    }
+    value_plane->next_check_time = cur_time + VALUE_PLANE_REOPEN_INTERVAL;
+
+    struct stat file_stat;
+    if (stat(value_plane->path, &file_stat) != 0) {
+        value_plane_close(value_plane);
+        return;
+    }
+    if (!value_plane->data || (file_stat.st_ino != value_plane->inode)) {
+        value_plane_close(value_plane);
+        value_plane_open(value_plane, file_stat.st_ino);
+    }
+}
+
+
+/* Key and parameters joined with '\0', as in valueplane._encode_key(). */
+static bool value_plane_encode_key(const AGENT_REQUEST *request, char *buf,
+        size_t *size)
+{
+    size_t key_size = strlen(request->key);
+    if (key_size > VALUE_PLANE_MAX_KEY_SIZE) {
+        return false;
+    }
+    memcpy(buf, request->key, key_size);
+
+    for (int i = 0; i < request->nparam; ++i) {
+        const char *param = request->params[i] ? request->params[i] : "";
+        size_t param_size = strlen(param);
+        if (key_size + 1 + param_size > VALUE_PLANE_MAX_KEY_SIZE) {
+            return false;
+        }
+        buf[key_size++] = '\0';
+        memcpy(buf + key_size, param, param_size);
+        key_size += param_size;
+    }
+
+    *size = key_size;
+    return true;
+}
+
+
+enum {
+    SLOT_FOUND,
+    SLOT_MISSING,
+    SLOT_NEXT,
+};
+
+
+static int value_plane_read_slot(const char *slot, uint32_t slot_size,
+        uint32_t key_hash, const char *key, size_t key_size,
+        AGENT_RESULT *result, int *ret)
+{
+    const uint32_t *sequence_ptr = (const uint32_t *) slot;
+
+    for (int retry_n = 0; retry_n < VALUE_PLANE_MAX_READ_RETRIES; ++retry_n) {
+        uint32_t sequence = __atomic_load_n(sequence_ptr, __ATOMIC_ACQUIRE);
+        if (sequence & 1) {
+            /* Slot is being written. */
+            continue;
+        }
+
+        uint32_t slot_hash;
+        double timestamp;
+        double max_age;
+        uint8_t kind;
+        uint16_t key_length;
+        uint16_t value_length;
+        memcpy(&slot_hash, slot + 4, sizeof(slot_hash));
+        memcpy(&timestamp, slot + 8, sizeof(timestamp));
+        memcpy(&max_age, slot + 16, sizeof(max_age));
+        memcpy(&kind, slot + 24, sizeof(kind));
+        memcpy(&key_length, slot + 25, sizeof(key_length));
+        memcpy(&value_length, slot + 27, sizeof(value_length));
+        if (!key_length) {
+            /* Empty slot, end of probing chain. */
+            return SLOT_MISSING;
+        }
+        if (slot_hash != key_hash) {
+            return SLOT_NEXT;
+        }
+        if (VALUE_PLANE_SLOT_HEADER_SIZE + (uint32_t) key_length +
+                value_length > slot_size) {
+            /* Torn read. */
+            continue;
+        }
+
+        const char *slot_key = slot + VALUE_PLANE_SLOT_HEADER_SIZE;
+        const char *value = slot_key + key_length;
+        bool same_key = (key_length == key_size) &&
+                (memcmp(slot_key, key, key_size) == 0);
+        uint64_t number = 0;
+        char *string = NULL;
+        if (same_key) {
+            if ((kind == VALUE_KIND_UI64) || (kind == VALUE_KIND_DBL)) {
+                if (value_length != sizeof(number)) {
+                    continue;
+                }
+                memcpy(&number, value, sizeof(number));
+            } else if ((kind == VALUE_KIND_STR) ||
+                    (kind == VALUE_KIND_TEXT) || (kind == VALUE_KIND_MSG)) {
+                string = copy_string(value, value_length);
+                if (!string) {
+                    return SLOT_MISSING;
+                }
+            }
+        }
+
+        __atomic_thread_fence(__ATOMIC_ACQUIRE);
+        if (__atomic_load_n(sequence_ptr, __ATOMIC_RELAXED) != sequence) {
+            free(string);
+            continue;
+        }
+
+        if (!same_key) {
+            return SLOT_NEXT;
+        }
+        if (get_time() - timestamp > max_age) {
+            free(string);
+            return SLOT_MISSING;
+        }
+
+        *ret = SYSINFO_RET_OK;
+        switch (kind) {
+        case VALUE_KIND_UI64:
+            SET_UI64_RESULT(result, number);
+            return SLOT_FOUND;
+        case VALUE_KIND_DBL:
+            {
+                double dbl;
+                memcpy(&dbl, &number, sizeof(dbl));
+                SET_DBL_RESULT(result, dbl);
+            }
+            return SLOT_FOUND;
+        case VALUE_KIND_STR:
+            SET_STR_RESULT(result, string);
+            return SLOT_FOUND;
+        case VALUE_KIND_TEXT:
+            SET_TEXT_RESULT(result, string);
+            return SLOT_FOUND;
+        case VALUE_KIND_MSG:
+            SET_MSG_RESULT(result, string);
+            *ret = SYSINFO_RET_FAIL;
+            return SLOT_FOUND;
+        }
+        /* Value did not fit into slot. */
+        free(string);
+        return SLOT_MISSING;
+    }
+
+    /* Slot is constantly being rewritten. */
+    return SLOT_MISSING;
+}
+
+
+/*
+ * Reads value of asynchronous item published by loader. Returns false if
+ * value is missing or stale and item should be requested from module.
+ */
+static bool value_plane_get(ValuePlane *value_plane,
+        const AGENT_REQUEST *request, AGENT_RESULT *result, int *ret)
+{
+    value_plane_check(value_plane);
+    if (!value_plane->data) {
+        return false;
+    }
+
+    char key[VALUE_PLANE_MAX_KEY_SIZE];
+    size_t key_size;
+    if (!value_plane_encode_key(request, key, &key_size)) {
+        return false;
+    }
+
+    uint32_t key_hash = get_crc32(key, key_size);
+    for (int probe_n = 0; probe_n < VALUE_PLANE_MAX_PROBES; ++probe_n) {
+        uint32_t slot_n = (uint32_t) (((uint64_t) key_hash + probe_n) %
+                value_plane->n_slots);
+        const char *slot = value_plane->data + VALUE_PLANE_HEADER_SIZE +
+                (size_t) slot_n * value_plane->slot_size;
+        int slot_ret = value_plane_read_slot(slot, value_plane->slot_size,
+                key_hash, key, key_size, result, ret);
+        if (slot_ret == SLOT_FOUND) {
+            return true;
+        }
+        if (slot_ret == SLOT_MISSING) {
+            break;
+        }
+    }
+    return false;
+}
+
+
+/*
+ * Reads item from value plane or requests it directly from module's socket.
+ * Returns false if item should be requested through python instead.
+ */
+static bool native_get_value(const ItemKey *item_key,
+        const AGENT_REQUEST *request, AGENT_RESULT *result, int *ret)
+{
+    NativeModule *module = &native_modules[item_key->module_n];
+    if (item_key->published &&
+            value_plane_get(&module->value_plane, request, result, ret)) {
+        return true;
+    }
+    if (!item_key->native_rpc || module->disabled) {
+        return false;
+    }
+
+    double deadline = get_time() + native_timeout;
+    if (module->fd == -1) {
+        /* Python decides when to retry connection to failed module. */
+        if (access(module->breaker_state_path, F_OK) == 0) {
+            return false;
+        }
+        if (!native_connect(module, deadline)) {
+            /* Module accepted connection, but did not answer handshake:
+             * requesting item through python would wait as long again. */
+            if (!module->disabled && (errno == ETIMEDOUT)) {
+                set_timeout_result(result, request->key, module);
+                *ret = SYSINFO_RET_FAIL;
+                return true;
+            }
+            /* Python will handle reconnection backoff and logging. */
+            return false;
+        }
+    }
+
+    uint32_t call_id = ++module->last_call_id;
+    size_t frame_size;
+    char *frame = native_encode_call(module, request, call_id, deadline,
+            &frame_size);
+    if (!frame) {
+        return false;
+    }
+
+    char *packet = NULL;
+    uint32_t packet_size;
+    if (native_send_frame(module->fd, frame, frame_size, deadline)) {
+        packet = native_recv_frame(module->fd, &packet_size, deadline);
+    }
+    free(frame);
+
+    if (!packet) {
+        int error = errno;
+        /* Late reply must not be received by next call. */
+        native_close(module);
+        if (error == ETIMEDOUT) {
+            set_timeout_result(result, request->key, module);
+            *ret = SYSINFO_RET_FAIL;
+            return true;
+        }
+        log(LOG_ERR, "Unable to get value '%s' from module '%s': %s",
+                request->key, module->name, strerror(error));
+        set_failure_result(result);
+        *ret = SYSINFO_RET_FAIL;
+        return true;
+    }
+
+    if (!decode_reply(item_key, call_id, packet, packet_size, result, ret)) {
+        native_close(module);
+        set_failure_result(result);
+        *ret = SYSINFO_RET_FAIL;
+    }
+    free(packet);
+    return true;
+}
+
+
+static void close_native_modules()
+{
+    for (int i = 0; i < n_native_modules; ++i) {
+        native_close(&native_modules[i]);
+    }
+}
+
+
+static void free_native_modules()
+{
+    for (int i = 0; i < n_native_modules; ++i) {
+        native_close(&native_modules[i]);
+        value_plane_close(&native_modules[i].value_plane);
+        free(native_modules[i].name);
+        free(native_modules[i].sock_path);
+        free(native_modules[i].breaker_state_path);
+        free(native_modules[i].value_plane.path);
+    }
+    free(native_modules);
+    native_modules = NULL;
+    n_native_modules = 0;
+
+    for (int i = 0; i < n_item_keys; ++i) {
+        item_keys[i].module_n = -1;
+        item_keys[i].native_rpc = false;
+        item_keys[i].published = false;
+    }
+}
+
+
+static int zbx_module_get_value(AGENT_REQUEST *request, AGENT_RESULT *result)
+{
+    int ret = SYSINFO_RET_OK;
+
+    PyObject *py_key = NULL;
+    PyObject *py_params = NULL;
+    PyObject *py_ret = NULL;
+
+    if (!check_if_forked()) {
+        goto on_error;
+    }
+
+    const ItemKey *item_key = find_item_key(request->key);
+    if (item_key && (item_key->module_n != -1) &&
+            native_get_value(item_key, request, result, &ret)) {
+        goto on_exit;
+    }
+
+    py_key = get_py_key(item_key, request->key);
+    if (!py_key) {
+        goto on_error;
+    }
+
+    py_params = convert_request_params(request);
+    if (!py_params) {
+        goto on_error;
+    }
+
+    py_ret = PyObject_CallFunctionObjArgs(mod_zabbix.get_value_fast_fn,
+            py_key, py_params, NULL);
+    if (!py_ret) {
+        log(LOG_ERR,
+                "Unable to get value '%s': call to get_value_fast() failed",
+                request->key);
+        log_python_exception();
+        goto on_error;
+    }
+
+    if (!convert_result(py_ret, result, &ret, request->key)) {
+        goto on_error;
+    }
+
+on_exit:
+    Py_XDECREF(py_ret);
+    Py_XDECREF(py_params);
+    Py_XDECREF(py_key);
+    return ret;
+
+on_error:
+    set_failure_result(result);
+    ret = SYSINFO_RET_FAIL;
+    goto on_exit;
+}
+
+
+static void free_item(ZBX_METRIC *item)
+{
+    free(item->key);
+    free(item->test_param);
+}
+
+
+static bool add_item(
+        int *n_items_ptr,
+        ZBX_METRIC **item_list_ptr,
+        PyObject *py_items_iterator)
+{
+    bool continue_flag = true;
+
+    ZBX_METRIC *new_item_list = NULL;
+    PyObject *py_item = NULL;
+    ZBX_METRIC item = {0};
+
+    py_item = PyIter_Next(py_items_iterator);
+    if (py_item) {
+        item.function = zbx_module_get_value;
+
+        if (!get_string_attr_from_py(py_item, item_attr_key,
+                &item.key, false)) {
+            log(LOG_ERR,
+                    "Unable to add new item: "
+                    "unable to get attribute '%s'",
+                    item_attr_key);
+            goto on_error;
+        }
+
+        uint64_t flags;
+        bool has_flags;
+        if (!get_uint64_attr_from_py(py_item, item_attr_flags,
+                &flags, &has_flags)) {
+            log(LOG_ERR,
+                    "Unable to add new item: "
+                    "unable to get attribute '%s'",
+                    item_attr_flags);
+            goto on_error;
+        }
+        if (has_flags) {
+            item.flags = (unsigned int) flags;
+        }
+
+        if (!get_string_attr_from_py(py_item, item_attr_test_param,
+                &item.test_param, true)) {
+            log(LOG_ERR,
+                    "Unable to add new item: "
+                    "unable to get attribute '%s'",
+                    item_attr_test_param);
+            goto on_error;
+        }
+    } else {
+        continue_flag = false;
+        if (PyErr_Occurred()) {
+            log(LOG_ERR,
+                    "Unable to add new item: "
+                    "python exception occured in PyIter_Next()");
+            goto on_error;
+        }
+    }
+
+append_item:
+    /* TODO: Allocate space for multiple items at once. */
+    new_item_list = realloc(
+            *item_list_ptr,
+            (*n_items_ptr + 1) * sizeof(**item_list_ptr));
+    if (new_item_list) {
+        new_item_list[*n_items_ptr] = item;
+        *item_list_ptr = new_item_list;
+        if (continue_flag) {
+            ++*n_items_ptr;
+        }
+    } else {
+        log(LOG_ERR,
+                "Unable to add new item: "
+                "realloc() failed");
+        continue_flag = false;
+        *n_items_ptr = -1;
+
+        free_item(&item);
+    }
+
+on_exit:
+    Py_XDECREF(py_item);
+
+    return continue_flag;
+
+on_error:
+    log_python_exception();
+
+    free_item(&item);
+
+    if (continue_flag) {
         goto on_exit;
     }
 
@@ -1352,6 +2224,170 @@ static void free_item_list(ZBX_METRIC *list)
 }
 
 
+static int compare_item_keys(const void *a, const void *b)
+{
+    return strcmp(((const ItemKey *) a)->key, ((const ItemKey *) b)->key);
+}
+
+
+static void free_item_keys()
+{
+    for (int i = 0; i < n_item_keys; ++i) {
+        Py_DECREF(item_keys[i].py_key);
+    }
+    free(item_keys);
+    item_keys = NULL;
+    n_item_keys = 0;
+}
+
+
+static bool create_item_keys(const ZBX_METRIC *list, int n_items)
+{
+    item_keys = calloc(n_items ? n_items : 1, sizeof(*item_keys));
+    if (!item_keys) {
+        log(LOG_ERR, "Unable to create item keys: calloc() failed");
+        return false;
+    }
+
+    for (int i = 0; i < n_items; ++i) {
+        /* Interned key makes dict lookups in python cheaper. */
+#if PY_MAJOR_VERSION >= 3
+        PyObject *py_key = PyUnicode_InternFromString(list[i].key);
+#else
+        PyObject *py_key = PyUnicode_FromString(list[i].key);
+#endif
+        if (!py_key) {
+            log(LOG_ERR,
+                    "Unable to create item keys: "
+                    "PyUnicode_InternFromString()/PyUnicode_FromString() "
+                    "failed");
+            log_python_exception();
+            free_item_keys();
+            return false;
+        }
+        item_keys[i].key = list[i].key;
+        item_keys[i].py_key = py_key;
+        item_keys[i].module_n = -1;
+        item_keys[i].native_rpc = false;
+        item_keys[i].published = false;
+        ++n_item_keys;
+    }
+
+    qsort(item_keys, n_item_keys, sizeof(*item_keys), compare_item_keys);
+    return true;
+}
+
+
+static bool load_native_module(PyObject *py_module, NativeModule *module)
+{
+    PyObject *py_name = NULL;
+    PyObject *py_sock_path = NULL;
+    PyObject *py_breaker_state_path = NULL;
+    PyObject *py_value_plane_path = NULL;
+
+    if (!PyArg_ParseTuple(py_module, "OOOO", &py_name, &py_sock_path,
+            &py_breaker_state_path, &py_value_plane_path)) {
+        log(LOG_ERR, "Unable to load native routes: invalid module");
+        log_python_exception();
+        return false;
+    }
+    if (!get_string_from_py(py_name, &module->name, false) ||
+            !get_string_from_py(py_sock_path, &module->sock_path, false) ||
+            !get_string_from_py(py_breaker_state_path,
+                    &module->breaker_state_path, false) ||
+            !get_string_from_py(py_value_plane_path,
+                    &module->value_plane.path, true)) {
+        log(LOG_ERR, "Unable to load native routes: invalid module");
+        return false;
+    }
+    return true;
+}
+
+
+static bool set_native_routes(PyObject *py_routes)
+{
+    PyObject *py_modules = NULL;
+    PyObject *py_keys = NULL;
+    PyObject *py_published_keys = NULL;
+
+    if (!PyArg_ParseTuple(py_routes, "dO!O!O!", &native_timeout,
+            &PyList_Type, &py_modules, &PyDict_Type, &py_keys,
+            &PyDict_Type, &py_published_keys)) {
+        log(LOG_ERR,
+                "Unable to load native routes: "
+                "get_native_routes() returned invalid result");
+        log_python_exception();
+        return false;
+    }
+
+    Py_ssize_t n_modules = PyList_GET_SIZE(py_modules);
+    native_modules = calloc(n_modules ? n_modules : 1,
+            sizeof(*native_modules));
+    if (!native_modules) {
+        log(LOG_ERR, "Unable to load native routes: calloc() failed");
+        return false;
+    }
+    for (Py_ssize_t i = 0; i < n_modules; ++i) {
+        NativeModule *module = &native_modules[n_native_modules++];
+        module->fd = -1;
+        if (!load_native_module(PyList_GET_ITEM(py_modules, i), module)) {
+            return false;
+        }
+    }
+
+    int n_routes = 0;
+    int n_published = 0;
+    for (int i = 0; i < n_item_keys; ++i) {
+        PyObject *py_module_n = PyDict_GetItem(py_keys, item_keys[i].py_key);
+        PyObject *py_published_module_n = PyDict_GetItem(py_published_keys,
+                item_keys[i].py_key);
+        if (!py_module_n && !py_published_module_n) {
+            continue;
+        }
+
+        int module_n;
+        if (!get_int_from_py(
+                    py_module_n ? py_module_n : py_published_module_n,
+                    &module_n, NULL) ||
+                (module_n < 0) || (module_n >= n_native_modules)) {
+            log(LOG_ERR, "Unable to load native routes: invalid module "
+                    "index for item '%s'", item_keys[i].key);
+            return false;
+        }
+        item_keys[i].module_n = module_n;
+        if (py_module_n) {
+            item_keys[i].native_rpc = true;
+            ++n_routes;
+        }
+        if (py_published_module_n) {
+            item_keys[i].published = true;
+            ++n_published;
+        }
+    }
+
+    log(LOG_INFO, "%d items will be requested without python, %d items "
+            "will be read from value plane", n_routes, n_published);
+    return true;
+}
+
+
+static void load_native_routes()
+{
+    PyObject *py_routes = call_py_fn(mod_zabbix.get_native_routes_fn, NULL);
+    if (!py_routes) {
+        log(LOG_ERR, "Unable to load native routes: "
+                "call to get_native_routes() failed");
+        return;
+    }
+
+    if ((py_routes != Py_None) && !set_native_routes(py_routes)) {
+        /* Everything still works through python. */
+        free_native_modules();
+    }
+    Py_DECREF(py_routes);
+}
+
+
 ZBX_METRIC *zbx_module_item_list()
 {
     if (item_list) {
@@ -1391,6 +2427,12 @@ ZBX_METRIC *zbx_module_item_list()
         goto on_error;
     }
 
+    if (!create_item_keys(result, n_items)) {
+        goto on_error;
+    }
+
+    load_native_routes();
+
     item_list = result;
 
     log(LOG_INFO, "Found %d supported items", n_items);
@@ -1411,6 +2453,272 @@ on_error:
 }
 
 
+#if defined(ZBX_MODULE_API_VERSION) && (ZBX_MODULE_API_VERSION >= 2)
+static PyObject *create_history_column(const void *history, int history_num,
+        size_t stride, size_t offset, size_t size)
+{
+    PyObject *py_column = PyBytes_FromStringAndSize(NULL,
+            (Py_ssize_t) (history_num * size));
+    if (!py_column) {
+        log(LOG_ERR, "Unable to create history column: "
+                "PyBytes_FromStringAndSize() failed");
+        log_python_exception();
+        return NULL;
+    }
+
+    char *data = PyBytes_AS_STRING(py_column);
+    const char *row = history;
+    for (int i = 0; i < history_num; ++i) {
+        memcpy(data, row + offset, size);
+        data += size;
+        row += stride;
+    }
+    return py_column;
+}
+
+
+static PyObject *create_history_string_column(const void *history,
+        int history_num, size_t stride, size_t offset)
+{
+    PyObject *py_column = PyList_New(history_num);
+    if (!py_column) {
+        log(LOG_ERR, "Unable to create history column: PyList_New() failed");
+        log_python_exception();
+        return NULL;
+    }
+
+    const char *row = history;
+    for (int i = 0; i < history_num; ++i) {
+        const char *string = *(const char *const *) (row + offset);
+        PyObject *py_string;
+        if (string) {
+            py_string = PyUnicode_DecodeUTF8(string, strlen(string),
+                    "replace");
+            if (!py_string) {
+                log(LOG_ERR, "Unable to create history column: "
+                        "PyUnicode_DecodeUTF8() failed");
+                log_python_exception();
+                Py_DECREF(py_column);
+                return NULL;
+            }
+        } else {
+            py_string = Py_None;
+            Py_INCREF(py_string);
+        }
+        /* "Steals" py_string reference. */
+        PyList_SET_ITEM(py_column, i, py_string);
+        row += stride;
+    }
+    return py_column;
+}
+
+
+/* Steals reference to py_column. */
+static bool add_history_column(PyObject *py_columns, const char *name,
+        PyObject *py_column)
+{
+    if (!py_column) {
+        return false;
+    }
+
+    int ret = PyDict_SetItemString(py_columns, name, py_column);
+    Py_DECREF(py_column);
+    if (ret) {
+        log(LOG_ERR, "Unable to create history column: "
+                "PyDict_SetItemString() failed");
+        log_python_exception();
+        return false;
+    }
+    return true;
+}
+
+
+#define HISTORY_COLUMN(py_columns, type, history, history_num, field) \
+    add_history_column(py_columns, #field, create_history_column( \
+            history, history_num, sizeof(type), offsetof(type, field), \
+            sizeof(((const type *) NULL)->field)))
+
+#define HISTORY_STRING_COLUMN(py_columns, type, history, history_num, field) \
+    add_history_column(py_columns, #field, create_history_string_column( \
+            history, history_num, sizeof(type), offsetof(type, field)))
+
+/* Columns present in history of all value types. */
+#define HISTORY_COMMON_COLUMNS(py_columns, type, history, history_num) \
+    (HISTORY_COLUMN(py_columns, type, history, history_num, itemid) && \
+     HISTORY_COLUMN(py_columns, type, history, history_num, clock) && \
+     HISTORY_COLUMN(py_columns, type, history, history_num, ns))
+
+
+static PyObject *create_history_columns()
+{
+    if (!check_if_forked()) {
+        return NULL;
+    }
+
+    PyObject *py_columns = PyDict_New();
+    if (!py_columns) {
+        log(LOG_ERR, "Unable to create history columns: PyDict_New() failed");
+        log_python_exception();
+        return NULL;
+    }
+    return py_columns;
+}
+
+
+/* Steals reference to py_columns. */
+static void call_history_write_fn(const char *value_type, PyObject *py_columns,
+        bool no_errors)
+{
+    if (!py_columns) {
+        return;
+    }
+
+    if (no_errors) {
+        PyObject *py_ret = PyObject_CallFunction(mod_zabbix.history_write_fn,
+                "sO", value_type, py_columns);
+        if (!py_ret) {
+            log(LOG_ERR, "Unable to write history of type '%s': "
+                    "call to history_write() failed",
+                    value_type);
+            log_python_exception();
+        }
+        Py_XDECREF(py_ret);
+    } else {
+        log(LOG_ERR, "Unable to write history of type '%s': "
+                "unable to create columns",
+                value_type);
+    }
+
+    Py_DECREF(py_columns);
+}
+
+
+static void history_float_cb(const ZBX_HISTORY_FLOAT *history, int history_num)
+{
+    PyObject *py_columns = create_history_columns();
+    call_history_write_fn("float", py_columns, py_columns &&
+            HISTORY_COMMON_COLUMNS(py_columns, ZBX_HISTORY_FLOAT,
+                    history, history_num) &&
+            HISTORY_COLUMN(py_columns, ZBX_HISTORY_FLOAT,
+                    history, history_num, value));
+}
+
+
+static void history_integer_cb(const ZBX_HISTORY_INTEGER *history,
+        int history_num)
+{
+    PyObject *py_columns = create_history_columns();
+    call_history_write_fn("integer", py_columns, py_columns &&
+            HISTORY_COMMON_COLUMNS(py_columns, ZBX_HISTORY_INTEGER,
+                    history, history_num) &&
+            HISTORY_COLUMN(py_columns, ZBX_HISTORY_INTEGER,
+                    history, history_num, value));
+}
+
+
+static void history_string_cb(const ZBX_HISTORY_STRING *history,
+        int history_num)
+{
+    PyObject *py_columns = create_history_columns();
+    call_history_write_fn("string", py_columns, py_columns &&
+            HISTORY_COMMON_COLUMNS(py_columns, ZBX_HISTORY_STRING,
+                    history, history_num) &&
+            HISTORY_STRING_COLUMN(py_columns, ZBX_HISTORY_STRING,
+                    history, history_num, value));
+}
+
+
+static void history_text_cb(const ZBX_HISTORY_TEXT *history, int history_num)
+{
+    PyObject *py_columns = create_history_columns();
+    call_history_write_fn("text", py_columns, py_columns &&
+            HISTORY_COMMON_COLUMNS(py_columns, ZBX_HISTORY_TEXT,
+                    history, history_num) &&
+            HISTORY_STRING_COLUMN(py_columns, ZBX_HISTORY_TEXT,
+                    history, history_num, value));
+}
+
+
+static void history_log_cb(const ZBX_HISTORY_LOG *history, int history_num)
+{
+    PyObject *py_columns = create_history_columns();
+    call_history_write_fn("log", py_columns, py_columns &&
+            HISTORY_COMMON_COLUMNS(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num) &&
+            HISTORY_STRING_COLUMN(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num, value) &&
+            HISTORY_STRING_COLUMN(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num, source) &&
+            HISTORY_COLUMN(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num, timestamp) &&
+            HISTORY_COLUMN(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num, logeventid) &&
+            HISTORY_COLUMN(py_columns, ZBX_HISTORY_LOG,
+                    history, history_num, severity));
+}
+
+
+static bool has_history_type(PyObject *py_types, const char *value_type)
+{
+    PyObject *py_value_type = PyUnicode_FromString(value_type);
+    if (!py_value_type) {
+        log(LOG_ERR, "Unable to get history types: "
+                "PyUnicode_FromString() failed");
+        log_python_exception();
+        return false;
+    }
+
+    int ret = PySequence_Contains(py_types, py_value_type);
+    Py_DECREF(py_value_type);
+    if (ret == -1) {
+        log(LOG_ERR, "Unable to get history types: "
+                "PySequence_Contains() failed");
+        log_python_exception();
+        return false;
+    }
+    return ret == 1;
+}
+
+
+ZBX_HISTORY_WRITE_CBS zbx_module_history_write_cbs()
+{
+    ZBX_HISTORY_WRITE_CBS callbacks = {0};
+
+    if (!check_if_forked()) {
+        return callbacks;
+    }
+
+    /* Only callbacks for value types requested by modules are registered,
+     * so zabbix does not prepare history which nobody needs. */
+    PyObject *py_types = call_py_fn(mod_zabbix.history_types_fn, NULL);
+    if (!py_types) {
+        log(LOG_ERR, "Unable to get history types: "
+                "call to history_types() failed");
+        return callbacks;
+    }
+
+    if (has_history_type(py_types, "float")) {
+        callbacks.history_float_cb = history_float_cb;
+    }
+    if (has_history_type(py_types, "integer")) {
+        callbacks.history_integer_cb = history_integer_cb;
+    }
+    if (has_history_type(py_types, "string")) {
+        callbacks.history_string_cb = history_string_cb;
+    }
+    if (has_history_type(py_types, "text")) {
+        callbacks.history_text_cb = history_text_cb;
+    }
+    if (has_history_type(py_types, "log")) {
+        callbacks.history_log_cb = history_log_cb;
+    }
+
+    Py_DECREF(py_types);
+    return callbacks;
+}
+#endif
+
+
 int zbx_module_uninit()
 {
     int ret_code = ZBX_MODULE_OK;
@@ -1421,6 +2729,8 @@ int zbx_module_uninit()
         goto on_error;
     }
 
+    free_native_modules();
+    free_item_keys();
     free_item_list(item_list);
     item_list = NULL;
 
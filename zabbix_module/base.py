@@ -1,12 +1,27 @@
 from __future__ import absolute_import
 
 import abc
+import logging
 
 import six
 
 
+_log = logging.getLogger(__name__)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class ModuleBase(object):
+    # Set by loader: object with record(key, duration, failed) method, which
+    # should be called for each item request.
+    item_stats = None
+    # Set by loader: object with publish(key, params, result, timestamp,
+    # max_age) method, which makes values of asynchronous items available to
+    # agent processes without RPC.
+    value_sink = None
+    # Value types of history ("float", "integer", "string", "text", "log")
+    # which module receives from Zabbix server through remote_history_write().
+    history_types = ()
+
     def __init__(self, module_type, module_name, module_conf):
         self.module_type = module_type
         self.module_name = module_name
@@ -20,5 +35,45 @@ class ModuleBase(object):
     def remote_get_value(self, key, *params):
         pass
 
+    def remote_get_values(self, requests):
+        results = []
+        for key, params in requests:
+            try:
+                results.append(self.remote_get_value(key, *params))
+            except Exception as exc:
+                _log.exception('Unable to get item %r', (key, params))
+                results.append({'msg': 'Unable to get item: %r' % exc,
+                                'result': False})
+        return results
+
+    def remote_history_types(self):
+        return list(self.history_types)
+
+    def remote_history_write(self, value_type, columns):
+        # Columns is dict of lists of equal length: "itemid", "clock", "ns",
+        # "value", and for "log" type also "source", "timestamp",
+        # "logeventid" and "severity".
+        pass
+
+    def is_blocking_item(self, key):
+        # True if item should be executed in loader's worker pool, False if
+        # it should be executed in event loop, None to use loader's default.
+        return None
+
+    def get_collectors(self):
+        # List of dicts with "name", "interval", "jitter" and "blocking" keys
+        # describing functions which loader should run periodically.
+        return []
+
+    def run_collector(self, name):
+        raise RuntimeError('Unknown collector: "%s"' % name)
+
+    def on_collector_result(self, name, data):
+        # Always called from loader's event loop.
+        pass
+
+    def set_value_sink(self, value_sink):
+        self.value_sink = value_sink
+
     def on_module_terminate(self):
         pass
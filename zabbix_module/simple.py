@@ -1,16 +1,27 @@
 from __future__ import absolute_import
 
 import inspect
+import logging
 import time
 
 import six
 
+import trollius
+
 import zabbix_module.base
 import zabbix_module.types as types
 
 
 _GET_FN_PREFIX = 'get_'
 
+# Data of asynchronous item filled by collector is considered stale after
+# this number of collection intervals.
+_COLLECTOR_MAX_INTERVALS = 3
+_COLLECTOR_DEFAULT_JITTER = 0.1
+
+
+_log = logging.getLogger(__name__)
+
 
 def _add_args_check(fn, argspec):
     max_args = len(argspec.args) - 1
@@ -58,7 +69,8 @@ def _add_converters(fn, argspec, arg_converters):
     return _convert
 
 
-def _item(fn, name=None, arg_converters=None, test_params=None):
+def _item(fn, name=None, arg_converters=None, test_params=None,
+          cache_ttl=None, blocking=None):
     if name is None:
         if not fn.__name__.startswith(_GET_FN_PREFIX):
             raise RuntimeError(
@@ -68,6 +80,9 @@ def _item(fn, name=None, arg_converters=None, test_params=None):
         name = fn.__name__[len(_GET_FN_PREFIX):]
 
     argspec = inspect.getargspec(fn)
+    is_coroutine = trollius.iscoroutinefunction(fn)
+    if is_coroutine and blocking:
+        raise RuntimeError('Coroutine item could not be blocking: "%s"' % name)
 
     if not argspec.args:
         raise RuntimeError('Functions without "self" argument are not '
@@ -86,11 +101,67 @@ def _item(fn, name=None, arg_converters=None, test_params=None):
     else:
         fn.test_param = ','.join(test_params)
 
+    fn.cache_ttl = cache_ttl
+    # Coroutines are always executed in loader's event loop.
+    fn.blocking = False if is_coroutine else blocking
+
+    return fn
+
+
+def item(name=None, arg_converters=None, test_params=None, cache_ttl=None,
+         blocking=None):
+    return lambda fn: _item(fn, name, arg_converters, test_params, cache_ttl,
+                            blocking)
+
+
+def _collector(fn, interval, items, jitter, blocking):
+    if interval <= 0:
+        raise RuntimeError('Invalid collector interval: %r' % interval)
+    if trollius.iscoroutinefunction(fn):
+        if blocking:
+            raise RuntimeError('Coroutine collector could not be blocking: '
+                               '"%s"' % fn.__name__)
+        blocking = False
+
+    if isinstance(items, dict):
+        async_items = items
+    else:
+        async_items = dict(
+                (item_name, {
+                    'max_time_diff': interval * _COLLECTOR_MAX_INTERVALS,
+                }) for item_name in items)
+
+    fn.collector_interval = interval
+    fn.collector_items = async_items
+    if jitter is None:
+        jitter = interval * _COLLECTOR_DEFAULT_JITTER
+    fn.collector_jitter = jitter
+    fn.collector_blocking = blocking
+
     return fn
 
 
-def item(name=None, arg_converters=None, test_params=None):
-    return lambda fn: _item(fn, name, arg_converters, test_params)
+def collector(interval, items, jitter=None, blocking=None):
+    # Decorated function should return dict {item_name: value} or
+    # {item_name: {params_tuple: value}} for items with parameters.
+    return lambda fn: _collector(fn, interval, items, jitter, blocking)
+
+
+# Exact type is looked up first, isinstance() checks are used for subclasses.
+_RESULT_CONVERTERS = dict(
+    [(integer_type, lambda result: {'ui64': result})
+     for integer_type in six.integer_types] +
+    [(string_type, lambda result: {'str': result})
+     for string_type in six.string_types] +
+    [
+        (float, lambda result: {'dbl': result}),
+        (types.Text, lambda result: {'text': result.get_string()}),
+        (types.NotSupported, lambda result: {
+            'msg': result.get_string(),
+            'result': False,
+        }),
+        (types.Discovery, lambda result: {'str': result.get_string()}),
+    ])
 
 
 class Simple(zabbix_module.base.ModuleBase):
@@ -108,9 +179,28 @@ class Simple(zabbix_module.base.ModuleBase):
             if hasattr(self_member, 'item_name'):
                 self._add_item(self_member.item_name, self_member)
 
+    def _add_collectors(self):
+        for self_member_name in dir(self):
+            self_member = getattr(self, self_member_name)
+            if hasattr(self_member, 'collector_interval'):
+                self.add_asynchronous_items(self_member.collector_items)
+                self._collectors['%s.%s' % (type(self).__name__,
+                                            self_member_name)] = (
+                    self, self_member)
+
     def add_submodule(self, submodule):
         for item_name, fn in six.iteritems(submodule._supported_items):
             self._add_item(item_name, fn)
+        self._collectors.update(submodule._collectors)
+        self._submodules.append(submodule)
+
+    def set_value_sink(self, value_sink, key_prefix=''):
+        super(Simple, self).set_value_sink(value_sink)
+        # Keys of submodule's items are prefixed by parent's prefix.
+        self._value_key_prefix = key_prefix
+        for submodule in self._submodules:
+            submodule.set_value_sink(value_sink,
+                                     key_prefix + self.items_prefix)
 
     def _get_async_item_function(self, item_name, max_time_diff, have_params):
         def _get_async_item_data(*args):
@@ -128,6 +218,9 @@ class Simple(zabbix_module.base.ModuleBase):
 
         _get_async_item_data.have_params = have_params
         _get_async_item_data.test_param = None
+        _get_async_item_data.cache_ttl = None
+        _get_async_item_data.blocking = False
+        _get_async_item_data.asynchronous = True
 
         return _get_async_item_data
 
@@ -139,6 +232,8 @@ class Simple(zabbix_module.base.ModuleBase):
                             item_name, item_dict['max_time_diff'],
                             item_dict.get('have_params', False)))
             self._asynchronous_data[self.items_prefix + item_name] = {}
+            self._max_time_diffs[self.items_prefix + item_name] = \
+                item_dict['max_time_diff']
 
     def __init__(self, *args, **kwargs):
         super(Simple, self).__init__(*args, **kwargs)
@@ -147,32 +242,145 @@ class Simple(zabbix_module.base.ModuleBase):
         self._add_supported_items()
 
         self._asynchronous_data = {}
+        self._max_time_diffs = {}
+        self._submodules = []
+        self._value_key_prefix = ''
+
+        # name -> (module, function)
+        self._collectors = {}
+        self._add_collectors()
 
     def remote_item_list(self):
         return [{
                     'key': key,
                     'flags': ('haveparams', ) if fn.have_params else (),
                     'test_param': fn.test_param,
+                    'cache_ttl': fn.cache_ttl,
+                    'asynchronous': getattr(fn, 'asynchronous', False),
                 } for key, fn in six.iteritems(self._supported_items)]
 
-    def remote_get_value(self, key, *params):
+    def _convert_result(self, key, result):
+        converter = _RESULT_CONVERTERS.get(type(result))
+        if converter is None:
+            for result_type, converter in six.iteritems(_RESULT_CONVERTERS):
+                if isinstance(result, result_type):
+                    break
+            else:
+                raise RuntimeError(
+                        'Item "%s" returned value of unknown type "%s": %r' % (
+                            key, type(result).__name__, result))
+        return converter(result)
+
+    def _record(self, key, start_time, result):
+        # Result is None if item raised exception.
+        self.item_stats.record(
+                key, time.time() - start_time,
+                (result is None) or (not result.get('result', True)))
+
+    @staticmethod
+    def _get_failure(key, params, exc):
+        _log.error('Unable to get item %r', (key, params), exc_info=True)
+        return {'msg': 'Unable to get item: %r' % exc, 'result': False}
+
+    @trollius.coroutine
+    def _get_coroutine_value(self, key, params, coroutine, start_time,
+                             catch_errors=False):
+        # Items of batch fail separately, single request fails as a whole.
+        result = None
+        try:
+            result = self._convert_result(
+                    key, (yield trollius.From(coroutine)))
+        except trollius.CancelledError:
+            raise
+        except Exception as exc:
+            if not catch_errors:
+                raise
+            result = self._get_failure(key, params, exc)
+        finally:
+            if start_time is not None:
+                self._record(key, start_time, result)
+        raise trollius.Return(result)
+
+    def _get_value(self, key, params, start_time):
         result = self._supported_items[key](*params)
-        if isinstance(result, six.integer_types):
-            return {'ui64': result}
-        elif isinstance(result, float):
-            return {'dbl': result}
-        elif isinstance(result, six.string_types):
-            return {'str': result}
-        elif isinstance(result, types.Text):
-            return {'text': result.get_string()}
-        elif isinstance(result, types.NotSupported):
-            return {'msg': result.get_string(), 'result': False}
-        elif isinstance(result, types.Discovery):
-            return {'str': result.get_string()}
-        else:
-            raise RuntimeError(
-                    'Item "%s" returned value of unknown type "%s": %r' % (
-                        key, type(result).__name__, result))
+        if trollius.iscoroutine(result):
+            return self._get_coroutine_value(key, params, result, start_time)
+        return self._convert_result(key, result)
+
+    def remote_get_value(self, key, *params):
+        # Returns coroutine for coroutine items, loader will run it.
+        if self.item_stats is None:
+            return self._get_value(key, params, None)
+
+        start_time = time.time()
+        result = None
+        try:
+            result = self._get_value(key, params, start_time)
+        finally:
+            if not trollius.iscoroutine(result):
+                self._record(key, start_time, result)
+        return result
+
+    @trollius.coroutine
+    def _complete_values(self, results, coroutines):
+        values = yield trollius.From(trollius.gather(
+                *[coroutine for _, coroutine in coroutines]))
+        for (result_n, _), value in zip(coroutines, values):
+            results[result_n] = value
+        raise trollius.Return(results)
+
+    def remote_get_values(self, requests):
+        supported_items = self._supported_items
+        convert_result = self._convert_result
+        item_stats = self.item_stats
+
+        results = []
+        coroutines = []
+        for key, params in requests:
+            start_time = None if item_stats is None else time.time()
+            try:
+                result = supported_items[key](*params)
+                if trollius.iscoroutine(result):
+                    coroutines.append((len(results), self._get_coroutine_value(
+                            key, params, result, start_time, True)))
+                    results.append(None)
+                    continue
+                result = convert_result(key, result)
+            except Exception as exc:
+                result = self._get_failure(key, params, exc)
+            if start_time is not None:
+                self._record(key, start_time, result)
+            results.append(result)
+
+        if coroutines:
+            # Coroutine items from one batch run concurrently.
+            return self._complete_values(results, coroutines)
+        return results
+
+    def is_blocking_item(self, key):
+        fn = self._supported_items.get(key)
+        if fn is None:
+            return None
+        return fn.blocking
+
+    def get_collectors(self):
+        return [{
+                    'name': name,
+                    'interval': fn.collector_interval,
+                    'jitter': fn.collector_jitter,
+                    'blocking': fn.collector_blocking,
+                } for name, (_, fn) in six.iteritems(self._collectors)]
+
+    def run_collector(self, name):
+        _, fn = self._collectors[name]
+        return fn()
+
+    def on_collector_result(self, name, data):
+        module, _ = self._collectors[name]
+        module.update_asynchronous_items(dict(
+                (item_name, item_data if isinstance(item_data, dict)
+                 else {(): item_data})
+                for item_name, item_data in six.iteritems(data)))
 
     def update_asynchronous_items(self, new_data):
         cur_time = time.time()
@@ -185,3 +393,18 @@ class Simple(zabbix_module.base.ModuleBase):
                     'timestamp': cur_time,
                     'data': item_data,
                 }
+            if self.value_sink is not None:
+                self._publish_values(item_name, item_args_dict, cur_time)
+
+    def _publish_values(self, item_name, item_args_dict, cur_time):
+        key = self._value_key_prefix + item_name
+        max_time_diff = self._max_time_diffs[item_name]
+        for item_args, item_data in six.iteritems(item_args_dict):
+            try:
+                result = self._convert_result(key, item_data)
+            except Exception:
+                _log.exception('Unable to publish value of item %r',
+                               (key, item_args))
+                continue
+            self.value_sink.publish(key, item_args, result, cur_time,
+                                    max_time_diff)
@@ -1,20 +1,115 @@
 from __future__ import absolute_import
 
+import collections
+import errno
 import os
-import os.path
+import threading
+import time
 
 import zabbix_module.simple as simple
 import zabbix_module.types as types
 
 
-def _read_file(file_path, conv=None):
-    if not os.path.exists(file_path):
-        return types.NotSupported('{0} does not exist', file_path)
-    with open(file_path) as value_file:
+# Reads into buf starting from given offset of both file and buffer, returns
+# number of bytes read. Files are always read sequentially from offset 0.
+if hasattr(os, 'preadv'):
+    def _read_at(fd, buf, offset):
+        return os.preadv(fd, [memoryview(buf)[offset:]], offset)
+elif hasattr(os, 'pread'):
+    def _read_at(fd, buf, offset):
+        data = os.pread(fd, len(buf) - offset, offset)
+        buf[offset:offset + len(data)] = data
+        return len(data)
+else:
+    def _read_at(fd, buf, offset):
+        if offset == 0:
+            os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, len(buf) - offset)
+        buf[offset:offset + len(data)] = data
+        return len(data)
+
+
+class _FileReader(object):
+    """
+    Keeps procfs and sysfs files open and reads them from the beginning each
+    time, instead of opening them again on every read.
+    """
+
+    _INITIAL_BUF_SIZE = 4096
+    # File is reopened once after these errors (device removed and so on).
+    _REOPEN_ERRNOS = frozenset((
+        errno.ENODEV, errno.ENOENT, errno.EBADF, errno.ESTALE))
+
+    def __init__(self, max_open_files):
+        self._max_open_files = max_open_files
+
+        self._fds = collections.OrderedDict()
+        self._buf = bytearray(self._INITIAL_BUF_SIZE)
+        self._lock = threading.Lock()
+
+    def _get_fd(self, file_path):
+        fd = self._fds.pop(file_path, None)
+        if fd is None:
+            fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+            while self._fds and (len(self._fds) >= self._max_open_files):
+                _, old_fd = self._fds.popitem(last=False)
+                os.close(old_fd)
+        self._fds[file_path] = fd
+        return fd
+
+    def _close_fd(self, file_path):
+        fd = self._fds.pop(file_path, None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _read_fd(self, fd):
+        # Short read does not mean end of file for procfs, so read until
+        # zero is returned.
+        buf = self._buf
+        size = 0
+        while True:
+            if size == len(buf):
+                buf = self._buf = buf + bytearray(len(buf))
+            read_size = _read_at(fd, buf, size)
+            if not read_size:
+                return buf[:size].decode('utf-8')
+            size += read_size
+
+    def _read(self, file_path):
+        try:
+            return self._read_fd(self._get_fd(file_path))
+        except OSError as exc:
+            if exc.errno not in self._REOPEN_ERRNOS:
+                raise
+            self._close_fd(file_path)
+        return self._read_fd(self._get_fd(file_path))
+
+    def read(self, file_path, conv=None):
+        with self._lock:
+            try:
+                data = self._read(file_path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                self._close_fd(file_path)
+                return types.NotSupported('{0} does not exist', file_path)
+            finally:
+                # Zero limit means that files are not kept open at all.
+                if self._max_open_files < 1:
+                    self._close_fd(file_path)
+
         if conv is None:
-            return value_file.read()
+            return data
         else:
-            return conv(value_file.read())
+            return conv(data)
+
+    def close(self):
+        with self._lock:
+            while self._fds:
+                self._close_fd(next(iter(self._fds)))
 
 
 class _KSM(simple.Simple):
@@ -24,43 +119,91 @@ class _KSM(simple.Simple):
 
     items_prefix = 'ksm.'
 
+    def __init__(self, file_reader, *args, **kwargs):
+        super(_KSM, self).__init__(*args, **kwargs)
+
+        self._file_reader = file_reader
+
     @simple.item()
     def get_pages_shared(self):
-        return _read_file('/sys/kernel/mm/ksm/pages_shared', int)
+        return self._file_reader.read('/sys/kernel/mm/ksm/pages_shared', int)
 
     @simple.item()
     def get_pages_sharing(self):
-        return _read_file('/sys/kernel/mm/ksm/pages_sharing', int)
+        return self._file_reader.read('/sys/kernel/mm/ksm/pages_sharing', int)
 
     @simple.item()
     def get_pages_unshared(self):
-        return _read_file('/sys/kernel/mm/ksm/pages_unshared', int)
+        return self._file_reader.read('/sys/kernel/mm/ksm/pages_unshared', int)
 
     @simple.item()
     def get_pages_volatile(self):
-        return _read_file('/sys/kernel/mm/ksm/pages_volatile', int)
+        return self._file_reader.read('/sys/kernel/mm/ksm/pages_volatile', int)
 
     @simple.item()
     def get_full_scans(self):
-        return _read_file('/sys/kernel/mm/ksm/full_scans', int)
+        return self._file_reader.read('/sys/kernel/mm/ksm/full_scans', int)
 
 
-def _get_field(field_n, conv=None):
-    def _really_get_field(str_value):
-        field_values = str_value.split()
-        if (not str_value) or (len(field_values) <= field_n):
-            return types.NotSupported(
-                    'String "{0}" does not contain field #{1}',
-                    str_value, field_n)
+class _BlockStatSnapshot(object):
+    """
+    $KERNEL_SRC/Documentation/iostats.txt
 
-        field_value = field_values[field_n]
+    Statistics of all block devices are read from /proc/diskstats at once and
+    reused during the configured time window.
+    """
 
-        if conv is None:
-            return field_value
+    _DISKSTATS_PATH = '/proc/diskstats'
+    # Major number, minor number and device name.
+    _N_HEADER_FIELDS = 3
+
+    def __init__(self, file_reader, window):
+        self._file_reader = file_reader
+        self._window = window
+
+        self._stats = {}
+        self._timestamp = None
+
+        self.refreshes = 0
+        self.reuses = 0
+
+    def _refresh(self):
+        diskstats = self._file_reader.read(self._DISKSTATS_PATH)
+        if isinstance(diskstats, types.NotSupported):
+            raise RuntimeError(diskstats.get_string())
+
+        stats = {}
+        for line in diskstats.splitlines():
+            fields = line.split()
+            if len(fields) <= self._N_HEADER_FIELDS:
+                continue
+            # Same as in /sys/class/block.
+            block_dev_name = fields[self._N_HEADER_FIELDS - 1].replace(
+                    '/', '!')
+            stats[block_dev_name] = fields[self._N_HEADER_FIELDS:]
+        self._stats = stats
+        self.refreshes += 1
+
+    def _get_stats(self):
+        cur_time = time.time()
+        if (self._timestamp is None) or \
+                not (0 <= cur_time - self._timestamp < self._window):
+            self._refresh()
+            self._timestamp = cur_time
         else:
-            return conv(field_value)
-
-    return _really_get_field
+            self.reuses += 1
+        return self._stats
+
+    def get_field(self, block_dev_name, field_n):
+        fields = self._get_stats().get(block_dev_name)
+        if fields is None:
+            return types.NotSupported('Block device {0} not found in {1}',
+                                      block_dev_name, self._DISKSTATS_PATH)
+        if len(fields) <= field_n:
+            return types.NotSupported(
+                    'Statistics of block device {0} do not contain '
+                    'field #{1}', block_dev_name, field_n)
+        return int(fields[field_n])
 
 
 class _Block(simple.Simple):
@@ -70,6 +213,13 @@ class _Block(simple.Simple):
 
     items_prefix = 'block.'
 
+    def __init__(self, file_reader, *args, **kwargs):
+        super(_Block, self).__init__(*args, **kwargs)
+
+        self._snapshot = _BlockStatSnapshot(
+                file_reader,
+                self.module_conf.get('block_snapshot_window', 1.0))
+
     @simple.item()
     def get_discovery(self):
         return types.Discovery({
@@ -78,58 +228,55 @@ class _Block(simple.Simple):
 
     @simple.item(test_params='sda')
     def get_read_ios(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(0, int))
+        return self._snapshot.get_field(block_dev_name, 0)
 
     @simple.item(test_params='sda')
     def get_read_merges(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(1, int))
+        return self._snapshot.get_field(block_dev_name, 1)
 
     @simple.item(test_params='sda')
     def get_read_sectors(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(2, int))
+        return self._snapshot.get_field(block_dev_name, 2)
 
     @simple.item(test_params='sda')
     def get_read_ticks(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(3, int))
+        return self._snapshot.get_field(block_dev_name, 3)
 
     @simple.item(test_params='sda')
     def get_write_ios(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(4, int))
+        return self._snapshot.get_field(block_dev_name, 4)
 
     @simple.item(test_params='sda')
     def get_write_merges(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(5, int))
+        return self._snapshot.get_field(block_dev_name, 5)
 
     @simple.item(test_params='sda')
     def get_write_sectors(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(6, int))
+        return self._snapshot.get_field(block_dev_name, 6)
 
     @simple.item(test_params='sda')
     def get_write_ticks(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(7, int))
+        return self._snapshot.get_field(block_dev_name, 7)
 
     @simple.item(test_params='sda')
     def get_in_flight(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(8, int))
+        return self._snapshot.get_field(block_dev_name, 8)
 
     @simple.item(test_params='sda')
     def get_io_ticks(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(9, int))
+        return self._snapshot.get_field(block_dev_name, 9)
 
     @simple.item(test_params='sda')
     def get_time_in_queue(self, block_dev_name):
-        return _read_file('/sys/class/block/%s/stat' % block_dev_name,
-                          _get_field(10, int))
+        return self._snapshot.get_field(block_dev_name, 10)
+
+    @simple.item()
+    def get_snapshot_refreshes(self):
+        return self._snapshot.refreshes
+
+    @simple.item()
+    def get_snapshot_reuses(self):
+        return self._snapshot.reuses
 
 
 class Main(simple.Simple):
@@ -138,5 +285,11 @@ class Main(simple.Simple):
     def __init__(self, *args, **kwargs):
         super(Main, self).__init__(*args, **kwargs)
 
-        self.add_submodule(_KSM(*args, **kwargs))
-        self.add_submodule(_Block(*args, **kwargs))
+        self._file_reader = _FileReader(
+                self.module_conf.get('max_open_files', 64))
+
+        self.add_submodule(_KSM(self._file_reader, *args, **kwargs))
+        self.add_submodule(_Block(self._file_reader, *args, **kwargs))
+
+    def on_module_terminate(self):
+        self._file_reader.close()
@@ -4,16 +4,21 @@ import math
 import random
 import time
 
+import trollius
+
 import zabbix_module.simple as simple
 
 
 class Test(simple.Simple):
     items_prefix = 'zpm.test.'
+    history_types = ('float', 'integer', 'string', 'text', 'log')
 
     def __init__(self, *args, **kwargs):
         super(Test, self).__init__(*args, **kwargs)
 
         self._random_val = random.randint(0, 1000)
+        self._collections = 0
+        self._history_values = dict.fromkeys(self.history_types, 0)
 
     @simple.item()
     def get_sine(self):
@@ -33,3 +38,26 @@ class Test(simple.Simple):
         for arg in args[:-1]:
             exec(arg)
         return eval(args[-1])
+
+    @simple.item(arg_converters={'seconds': float}, test_params='0')
+    @trollius.coroutine
+    def get_sleep(self, seconds):
+        yield trollius.From(trollius.sleep(seconds))
+        raise trollius.Return(seconds)
+
+    @simple.collector(interval=10, items=('collections', 'collection_time'))
+    def collect(self):
+        self._collections += 1
+        return {
+            'collections': self._collections,
+            'collection_time': time.time(),
+        }
+
+    def remote_history_write(self, value_type, columns):
+        self._history_values[value_type] += len(columns['itemid'])
+
+    # Counters exist only in instance of loader process, not in instances of
+    # process pool.
+    @simple.item(test_params='float', blocking=False)
+    def get_history_values(self, value_type):
+        return self._history_values[value_type]
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import errno
+import json
+import logging
+import os
+import time
+
+import zabbix_modules.modules as modules
+
+
+_log = logging.getLogger(__name__)
+
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+# Limits exponent of backoff, 2 ** 1024 does not fit into float.
+_MAX_BACKOFF_EXPONENT = 32
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops connection attempts to unavailable module for exponentially growing
+    time. State is shared between all agent processes through small file, so
+    only one of them retries connection after backoff time.
+    """
+
+    def __init__(self, name, state_path, backoff_min, backoff_max):
+        self._name = name
+        self._state_path = state_path
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+
+        # Used when state file could not be written.
+        self._failures = 0
+        self._retry_time = 0.0
+        self._shared = True
+
+    def _load(self):
+        if not self._shared:
+            return
+        try:
+            with open(self._state_path) as state_file:
+                state = json.load(state_file)
+            self._failures = state['failures']
+            self._retry_time = state['retry_time']
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                # Keep state of this process, item requests must not fail
+                # because of breaker.
+                _log.warning('Unable to read circuit breaker state from '
+                             '"%s", state will not be shared with other '
+                             'processes: %r', self._state_path, exc)
+                self._shared = False
+                return
+            self._failures = 0
+            self._retry_time = 0.0
+        except ValueError:
+            # Partially written by older version or corrupted.
+            _log.warning('Invalid circuit breaker state in "%s", ignoring',
+                         self._state_path)
+            self._failures = 0
+            self._retry_time = 0.0
+
+    def _save(self):
+        if not self._shared:
+            return
+        try:
+            if self._failures:
+                modules.write_file_atomically(
+                        self._state_path, json.dumps({
+                            'failures': self._failures,
+                            'retry_time': self._retry_time,
+                        }))
+            else:
+                os.unlink(self._state_path)
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                return
+            _log.warning('Unable to write circuit breaker state to "%s", '
+                         'state will not be shared with other processes: %r',
+                         self._state_path, exc)
+            self._shared = False
+
+    def get_state(self):
+        self._load()
+        if not self._failures:
+            return STATE_CLOSED
+        if time.time() < self._retry_time:
+            return STATE_OPEN
+        return STATE_HALF_OPEN
+
+    def check(self):
+        """
+        Raises CircuitOpenError if connection should not be attempted.
+        """
+        state = self.get_state()
+        if state == STATE_OPEN:
+            raise CircuitOpenError(
+                    'Module "%s" is unavailable, next connection attempt in '
+                    '%.1f seconds' % (
+                        self._name, self._retry_time - time.time()))
+        if state == STATE_HALF_OPEN:
+            # Other processes will wait while this one tries to connect.
+            self._retry_time = time.time() + self._get_backoff()
+            self._save()
+
+    def _get_backoff(self):
+        return min(self._backoff_max,
+                   self._backoff_min * 2 ** min(
+                       max(self._failures - 1, 0), _MAX_BACKOFF_EXPONENT))
+
+    def on_success(self):
+        if self._failures:
+            _log.info('Module "%s" is available again after %d failed '
+                      'connection attempts', self._name, self._failures)
+            self._failures = 0
+            self._retry_time = 0.0
+            self._save()
+
+    def on_failure(self):
+        self._load()
+        self._failures += 1
+        backoff = self._get_backoff()
+        self._retry_time = time.time() + backoff
+        _log.warning('Module "%s" is unavailable, failed connection attempts: '
+                     '%d, next attempt in %.1f seconds',
+                     self._name, self._failures, backoff)
+        self._save()
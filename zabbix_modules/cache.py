@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+
+import collections
+import time
+
+
+class ResultCache(object):
+    """
+    LRU cache of item results with per-entry TTL.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if (entry is None) or (entry[0] < time.time()):
+            self.misses += 1
+            return None
+
+        # Re-insert to mark entry as the most recently used.
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl):
+        if self._max_size <= 0:
+            return
+
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + ttl, value)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
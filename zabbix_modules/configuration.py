@@ -1,16 +1,23 @@
 from __future__ import absolute_import
 
+import json
 import os
 import os.path
-
-import yaml
+import zlib
 
 
 CONF = {}
 CONF_FILE_PATH = None
+# True if configuration was loaded from cache without parsing YAML.
+CONF_CACHED = False
 
 MODULE_CONF_EXT = '.conf'
 
+# Parsed configuration files are cached as JSON, which is much faster to
+# load in every Zabbix process than importing and running YAML parser.
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                          'python-zabbix-modules')
+
 
 def _get_default(module_type):
     return {
@@ -18,12 +25,21 @@ def _get_default(module_type):
                 '/', 'var', 'log', 'python-zabbix-modules',
                 'zabbix_%s.log' % module_type),
         'log_level': 'info',
+        'log_queue': {},
         'modules_conf_dir': os.path.join(
                 '/', 'etc', 'python-zabbix-modules',
                 'zabbix_%s.enabled.d' % module_type),
         'modules_sock_dir': os.path.join(
                 '/', 'var', 'run', 'python-zabbix-modules.%s' % module_type),
         'modules_sock_dir_access': {},
+        'result_cache_size': 1024,
+        'item_timeout': 3.0,
+        'item_list_timeout': 30.0,
+        'circuit_breaker_backoff_min': 1.0,
+        'circuit_breaker_backoff_max': 60.0,
+        'value_plane': True,
+        'native_get_value': False,
+        'preconnect': 'none',
     }
 
 
@@ -47,18 +63,102 @@ def _find_file(module_type):
             'Configuration file not found for "zabbix_%s"' % module_type)
 
 
-def load(module_type):
+def _get_cache_path(real_path):
+    # Files with the same name from different directories must not share
+    # cache, source stored in cache is checked anyway.
+    path_bytes = real_path
+    if not isinstance(path_bytes, bytes):
+        path_bytes = path_bytes.encode('utf-8')
+    return os.path.join(_CACHE_DIR, '%s.%08x.json' % (
+        os.path.basename(real_path), zlib.crc32(path_bytes) & 0xffffffff))
+
+
+def _can_create_cache_dir():
+    # Cache directory is not created in home directories not writable by
+    # user running agent or loader.
+    dir_path = _CACHE_DIR
+    while not os.path.isdir(dir_path):
+        parent_path = os.path.dirname(dir_path)
+        if parent_path == dir_path:
+            return False
+        dir_path = parent_path
+    return os.access(dir_path, os.W_OK)
+
+
+def _load_cache(cache_path, source):
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+        if cache['source'] == source:
+            return cache['conf']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _save_cache(cache_path, source, file_conf):
+    # Configuration which does not survive conversion to JSON is not cached.
+    try:
+        data = json.dumps({'source': source, 'conf': file_conf})
+    except (TypeError, ValueError):
+        return
+    if json.loads(data)['conf'] != file_conf:
+        return
+
+    if not _can_create_cache_dir():
+        return
+
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        if not os.path.isdir(_CACHE_DIR):
+            os.makedirs(_CACHE_DIR, 0o700)
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # Cache is optional, e.g. home directory may be not writable.
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def _load_file(file_path):
+    real_path = os.path.realpath(file_path)
+    stat = os.stat(real_path)
+    source = [real_path, stat.st_mtime, stat.st_size]
+    cache_path = _get_cache_path(real_path)
+
+    file_conf = _load_cache(cache_path, source)
+    if file_conf is not None:
+        return file_conf, True
+
+    # Imported only when needed, as import takes noticeable time.
+    import yaml
+
+    with open(file_path) as conf_file:
+        file_conf = yaml.safe_load(conf_file) or {}
+    _save_cache(cache_path, source, file_conf)
+    return file_conf, False
+
+
+def _load(module_type):
     conf = _get_default(module_type)
 
     file_path = _find_file(module_type)
-    with open(file_path) as conf_file:
-        conf.update(yaml.safe_load(conf_file) or {})
+    file_conf, cached = _load_file(file_path)
+    conf.update(file_conf)
+
+    return conf, file_path, cached
 
+
+def load(module_type):
+    conf, file_path, _ = _load(module_type)
     return conf, file_path
 
 
 def load_global(module_type):
-    global CONF, CONF_FILE_PATH
-    conf, CONF_FILE_PATH = load(module_type)
+    global CONF, CONF_FILE_PATH, CONF_CACHED
+    conf, CONF_FILE_PATH, CONF_CACHED = _load(module_type)
     CONF.clear()
     CONF.update(conf)
@@ -12,7 +12,12 @@ import stevedore
 def main():
     namespace = sys.argv[1]
     manager = stevedore.ExtensionManager(namespace)
-    json.dump(manager.names(), sys.stdout)
+    json.dump({
+        'modules': manager.names(),
+        # Installing or removing packages changes modification times of
+        # these directories, manager uses them to cache results.
+        'paths': [path for path in sys.path if os.path.isdir(path)],
+    }, sys.stdout)
     return os.EX_OK
 
 
@@ -2,10 +2,16 @@
 
 from __future__ import absolute_import
 
+import errno
 import functools
 import os
+import random
 import signal
+import socket
 import sys
+import time
+
+import concurrent.futures
 
 import yaml
 
@@ -19,25 +25,404 @@ import zabbix_modules.configuration as configuration
 import zabbix_modules.logging as logging
 import zabbix_modules.modules as modules
 import zabbix_modules.rpc as rpc
+import zabbix_modules.stats as stats
+import zabbix_modules.valueplane as valueplane
+
+
+_EXECUTOR_NONE = 'none'
+_EXECUTOR_THREAD = 'thread'
+_EXECUTOR_PROCESS = 'process'
+
+_INTERNAL_ITEMS_PREFIX = 'zpm.internal.%s.'
+
+_EXECUTORS = {
+    _EXECUTOR_THREAD: concurrent.futures.ThreadPoolExecutor,
+    _EXECUTOR_PROCESS: concurrent.futures.ProcessPoolExecutor,
+}
 
 
 _conf = configuration.CONF
 _log = None
 
+# Module instance and event loop of process pool worker.
+_pool_target = None
+_pool_loop = None
+
+
+class _PoolStats(object):
+    # Item statistics of pool process are sent back to loader with reply.
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, key, duration, failed):
+        self.records.append((key, duration, failed))
+
+
+def _load_module(namespace, module_type, module_name, module_conf):
+    return stevedore.DriverManager(
+            namespace, module_name, True,
+            invoke_kwds=dict(
+                    module_type=module_type,
+                    module_name=module_name,
+                    module_conf=module_conf))
+
+
+def _is_pending(reply):
+    return ('result' in reply) and trollius.iscoroutine(reply['result'])
+
+
+@trollius.coroutine
+def _complete_reply(reply):
+    result = yield trollius.From(reply['result'])
+    raise trollius.Return({'result': result})
+
+
+def _get_pool_target(module_args):
+    global _pool_target
+    global _pool_loop
+    if _pool_target is None:
+        _pool_target = _load_module(*module_args).driver
+        # Loop inherited from parent process must not be used here.
+        _pool_loop = trollius.new_event_loop()
+        trollius.set_event_loop(_pool_loop)
+    return _pool_target
+
+
+def _pool_collect(module_args, name):
+    result = _get_pool_target(module_args).run_collector(name)
+    if trollius.iscoroutine(result):
+        result = _pool_loop.run_until_complete(result)
+    return result
+
+
+def _pool_invoke(module_args, collect_stats, name, args, kwargs):
+    target = _get_pool_target(module_args)
+    if collect_stats:
+        target.item_stats = _PoolStats()
+    reply = rpc.invoke(target, name, args, kwargs)
+    if _is_pending(reply):
+        # Coroutines could not be sent back to parent process.
+        try:
+            reply = _pool_loop.run_until_complete(_complete_reply(reply))
+        except BaseException as exc:
+            _log.exception('RPC call %r failed', (name, args, kwargs))
+            reply = {
+                'error': '%r' % exc,
+            }
+    if collect_stats:
+        return reply, target.item_stats.records
+    return reply, ()
+
+
+class _Dispatcher(object):
+    def __init__(self, loop, target, module_args, loader_conf, item_stats):
+        self.target = target
+        self.loop = loop
+        self.stats = item_stats
+        # Sent to manager in reply to probes, so balance between workers
+        # sharing socket of module is visible.
+        self.load = {
+            'connections': 0,
+            'calls': 0,
+        }
+
+        self._module_args = module_args
+
+        executor_type = loader_conf['executor']
+        self._default_blocking = executor_type != _EXECUTOR_NONE
+        if not self._default_blocking:
+            # Pool for items explicitly marked as blocking.
+            executor_type = _EXECUTOR_THREAD
+        if executor_type not in _EXECUTORS:
+            raise RuntimeError('Unknown executor: "%s"' % executor_type)
+        self._executor_type = executor_type
+        self._executor_workers = loader_conf['executor_workers']
+        self._executor = None
+
+    def _is_blocking(self, name, args):
+        if name == 'get_value':
+            keys = args[:1]
+        elif name == 'get_values':
+            keys = [key for key, _ in args[0]]
+        elif name == 'history_write':
+            # Module instances of process pool do not serve items, history
+            # must reach instance of loader process.
+            return self._default_blocking and \
+                (self._executor_type != _EXECUTOR_PROCESS)
+        else:
+            return False
+
+        return any(self._is_blocking_key(key) for key in keys)
+
+    def _is_blocking_key(self, key):
+        blocking = self.target.is_blocking_item(key)
+        if blocking is None:
+            blocking = self._default_blocking
+        return blocking
+
+    def is_default_blocking(self):
+        return self._default_blocking
+
+    def _get_executor(self):
+        if self._executor is None:
+            _log.info('Starting %s pool with %d workers',
+                      self._executor_type, self._executor_workers)
+            self._executor = _EXECUTORS[self._executor_type](
+                    self._executor_workers)
+        return self._executor
+
+    @trollius.coroutine
+    def _complete_pool_call(self, future, local_reply, blocking):
+        if (local_reply is not None) and _is_pending(local_reply):
+            local_reply = yield trollius.From(_complete_reply(local_reply))
+
+        reply, records = yield trollius.From(future)
+        for record in records:
+            self.stats.record(*record)
+
+        if local_reply is None:
+            raise trollius.Return(reply)
+        if 'error' in local_reply:
+            raise trollius.Return(local_reply)
+        if 'result' in reply:
+            local_results = iter(local_reply['result'])
+            pool_results = iter(reply['result'])
+            reply = {
+                'result': [next(pool_results if key_blocking else
+                                local_results)
+                           for key_blocking in blocking],
+            }
+        raise trollius.Return(reply)
+
+    def _submit_to_process_pool(self, name, args, kwargs):
+        local_reply = None
+        blocking = None
+        if name == 'get_values':
+            # Only blocking items go to pool, the rest (including internal
+            # items, which exist only in loader process) is answered here.
+            requests = args[0]
+            blocking = [self._is_blocking_key(key) for key, _ in requests]
+            if not all(blocking):
+                local_reply = rpc.invoke(self.target, name, ([
+                    request for request, key_blocking
+                    in zip(requests, blocking) if not key_blocking], ), {})
+                args = ([
+                    request for request, key_blocking
+                    in zip(requests, blocking) if key_blocking], ) + \
+                    tuple(args[1:])
+
+        future = self.loop.run_in_executor(
+                self._get_executor(),
+                functools.partial(
+                        _pool_invoke, self._module_args,
+                        self.stats is not None, name, args, kwargs))
+        return trollius.ensure_future(
+                self._complete_pool_call(future, local_reply, blocking),
+                loop=self.loop)
+
+    def submit(self, name, args, kwargs):
+        # Returns future or None if call should be executed synchronously.
+        if not self._is_blocking(name, args):
+            return None
+
+        if self._executor_type == _EXECUTOR_PROCESS:
+            return self._submit_to_process_pool(name, args, kwargs)
+        fn = functools.partial(rpc.invoke, self.target, name, args, kwargs)
+        return self.loop.run_in_executor(self._get_executor(), fn)
+
+    def submit_collector(self, name):
+        if self._executor_type == _EXECUTOR_PROCESS:
+            fn = functools.partial(_pool_collect, self._module_args, name)
+        else:
+            fn = functools.partial(self.target.run_collector, name)
+        return self.loop.run_in_executor(self._get_executor(), fn)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class _Collector(object):
+    def __init__(self, dispatcher, name, interval, jitter, blocking):
+        self._dispatcher = dispatcher
+        self._name = name
+        self._interval = interval
+        self._jitter = jitter
+        if blocking is None:
+            blocking = dispatcher.is_default_blocking()
+        self._blocking = blocking
+
+        self._task = None
+
+        self._runs = 0
+        self._failures = 0
+        self._overruns = 0
+        self._skipped = 0
+        self._last_duration = None
+
+    def get_stats(self):
+        return {
+            'runs': self._runs,
+            'failures': self._failures,
+            'overruns': self._overruns,
+            'skipped': self._skipped,
+            'last_duration': self._last_duration,
+        }
+
+    @trollius.coroutine
+    def _collect(self):
+        dispatcher = self._dispatcher
+        if self._blocking:
+            result = yield trollius.From(
+                    dispatcher.submit_collector(self._name))
+        else:
+            result = dispatcher.target.run_collector(self._name)
+            if trollius.iscoroutine(result):
+                result = yield trollius.From(result)
+        dispatcher.target.on_collector_result(self._name, result)
+
+    @trollius.coroutine
+    def _run(self):
+        loop = self._dispatcher.loop
+        interval = self._interval
+
+        slot_time = loop.time()
+        while True:
+            delay = slot_time + random.uniform(0, self._jitter) - loop.time()
+            if delay > 0:
+                yield trollius.From(trollius.sleep(delay, loop=loop))
+
+            start_time = loop.time()
+            try:
+                yield trollius.From(self._collect())
+            except trollius.CancelledError:
+                raise
+            except Exception:
+                _log.exception('Collector "%s" failed', self._name)
+                self._failures += 1
+            cur_time = loop.time()
+            self._runs += 1
+            self._last_duration = cur_time - start_time
+
+            slot_time += interval
+            if cur_time > slot_time:
+                skipped = int((cur_time - slot_time) // interval) + 1
+                self._overruns += 1
+                self._skipped += skipped
+                slot_time += skipped * interval
+                _log.warning(
+                        'Collector "%s" overran its interval (%s seconds), '
+                        'skipping %d run(s), last run took %.3f seconds',
+                        self._name, interval, skipped, self._last_duration)
+
+    def start(self):
+        _log.info('Starting collector "%s" with interval %s seconds%s',
+                  self._name, self._interval,
+                  ' in worker pool' if self._blocking else '')
+        self._task = trollius.ensure_future(
+                self._run(), loop=self._dispatcher.loop)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        _log.info('Collector "%s" stopped: %r', self._name, self.get_stats())
+
+
+class _ModuleRpcServer(rpc.Server):
+    def __init__(self, stream, dispatcher):
+        super(_ModuleRpcServer, self).__init__(stream, dispatcher.target)
+        self._dispatcher = dispatcher
+
+    def _on_call_done(self, call, call_id, binary, deadline, deadline_handle,
+                      future):
+        if deadline_handle is not None:
+            deadline_handle.cancel()
+
+        if future.cancelled():
+            # Item executed by worker thread is still running, but its
+            # result will be ignored.
+            _log.warning('RPC call %r cancelled after deadline', call)
+            reply = rpc.get_deadline_reply()
+        else:
+            try:
+                reply = future.result()
+            except BaseException as exc:
+                _log.exception('Asynchronous RPC call %r failed', call)
+                reply = {
+                    'error': '%r' % exc,
+                }
+        self._reply_or_wait(call, call_id, binary, deadline, reply)
+
+    def _wait(self, call, call_id, binary, deadline, future):
+        deadline_handle = None
+        if deadline is not None:
+            deadline_handle = self._dispatcher.loop.call_later(
+                    max(deadline - time.time(), 0), future.cancel)
+        future.add_done_callback(functools.partial(
+                self._on_call_done, call, call_id, binary, deadline,
+                deadline_handle))
+
+    def _reply_or_wait(self, call, call_id, binary, deadline, reply):
+        if _is_pending(reply):
+            # Coroutine item, reply will be sent when task completes.
+            self._wait(call, call_id, binary, deadline, trollius.ensure_future(
+                    _complete_reply(reply), loop=self._dispatcher.loop))
+        else:
+            self._reply_send(call_id, binary, reply)
+
+    def _builtin_ping(self):
+        return self._dispatcher.load
+
+    def _remote_call(self, name, args, kwargs, call_id=None, binary=False,
+                     deadline=None):
+        if name != rpc.PING:
+            self._dispatcher.load['calls'] += 1
+        call = (name, args, kwargs)
+        future = self._dispatcher.submit(name, args, kwargs)
+        if future is None:
+            self._reply_or_wait(call, call_id, binary, deadline,
+                                self._invoke(name, args, kwargs))
+        else:
+            self._wait(call, call_id, binary, deadline, future)
+
 
 class _ModuleServer(trollius.BaseProtocol):
-    def __init__(self, target):
+    def __init__(self, dispatcher):
         super(_ModuleServer, self).__init__()
-        self._rpc = rpc.Server(self, target)
+        self._rpc = _ModuleRpcServer(self, dispatcher)
+        self._stats = dispatcher.stats
+        self._load = dispatcher.load
+        self._transport = None
 
     def connection_made(self, transport):
         _log.info('New connection accepted')
+        self._load['connections'] += 1
         self._transport = transport
 
+    def connection_lost(self, exc):
+        _log.info('Connection lost')
+        self._transport = None
+
     def data_received(self, data):
-        self._rpc.on_raw_recv(data)
+        if self._stats is not None:
+            self._stats.rpc_bytes_in += len(data)
+        try:
+            self._rpc.on_raw_recv(data)
+        except:
+            _log.exception('Unable to process received data, closing '
+                           'connection')
+            self._transport.close()
 
     def raw_send_all(self, data):
+        if self._transport is None:
+            _log.warning('Connection closed, dropping RPC answer')
+            return
+
+        if self._stats is not None:
+            self._stats.rpc_bytes_out += len(data)
         try:
             self._transport.write(data)
         except:
@@ -57,6 +442,12 @@ def _get_default_loader_conf(module_name):
         'log_file': os.path.join('/', 'var', 'log', 'python-zabbix-modules',
                                  'module.%s.log' % module_name),
         'log_level': 'info',
+        'log_queue': {},
+        'executor': _EXECUTOR_NONE,
+        'executor_workers': 4,
+        'internal_items': True,
+        'stats_window': 60.0,
+        'value_plane_slots': 4096,
     }
 
 
@@ -65,18 +456,36 @@ def _stop(sig_num, loop):
     loop.stop()
 
 
-def _main(namespace, module_type, module_name, module_conf):
-    setproctitle.setproctitle(
-            'python-zabbix-modules: Module %s/%s' % (module_type, module_name))
+def _create_servers(loop, server_factory, socket_path, worker_n, listen_fd):
+    if listen_fd is None:
+        loop.run_until_complete(
+                loop.create_unix_server(server_factory, socket_path))
+        # Access to sockets will be restricted on directory level.
+        os.chmod(socket_path, 0o666)
+        return
+
+    # Socket of module is bound by manager and shared by all workers. Each
+    # worker also listens on its own socket, so manager could probe it.
+    listen_sock = socket.fromfd(listen_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(listen_fd)
+    loop.run_until_complete(
+            loop.create_unix_server(server_factory, sock=listen_sock))
+    loop.run_until_complete(loop.create_unix_server(
+            server_factory,
+            modules.get_worker_sock_path(socket_path, worker_n)))
+
+
+def _main(namespace, module_type, module_name, module_conf, loader_conf,
+          worker_n=0, listen_fd=None):
+    title = 'python-zabbix-modules: Module %s/%s' % (module_type, module_name)
+    if listen_fd is not None:
+        title += ' (worker %d)' % worker_n
+    setproctitle.setproctitle(title)
 
     _log.info('Loading module "%s"...', module_name)
 
-    manager = stevedore.DriverManager(
-            namespace, module_name, True,
-            invoke_kwds=dict(
-                    module_type=module_type,
-                    module_name=module_name,
-                    module_conf=module_conf))
+    module_args = (namespace, module_type, module_name, module_conf)
+    manager = _load_module(*module_args)
 
     _log.info('Module "%s" loaded successfully, running...', module_name)
 
@@ -86,23 +495,65 @@ def _main(namespace, module_type, module_name, module_conf):
         for sig_num in signal.SIGINT, signal.SIGTERM:
             loop.add_signal_handler(sig_num, lambda: _stop(sig_num, loop))
 
-        socket_path = modules.get_sock_path(_conf, module_type, module_name)
-        module_coroutine = loop.create_unix_server(
-                functools.partial(_ModuleServer, manager.driver), socket_path)
-        loop.run_until_complete(module_coroutine)
-        # Access to sockets will be restricted on directory level.
-        os.chmod(socket_path, 0o666)
-
+        target = manager.driver
+        item_stats = None
+        if loader_conf['internal_items']:
+            item_stats = stats.Stats(loader_conf['stats_window'])
+            target.item_stats = item_stats
+            target = stats.InternalItems(
+                    target, item_stats, _INTERNAL_ITEMS_PREFIX % module_name)
+
+        dispatcher = _Dispatcher(loop, target, module_args, loader_conf,
+                                 item_stats)
+        collectors = [
+            _Collector(dispatcher, collector['name'], collector['interval'],
+                       collector['jitter'], collector['blocking'])
+            for collector in manager.driver.get_collectors()]
+
+        _create_servers(
+                loop, functools.partial(_ModuleServer, dispatcher),
+                modules.get_sock_path(_conf, module_type, module_name),
+                worker_n, listen_fd)
+        # Let agent processes connect without waiting for backoff.
+        breaker_state_path = modules.get_breaker_state_path(
+                _conf, module_type, module_name)
+        try:
+            os.unlink(breaker_state_path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                _log.warning('Unable to remove circuit breaker state "%s": %r',
+                             breaker_state_path, exc)
+
+        value_plane = None
+        # Only one of workers owns shared memory file.
+        if (loader_conf['value_plane_slots'] > 0) and (worker_n == 0):
+            value_plane = valueplane.Writer(
+                    modules.get_value_plane_path(
+                            _conf, module_type, module_name),
+                    loader_conf['value_plane_slots'])
+            manager.driver.set_value_sink(value_plane)
+
+        for collector in collectors:
+            collector.start()
         try:
             loop.run_forever()
         finally:
+            for collector in collectors:
+                collector.stop()
+            dispatcher.shutdown()
             loop.close()
+            if value_plane is not None:
+                manager.driver.set_value_sink(None)
+                value_plane.close()
     finally:
         manager.driver.on_module_terminate()
 
 
 def main():
     namespace, module_type, module_name = sys.argv[1:4]
+    # Worker number and descriptor of listening socket, when started by
+    # manager as one of several workers.
+    worker_args = tuple(map(int, sys.argv[4:6]))
 
     configuration.load_global(module_type)
 
@@ -114,14 +565,15 @@ def main():
 
     global _log
     _log = logging.configure_file_logger(
-            loader_conf['log_file'], loader_conf['log_level'])
+            loader_conf['log_file'], loader_conf['log_level'],
+            loader_conf['log_queue'])
 
     _log.info('Global configuration file: "%s"', configuration.CONF_FILE_PATH)
     _log.info('Module configuration file: "%s"', module_conf_path)
 
     try:
         _main(namespace, module_type, module_name,
-              module_conf.get('module', {}))
+              module_conf.get('module', {}), loader_conf, *worker_args)
     except KeyboardInterrupt:
         _log.info('Exiting after keyboard interrupt')
     except:
@@ -1,9 +1,175 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import threading
+import time
 
+import six.moves.queue as queue
 
-def _configure_logger(**kwargs):
+
+_DEFAULT_QUEUE_CONF = {
+    'enabled': False,
+    # Maximum number of records waiting for writer thread.
+    'size': 4096,
+    # Records per second, with bursts of given size.
+    'rate_limit': 100.0,
+    'burst': 1000,
+    # Identical messages are written once per interval, seconds.
+    'dedup_interval': 60.0,
+}
+
+# Deduplication state is pruned when it grows larger than this.
+_MAX_RECENT = 1024
+
+_queue_handler = None
+
+
+class _QueueHandler(logging.Handler):
+    """
+    Puts records into queue, from which they are written to target handler
+    by background thread, so logging thread never waits for disk. Records
+    are dropped when queue is full or rate limit is exceeded, repeated
+    messages are suppressed.
+    """
+
+    def __init__(self, target, size, rate_limit, burst, dedup_interval):
+        logging.Handler.__init__(self)
+
+        self._target = target
+        self._size = size
+        self._rate_limit = rate_limit
+        self._burst = burst
+        self._dedup_interval = dedup_interval
+
+        self._tokens = burst
+        self._tokens_time = time.time()
+        # (level, message, exception type) -> [time when written,
+        #                                      number of suppressed]
+        self._recent = {}
+
+        self.stats = {
+            'written': 0,
+            'dropped_queue_full': 0,
+            'dropped_rate_limit': 0,
+            'suppressed': 0,
+        }
+
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self._size)
+        self._thread = threading.Thread(
+                target=self._write, args=(self._queue, ),
+                name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_dropped(self):
+        return self.stats['dropped_queue_full'] + \
+            self.stats['dropped_rate_limit']
+
+    def _write(self, record_queue):
+        reported_dropped = 0
+        while True:
+            record = record_queue.get()
+            if record is None:
+                break
+            self._target.handle(record)
+            self.stats['written'] += 1
+
+            dropped = self._get_dropped()
+            if dropped != reported_dropped:
+                self._target.handle(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': logging.getLevelName(logging.WARNING),
+                    'msg': '%u log messages dropped (%r)',
+                    'args': (dropped - reported_dropped, self.stats),
+                }))
+                reported_dropped = dropped
+
+    def _take_token(self, cur_time):
+        self._tokens = min(
+                self._burst,
+                self._tokens +
+                (cur_time - self._tokens_time) * self._rate_limit)
+        self._tokens_time = cur_time
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    def _prune_recent(self, cur_time):
+        self._recent = dict(
+                (dedup_key, recent)
+                for dedup_key, recent in self._recent.items()
+                if cur_time - recent[0] < self._dedup_interval)
+        if len(self._recent) >= _MAX_RECENT:
+            self._recent.clear()
+
+    def _after_fork(self):
+        # Writer thread does not survive fork, and locks it or other threads
+        # held at the moment of fork stay held forever in child.
+        self.createLock()
+        self._target.createLock()
+        self._start()
+
+    def handle(self, record):
+        # Checked before Handler.handle() takes lock of this handler.
+        if os.getpid() != self._pid:
+            self._after_fork()
+        return logging.Handler.handle(self, record)
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except:
+            self.handleError(record)
+            return
+
+        cur_time = time.time()
+        dedup_key = (record.levelno, message,
+                     record.exc_info[0] if record.exc_info else None)
+        recent = self._recent.get(dedup_key)
+        if (recent is not None) and \
+                (cur_time - recent[0] < self._dedup_interval):
+            recent[1] += 1
+            self.stats['suppressed'] += 1
+            return
+
+        if not self._take_token(cur_time):
+            self.stats['dropped_rate_limit'] += 1
+            return
+
+        if recent is not None and recent[1]:
+            message = '%s [%u similar messages suppressed]' % (
+                    message, recent[1])
+        if len(self._recent) >= _MAX_RECENT:
+            self._prune_recent(cur_time)
+        self._recent[dedup_key] = [cur_time, 0]
+
+        # Traceback is formatted by writer thread.
+        record.msg = message
+        record.args = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.stats['dropped_queue_full'] += 1
+
+    def close(self):
+        if os.getpid() == self._pid:
+            try:
+                self._queue.put(None, timeout=1.0)
+                self._thread.join(1.0)
+            except queue.Full:
+                pass
+        self._target.close()
+        logging.Handler.close(self)
+
+
+def _configure_logger(log_queue, **kwargs):
     root_logger = logging.getLogger()
     list(map(root_logger.removeHandler, root_logger.handlers[:]))
     list(map(root_logger.removeFilter, root_logger.filters[:]))
@@ -11,6 +177,15 @@ def _configure_logger(**kwargs):
         format=' %(levelname).1s|%(asctime)s|%(process)d:%(thread)d| '
                '%(message)s',
         **kwargs)
+
+    global _queue_handler
+    _queue_handler = None
+    queue_conf = dict(_DEFAULT_QUEUE_CONF, **(log_queue or {}))
+    if queue_conf.pop('enabled'):
+        target, = root_logger.handlers
+        root_logger.removeHandler(target)
+        _queue_handler = _QueueHandler(target, **queue_conf)
+        root_logger.addHandler(_queue_handler)
     return logging.getLogger()
 
 
@@ -24,7 +199,17 @@ def _get_log_level(level_str):
     }[level_str.upper()[0]]
 
 
-def configure_file_logger(log_file_path, level_str):
+def configure_file_logger(log_file_path, level_str, log_queue=None):
     return _configure_logger(
+        log_queue,
         filename=log_file_path,
         level=_get_log_level(level_str))
+
+
+def get_stats():
+    """
+    Returns counters of queued logging or None if it is disabled.
+    """
+    if _queue_handler is None:
+        return None
+    return dict(_queue_handler.stats)
@@ -2,18 +2,21 @@
 
 from __future__ import absolute_import
 
+import collections
 import grp
 import functools
 import json
 import os
 import os.path
 import pwd
+import random
 import signal
+import socket
 import subprocess
 import sys
 import time
-import weakref
 
+import six
 import yaml
 
 import trollius
@@ -21,16 +24,31 @@ import trollius
 import zabbix_modules.configuration as configuration
 import zabbix_modules.logging as logging
 import zabbix_modules.modules as modules
+import zabbix_modules.rpc as rpc
 
 
 _DEFAULT_CONF = {
     'log_file': os.path.join('/', 'var', 'log', 'python-zabbix-modules',
                              'manager.log'),
     'log_level': 'info',
+    'log_queue': {},
     'python_interpreters_dir': os.path.join('/', 'etc',
                                             'python-zabbix-modules',
                                             'interpreters'),
+    'discovery_cache_file': os.path.join('/', 'var', 'cache',
+                                         'python-zabbix-modules',
+                                         'discovery.json'),
     'credentials': {},
+    'restart_backoff_min': 1.0,
+    'restart_backoff_max': 60.0,
+    'restart_reset_time': 60.0,
+    'restart_limit_count': 10,
+    'restart_limit_interval': 600.0,
+    'kill_timeout': 5.0,
+    'probe_interval': 10.0,
+    'probe_timeout': 5.0,
+    'probe_max_misses': 3,
+    'status_file': None,
 }
 
 _CONF_FILE_PATHS = (
@@ -47,7 +65,19 @@ _MODULES_LOADER = 'zabbix_modules.loader'
 
 _MODULE_TYPES = ('agent', 'agentd', 'server')
 
-_MODULE_RESTART_SLEEP = 5.0  # seconds
+# Random part of restart delay, fraction of backoff time.
+_RESTART_JITTER = 0.2
+# Restart delay stops doubling after this number of crashes, long before it
+# could overflow.
+_MAX_RESTART_EXPONENT = 32
+
+# Backlog of socket shared by workers of module.
+_LISTEN_BACKLOG = 100
+
+_CHILD_STARTING = 'starting'
+_CHILD_RUNNING = 'running'
+_CHILD_WAITING = 'waiting'
+_CHILD_STOPPED = 'stopped'
 
 
 _conf = _DEFAULT_CONF
@@ -64,34 +94,134 @@ def _find_interpreters():
     return interpreters
 
 
-def _find_modules(interpreter):
+def _get_interpreter_path(interpreter):
+    return os.path.join(_conf['python_interpreters_dir'], interpreter)
+
+
+def _start_finder(interpreter):
     _log.info('Looking for installed modules using interpreter %s...',
               interpreter)
 
-    proc = subprocess.Popen(
+    return subprocess.Popen(
             (
-                os.path.join(_conf['python_interpreters_dir'], interpreter),
+                _get_interpreter_path(interpreter),
                 '-m', _MODULES_FINDER,
                 _NAMESPACE
             ),
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _wait_finder(proc):
     stdout, _ = proc.communicate()
     if proc.returncode:
         raise RuntimeError(
                 '"%s" exited with code %d' % (_MODULES_FINDER, proc.returncode))
 
-    installed_modules = json.loads(stdout.decode())
-    _log.info('%u installed modules found:', len(installed_modules))
-    for installed_module in installed_modules:
-        _log.info('"%s" (%s)', installed_module, interpreter)
+    found = json.loads(stdout.decode())
+    if isinstance(found, list):
+        # Finder from older version.
+        return found, None
+    return found['modules'], found['paths']
+
+
+def _get_path_mtimes(paths):
+    return dict((path, os.stat(path).st_mtime) for path in paths)
+
+
+def _get_discovery_cache_entry(interpreter, installed_modules, paths):
+    real_path = os.path.realpath(_get_interpreter_path(interpreter))
+    return {
+        'real_path': real_path,
+        'mtime': os.stat(real_path).st_mtime,
+        'path_mtimes': _get_path_mtimes(paths),
+        'modules': installed_modules,
+    }
 
-    return installed_modules
+
+def _get_cached_modules(discovery_cache, interpreter):
+    cache_entry = discovery_cache.get(interpreter)
+    if cache_entry is None:
+        return None
+
+    try:
+        if cache_entry != _get_discovery_cache_entry(
+                interpreter, cache_entry['modules'],
+                cache_entry['path_mtimes']):
+            return None
+    except (OSError, KeyError):
+        return None
+    return cache_entry['modules']
+
+
+def _load_discovery_cache():
+    try:
+        with open(_conf['discovery_cache_file']) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError) as exc:
+        _log.info('Discovery cache is not available: %r', exc)
+        return {}
+
+
+def _save_discovery_cache(discovery_cache):
+    cache_file_path = _conf['discovery_cache_file']
+    try:
+        cache_dir = os.path.dirname(cache_file_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        modules.write_file_atomically(
+                cache_file_path, json.dumps(discovery_cache))
+    except (IOError, OSError) as exc:
+        _log.warning('Unable to save discovery cache to "%s": %r',
+                     cache_file_path, exc)
+
+
+def _find_modules(interpreters):
+    discovery_cache = _load_discovery_cache()
+
+    interpreter_modules = {}
+    procs = []
+    for interpreter in interpreters:
+        installed_modules = _get_cached_modules(discovery_cache, interpreter)
+        if installed_modules is None:
+            # All finders are running concurrently.
+            procs.append((interpreter, _start_finder(interpreter)))
+        else:
+            _log.info('Using cached list of installed modules for '
+                      'interpreter %s', interpreter)
+            interpreter_modules[interpreter] = installed_modules
+
+    for interpreter, proc in procs:
+        installed_modules, paths = _wait_finder(proc)
+        interpreter_modules[interpreter] = installed_modules
+        if paths is None:
+            discovery_cache.pop(interpreter, None)
+        else:
+            discovery_cache[interpreter] = _get_discovery_cache_entry(
+                    interpreter, installed_modules, paths)
+
+    if procs:
+        _save_discovery_cache(dict(
+                (interpreter, cache_entry)
+                for interpreter, cache_entry in discovery_cache.items()
+                if interpreter in interpreter_modules))
+
+    for interpreter in interpreters:
+        installed_modules = interpreter_modules[interpreter]
+        _log.info('%u installed modules found using interpreter %s:',
+                  len(installed_modules), interpreter)
+        for installed_module in installed_modules:
+            _log.info('"%s" (%s)', installed_module, interpreter)
+
+    return interpreter_modules
 
 
 def _find_module_interpreters():
+    interpreters = _find_interpreters()
+    interpreter_modules = _find_modules(interpreters)
+
     module_interpreters = {}
-    for interpreter in _find_interpreters():
-        for installed_module in _find_modules(interpreter):
+    for interpreter in interpreters:
+        for installed_module in interpreter_modules[interpreter]:
             if installed_module in module_interpreters:
                 _log.warning('Skipping duplicate module with different '
                              'interpreter: "%s" (%s)',
@@ -160,13 +290,17 @@ def _find_enabled_modules(module_type):
             for module_name in modules.find_enabled(conf)]
 
 
-def _get_module_runas(module_type, module_conf_path):
+def _get_module_manager_conf(module_type, module_conf_path):
     with open(module_conf_path) as conf_file:
         module_conf = yaml.safe_load(conf_file) or {}
     module_manager_conf = module_conf.get('manager', {})
     module_runas = module_manager_conf.get('runas', {})
     _normalize_credentials(module_type, module_runas)
-    return module_runas
+    module_workers = module_manager_conf.get('workers', 1)
+    if module_workers < 1:
+        raise RuntimeError('Invalid number of workers in "%s": %r' % (
+            module_conf_path, module_workers))
+    return module_runas, module_workers
 
 
 def _find_all_enabled_modules():
@@ -177,38 +311,416 @@ def _find_all_enabled_modules():
                      module_type,
                      module_name,
                      module_socket_path,
-                     _get_module_runas(module_type, module_conf_path),
-                 )
+                 ) + _get_module_manager_conf(module_type, module_conf_path)
                  for module_name, module_socket_path, module_conf_path
                  in _find_enabled_modules(module_type)])
 
     return enabled_modules
 
 
+@trollius.coroutine
+def _ping(reader, writer):
+    writer.write(rpc.get_call_frame(rpc.PING))
+    header = yield trollius.From(reader.readexactly(rpc.FRAME_HEADER_SIZE))
+    # Any reply (even error from older loader) means that event loop of
+    # module is not stuck.
+    packet = yield trollius.From(reader.readexactly(
+            rpc.get_frame_length(header)))
+
+    # Newer loaders reply with their load.
+    try:
+        load = json.loads(packet.decode()).get('result')
+    except ValueError:
+        load = None
+    raise trollius.Return(load if isinstance(load, dict) else None)
+
+
 class _ModuleProcess(trollius.SubprocessProtocol):
-    def __init__(self, loop, module_type, module_name, module_interpreter,
-                 module_socket_path, module_runas):
+    def __init__(self, child):
         super(_ModuleProcess, self).__init__()
 
-        self._loop = weakref.ref(loop)
+        self._child = child
+
+    def connection_made(self, transport):
+        self._child.on_started(transport)
+
+    def process_exited(self):
+        self._child.on_exited()
+
+
+class _ModuleChild(object):
+    def __init__(self, supervisor, module_type, module_name,
+                 module_interpreter, module_socket_path, module_runas,
+                 worker_n=None, listen_sock=None):
+        self._supervisor = supervisor
         self._module_type = module_type
         self._module_name = module_name
         self._module_interpreter = module_interpreter
-        self._module_socket_path = module_socket_path
         self._module_runas = module_runas
+        self._worker_n = worker_n
+        self._listen_sock = listen_sock
 
-    def process_exited(self):
-        _log.error('Plugin "%s/%s" (%s) exited, restarting...',
-                   self._module_type, self._module_name,
-                   self._module_interpreter)
-        # TODO: Asynchronous sleep.
-        time.sleep(_MODULE_RESTART_SLEEP)
-        _spawn_process(self._loop(),
-                       self._module_type,
-                       self._module_name,
-                       self._module_interpreter,
-                       self._module_socket_path,
-                       self._module_runas)
+        self.name = '%s/%s' % (module_type, module_name)
+        # Socket which is probed and removed before start.
+        self._module_socket_path = module_socket_path
+        if listen_sock is not None:
+            self.name += '[%d]' % worker_n
+            self._module_socket_path = modules.get_worker_sock_path(
+                    module_socket_path, worker_n)
+
+        self._state = _CHILD_STOPPED
+        self._transport = None
+        self._start_time = None
+        self._probe_task = None
+        # Connection is kept between probes, so they do not show up as new
+        # connections in log and load of module.
+        self._probe_stream = None
+        self._restart_handle = None
+        self._next_start_time = None
+        self._start_times = collections.deque(
+                maxlen=_conf['restart_limit_count'])
+
+        self._starts = 0
+        self._crashes = 0
+        self._consecutive_crashes = 0
+        self._throttled = 0
+        self._last_exit_code = None
+
+        self._probes = 0
+        self._probe_misses = 0
+        self._probe_failures = 0
+        self._probe_latency = None
+        self._probe_latency_max = None
+        self._probe_load = None
+        self._hangs = 0
+
+    def is_alive(self):
+        return self._transport is not None
+
+    def get_state(self):
+        return {
+            'state': self._state,
+            'interpreter': self._module_interpreter,
+            'pid': None if self._transport is None
+                   else self._transport.get_pid(),
+            'starts': self._starts,
+            'crashes': self._crashes,
+            'consecutive_crashes': self._consecutive_crashes,
+            'throttled_restarts': self._throttled,
+            'last_exit_code': self._last_exit_code,
+            'next_start_time': self._next_start_time,
+            'probes': self._probes,
+            'probe_failures': self._probe_failures,
+            'probe_latency': self._probe_latency,
+            'probe_latency_max': self._probe_latency_max,
+            'hangs': self._hangs,
+            'worker': self._worker_n,
+            'load': self._probe_load,
+        }
+
+    def _set_state(self, state):
+        self._state = state
+        self._supervisor.on_state_changed()
+
+    def start(self):
+        loop = self._supervisor.loop
+
+        self._restart_handle = None
+        self._next_start_time = None
+
+        user_id = self._module_runas.get('user_id', -1)
+        group_id = self._module_runas.get('group_id', -1)
+
+        if ((user_id != -1) or (group_id != -1)) and (os.getuid() != 0):
+            raise RuntimeError('"runas" only available for root')
+
+        _log.info('Starting module "%s" (%s) as %d:%d',
+                  self.name, self._module_interpreter, user_id, group_id)
+
+        if os.path.exists(self._module_socket_path):
+            os.unlink(self._module_socket_path)
+
+        self._starts += 1
+        self._start_time = loop.time()
+        self._start_times.append(self._start_time)
+        self._set_state(_CHILD_STARTING)
+
+        args = ['-m', _MODULES_LOADER,
+                _NAMESPACE, self._module_type, self._module_name]
+        kwargs = {}
+        if self._listen_sock is not None:
+            listen_fd = self._listen_sock.fileno()
+            args.extend((str(self._worker_n), str(listen_fd)))
+            if six.PY3:
+                kwargs['pass_fds'] = (listen_fd, )
+            else:
+                kwargs['close_fds'] = False
+
+        process = loop.subprocess_exec(
+                functools.partial(_ModuleProcess, self),
+                os.path.join(_conf['python_interpreters_dir'],
+                             self._module_interpreter),
+                *args,
+                stdin=None, stdout=None, stderr=None,
+                preexec_fn=functools.partial(_runas, user_id, group_id),
+                **kwargs)
+        trollius.ensure_future(process, loop=loop).add_done_callback(
+                self._on_spawned)
+
+    def _on_spawned(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            _log.error('Unable to start module "%s": %r', self.name, exc)
+            self._on_crash(None)
+
+    def on_started(self, transport):
+        self._transport = transport
+        _log.info('Module "%s" started, PID %d', self.name,
+                  transport.get_pid())
+        self._set_state(_CHILD_RUNNING)
+        if self._supervisor.stopping:
+            self.send_signal(signal.SIGTERM)
+        elif _conf['probe_interval']:
+            self._probe_misses = 0
+            self._probe_task = trollius.ensure_future(
+                    self._probe(), loop=self._supervisor.loop)
+
+    def _close_probe_stream(self):
+        if self._probe_stream is not None:
+            self._probe_stream[1].close()
+            self._probe_stream = None
+
+    def _stop_probe(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        self._close_probe_stream()
+
+    @trollius.coroutine
+    def _ping(self):
+        if self._probe_stream is None:
+            self._probe_stream = yield trollius.From(
+                    trollius.open_unix_connection(
+                            self._module_socket_path,
+                            loop=self._supervisor.loop))
+        load = yield trollius.From(_ping(*self._probe_stream))
+        raise trollius.Return(load)
+
+    def _on_probe_success(self, latency, load):
+        self._probes += 1
+        self._probe_misses = 0
+        self._probe_latency = latency
+        self._probe_load = load
+        if (self._probe_latency_max is None) or \
+                (latency > self._probe_latency_max):
+            self._probe_latency_max = latency
+        _log.debug('Module "%s" answered probe in %.6f seconds',
+                   self.name, latency)
+        self._supervisor.on_state_changed()
+
+    def _on_probe_failure(self, exc):
+        self._probe_misses += 1
+        self._probe_failures += 1
+        _log.warning('Module "%s" did not answer probe (%d of %d): %r',
+                     self.name, self._probe_misses,
+                     _conf['probe_max_misses'], exc)
+        self._supervisor.on_state_changed()
+        if self._probe_misses < _conf['probe_max_misses']:
+            return True
+
+        # Event loop is probably stuck, so SIGTERM will not be handled.
+        _log.error('Module "%s" seems to be hung, killing', self.name)
+        self._hangs += 1
+        self.send_signal(signal.SIGKILL)
+        return False
+
+    @trollius.coroutine
+    def _probe(self):
+        loop = self._supervisor.loop
+        while True:
+            yield trollius.From(trollius.sleep(
+                    _conf['probe_interval'], loop=loop))
+
+            start_time = loop.time()
+            try:
+                load = yield trollius.From(trollius.wait_for(
+                        self._ping(), _conf['probe_timeout'], loop=loop))
+            except trollius.CancelledError:
+                raise
+            except Exception as exc:
+                # Late reply must not be taken for reply to next probe.
+                self._close_probe_stream()
+                if not self._on_probe_failure(exc):
+                    return
+            else:
+                self._on_probe_success(loop.time() - start_time, load)
+
+    def on_exited(self):
+        self._stop_probe()
+        exit_code = self._transport.get_returncode()
+        self._transport.close()
+        self._transport = None
+
+        if self._supervisor.stopping:
+            _log.info('Module "%s" exited with code %r', self.name, exit_code)
+            self._set_state(_CHILD_STOPPED)
+        else:
+            self._on_crash(exit_code)
+
+    def _get_restart_delay(self, cur_time):
+        delay = min(_conf['restart_backoff_max'],
+                    _conf['restart_backoff_min'] *
+                    2 ** min(self._consecutive_crashes - 1,
+                             _MAX_RESTART_EXPONENT))
+        delay += random.uniform(0, delay * _RESTART_JITTER)
+
+        limit_interval = _conf['restart_limit_interval']
+        # Zero "restart_limit_count" disables limit.
+        if self._start_times.maxlen and \
+                (len(self._start_times) == self._start_times.maxlen) and \
+                (self._start_times[0] + limit_interval > cur_time + delay):
+            self._throttled += 1
+            delay = self._start_times[0] + limit_interval - cur_time
+            _log.warning('Module "%s" started %d times in %s seconds, '
+                         'throttling restarts', self.name,
+                         len(self._start_times), limit_interval)
+        return delay
+
+    def _on_crash(self, exit_code):
+        loop = self._supervisor.loop
+        cur_time = loop.time()
+
+        self._crashes += 1
+        self._last_exit_code = exit_code
+        if cur_time - self._start_time >= _conf['restart_reset_time']:
+            self._consecutive_crashes = 0
+        self._consecutive_crashes += 1
+
+        delay = self._get_restart_delay(cur_time)
+        _log.error('Module "%s" (%s) exited with code %r, restarting in '
+                   '%.1f seconds...', self.name, self._module_interpreter,
+                   exit_code, delay)
+        self._next_start_time = time.time() + delay
+        self._restart_handle = loop.call_later(delay, self._restart)
+        self._set_state(_CHILD_WAITING)
+
+    def _restart(self):
+        try:
+            self.start()
+        except:
+            _log.exception('Unable to restart module "%s"', self.name)
+            self._on_crash(None)
+
+    def stop(self):
+        self._stop_probe()
+        if self._restart_handle is not None:
+            self._restart_handle.cancel()
+            self._restart_handle = None
+            self._next_start_time = None
+            self._set_state(_CHILD_STOPPED)
+        self.send_signal(signal.SIGTERM)
+
+    def send_signal(self, sig_num):
+        if self._transport is None:
+            return
+        try:
+            self._transport.send_signal(sig_num)
+        except OSError as exc:
+            _log.warning('Unable to send signal %d to module "%s": %r',
+                         sig_num, self.name, exc)
+
+
+class _Supervisor(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.stopping = False
+
+        self._children = []
+        self._listen_socks = []
+
+    @staticmethod
+    def _bind(socket_path):
+        # Socket shared by workers stays open when they are restarted.
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listen_sock.bind(socket_path)
+            listen_sock.listen(_LISTEN_BACKLOG)
+            # Access to sockets will be restricted on directory level.
+            os.chmod(socket_path, 0o666)
+        except:
+            listen_sock.close()
+            raise
+        return listen_sock
+
+    def start(self, module_type, module_name, module_interpreter,
+              module_socket_path, module_runas, module_workers=1):
+        if module_workers == 1:
+            workers = [(None, None)]
+        else:
+            listen_sock = self._bind(module_socket_path)
+            self._listen_socks.append(listen_sock)
+            _log.info('Starting %d workers of module "%s/%s" sharing socket '
+                      '"%s"', module_workers, module_type, module_name,
+                      module_socket_path)
+            workers = [(worker_n, listen_sock)
+                       for worker_n in range(module_workers)]
+
+        for worker_n, listen_sock in workers:
+            child = _ModuleChild(self, module_type, module_name,
+                                 module_interpreter, module_socket_path,
+                                 module_runas, worker_n, listen_sock)
+            self._children.append(child)
+            child.start()
+
+    def get_state(self):
+        return dict((child.name, child.get_state())
+                    for child in self._children)
+
+    def log_state(self):
+        for child in self._children:
+            _log.info('Module "%s": %r', child.name, child.get_state())
+
+    def on_state_changed(self):
+        status_file_path = _conf['status_file']
+        if status_file_path is None:
+            return
+        try:
+            modules.write_file_atomically(
+                    status_file_path, json.dumps(self.get_state()))
+        except (IOError, OSError) as exc:
+            _log.warning('Unable to write status file "%s": %r',
+                         status_file_path, exc)
+
+    def _get_alive(self):
+        return [child for child in self._children if child.is_alive()]
+
+    @trollius.coroutine
+    def _wait(self, timeout):
+        deadline = self.loop.time() + timeout
+        while self._get_alive() and (self.loop.time() < deadline):
+            yield trollius.From(trollius.sleep(0.1, loop=self.loop))
+
+    @trollius.coroutine
+    def shutdown(self):
+        self.stopping = True
+
+        _log.info('Stopping %u modules...', len(self._get_alive()))
+        for child in self._children:
+            child.stop()
+        yield trollius.From(self._wait(_conf['kill_timeout']))
+
+        for child in self._get_alive():
+            _log.warning('Module "%s" did not exit in time, killing',
+                         child.name)
+            child.send_signal(signal.SIGKILL)
+        yield trollius.From(self._wait(_conf['kill_timeout']))
+
+        for listen_sock in self._listen_socks:
+            listen_sock.close()
 
 
 def _runas(user_id, group_id):
@@ -218,36 +730,6 @@ def _runas(user_id, group_id):
         os.setuid(user_id)
 
 
-def _spawn_process(loop, module_type, module_name, module_interpreter,
-                   module_socket_path, module_runas):
-    user_id = module_runas.get('user_id', -1)
-    group_id = module_runas.get('group_id', -1)
-
-    if ((user_id != -1) or (group_id != -1)) and (os.getuid() != 0):
-        raise RuntimeError('"runas" only available for root')
-
-    _log.info('Starting module "%s/%s" (%s) as %d:%d',
-              module_type, module_name, module_interpreter, user_id, group_id)
-
-    if os.path.exists(module_socket_path):
-        os.unlink(module_socket_path)
-
-    process = loop.subprocess_exec(
-            functools.partial(
-                    _ModuleProcess,
-                    loop, module_type, module_name, module_interpreter,
-                    module_socket_path, module_runas),
-            os.path.join(_conf['python_interpreters_dir'], module_interpreter),
-            '-m', _MODULES_LOADER,
-            _NAMESPACE, module_type, module_name,
-            stdin=None, stdout=None, stderr=None,
-            preexec_fn=functools.partial(_runas, user_id, group_id))
-    if loop.is_running():
-        loop.create_task(process)
-    else:
-        loop.run_until_complete(process)
-
-
 def _stop(sig_num, loop):
     _log.info('Exiting on signal %d...', sig_num)
     loop.stop()
@@ -257,7 +739,7 @@ def _main():
     module_interpreters = _find_module_interpreters()
 
     enabled_modules = []
-    for mod_type, mod_name, mod_socket_path, mod_runas in \
+    for mod_type, mod_name, mod_socket_path, mod_runas, mod_workers in \
             _find_all_enabled_modules():
         module_interpreter = module_interpreters.get(mod_name)
         if module_interpreter is None:
@@ -265,20 +747,23 @@ def _main():
                                '"%s"' % mod_name)
         enabled_modules.append(
                 (mod_type, mod_name, module_interpreter, mod_socket_path,
-                 mod_runas))
+                 mod_runas, mod_workers))
 
     _log.info('%u enabled module instances found', len(enabled_modules))
 
     loop = trollius.get_event_loop()
+    supervisor = _Supervisor(loop)
 
     for sig_num in signal.SIGINT, signal.SIGTERM:
         loop.add_signal_handler(sig_num, lambda: _stop(sig_num, loop))
-
-    list(map(lambda module: _spawn_process(loop, *module), enabled_modules))
+    loop.add_signal_handler(signal.SIGUSR1, supervisor.log_state)
 
     try:
+        list(map(lambda module: supervisor.start(*module), enabled_modules))
+
         loop.run_forever()
     finally:
+        loop.run_until_complete(supervisor.shutdown())
         loop.close()
 
 
@@ -303,7 +788,8 @@ def main():
     _load_conf(conf_file_path)
 
     global _log
-    _log = logging.configure_file_logger(_conf['log_file'], _conf['log_level'])
+    _log = logging.configure_file_logger(
+            _conf['log_file'], _conf['log_level'], _conf['log_queue'])
 
     _log.info('Manager started')
     _log.info('Configuration file: "%s"', conf_file_path)
@@ -315,7 +801,6 @@ def main():
     except:
         _log.exception('Unhandled exception')
         return os.EX_SOFTWARE
-    # TODO: Ensure that all subprocesses are killed.
     return os.EX_OK
 
 
@@ -37,3 +37,42 @@ def get_conf_path(conf, module_name):
 def get_sock_path(conf, module_type, module_name):
     return os.path.join(
             conf['modules_sock_dir'], '%s.%s.sock' % (module_type, module_name))
+
+
+def get_worker_sock_path(sock_path, worker_n):
+    # Private socket of one of loader workers sharing socket of module.
+    return '%s.%d' % (sock_path, worker_n)
+
+
+def get_breaker_state_path(conf, module_type, module_name):
+    return os.path.join(
+            conf['modules_sock_dir'],
+            '%s.%s.breaker' % (module_type, module_name))
+
+
+def get_catalogue_path(conf, module_type, module_name):
+    return os.path.join(
+            conf['modules_sock_dir'],
+            '%s.%s.items' % (module_type, module_name))
+
+
+def get_value_plane_path(conf, module_type, module_name):
+    return os.path.join(
+            conf['modules_sock_dir'],
+            '%s.%s.values' % (module_type, module_name))
+
+
+def write_file_atomically(file_path, data):
+    # Not imported globally to make agent's startup faster.
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(
+            prefix='.' + os.path.basename(file_path) + '.',
+            dir=os.path.dirname(file_path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, file_path)
+    except:
+        os.unlink(tmp_path)
+        raise
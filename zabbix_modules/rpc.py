@@ -1,9 +1,11 @@
 from __future__ import absolute_import
 
+import collections
 import functools
 import json
 import logging
 import struct
+import time
 import weakref
 
 import six
@@ -12,6 +14,46 @@ import six
 _LENGTH = '!I'
 _RPC_PREFIX = 'remote_'
 
+_MAX_FRAME_SIZE = 16 * 1024 * 1024  # bytes
+_RECV_SIZE = 64 * 1024  # bytes
+
+_MAX_CALL_ID = 0xffffffff
+
+# Calls with this prefix are handled by RPC server itself.
+_BUILTIN_PREFIX = 'rpc.'
+_BUILTIN_FN_PREFIX = '_builtin_'
+
+CODEC_JSON = 'json'
+CODEC_STRUCT = 'struct'
+
+_CODECS = (CODEC_STRUCT, CODEC_JSON)
+
+# Packets encoded with "struct" codec start with tag byte. JSON packets always
+# start with "{".
+_TAG_GET_VALUE = 1
+_TAG_UI64 = 2
+_TAG_DBL = 3
+_TAG_STRING = 4
+_TAG_GET_VALUE_DEADLINE = 5
+
+_STRUCT_HEADER = struct.Struct('!BI')
+_STRUCT_GET_VALUE = struct.Struct('!BIH')
+_STRUCT_GET_VALUE_DEADLINE = struct.Struct('!BIdH')
+_STRUCT_UI64 = struct.Struct('!BIQ')
+_STRUCT_DBL = struct.Struct('!BId')
+_STRUCT_STRING = struct.Struct('!BIBBI')
+_STRUCT_STRING_LENGTH = struct.Struct('!H')
+
+_MAX_STRING_LENGTH = 0xffff
+_MAX_UI64 = 0xffffffffffffffff
+
+# (result key, successful) for _TAG_STRING replies.
+_STRING_KINDS = (
+    ('str', True),
+    ('text', True),
+    ('msg', False),
+)
+
 
 _log = logging.getLogger(__name__)
 
@@ -22,88 +64,498 @@ def _length_to_bytes(length):
 
 _LENGTH_LENGTH = len(_length_to_bytes(0))
 
+# For clients using their own transport, see get_frame_length().
+FRAME_HEADER_SIZE = _LENGTH_LENGTH
+
+# Answered by server itself, could be used as liveness probe.
+PING = _BUILTIN_PREFIX + 'ping'
+
+
+def _frame(packet):
+    return _length_to_bytes(len(packet)) + packet
+
+
+def _json_packet(obj):
+    return json.dumps(obj).encode()
+
+
+def _check_frame_length(length, max_frame_size):
+    if length > max_frame_size:
+        raise RuntimeError('Frame too large: %u > %u bytes' % (
+            length, max_frame_size))
+
+
+def get_frame_length(header, max_frame_size=_MAX_FRAME_SIZE):
+    length = struct.unpack(_LENGTH, header)[0]
+    _check_frame_length(length, max_frame_size)
+    return length
+
+
+def get_call_frame(name, args=(), kwargs=None):
+    return _frame(_json_packet({
+        'name': name,
+        'args': args,
+        'kwargs': kwargs or {},
+    }))
+
+
+class _FrameDecoder(object):
+    """
+    Splits stream of length-prefixed frames into packets. All complete frames
+    are decoded in one pass, each one is copied once into its own packet.
+    Only incomplete frame at the end of chunk is kept in single internal
+    buffer until the rest of it arrives. Invalid frame is reported
+    after all complete frames preceding it are returned: by next call of
+    feed() and through "error" attribute.
+    """
+
+    def __init__(self, max_frame_size=_MAX_FRAME_SIZE):
+        self._max_frame_size = max_frame_size
+
+        self._buffer = bytearray()
+        self.error = None
+
+    def _split(self, data, packets):
+        view = memoryview(data)
+        data_len = len(data)
+        offset = 0
+        while (data_len - offset) >= _LENGTH_LENGTH:
+            length = struct.unpack_from(_LENGTH, data, offset)[0]
+            try:
+                _check_frame_length(length, self._max_frame_size)
+            except RuntimeError as exc:
+                if not packets:
+                    raise
+                self.error = exc
+                break
+
+            end = offset + _LENGTH_LENGTH + length
+            if end > data_len:
+                break
+            packets.append(view[offset + _LENGTH_LENGTH:end].tobytes())
+            offset = end
+        # Buffer could not be resized while there are exported views.
+        del view
+
+        return offset
+
+    def feed(self, data):
+        if self.error is not None:
+            raise self.error
+
+        packets = []
+
+        if self._buffer:
+            self._buffer += data
+            offset = self._split(self._buffer, packets)
+            if offset:
+                del self._buffer[:offset]
+        else:
+            offset = self._split(data, packets)
+            if offset < len(data):
+                self._buffer += data[offset:]
+
+        return packets
+
+
+def _is_json_packet(packet):
+    return packet[:1] == b'{'
+
+
+def _encode_strings(strings):
+    parts = []
+    for string in strings:
+        if not isinstance(string, six.string_types):
+            return None
+        if isinstance(string, six.text_type):
+            string = string.encode('utf-8')
+        if len(string) > _MAX_STRING_LENGTH:
+            return None
+        parts.append(_STRUCT_STRING_LENGTH.pack(len(string)))
+        parts.append(string)
+    return parts
+
+
+def _decode_strings(packet, offset, n_strings):
+    strings = []
+    for _ in six.moves.range(n_strings):
+        length = _STRUCT_STRING_LENGTH.unpack_from(packet, offset)[0]
+        offset += _STRUCT_STRING_LENGTH.size
+        strings.append(packet[offset:offset + length].decode('utf-8'))
+        offset += length
+    return strings
+
+
+def _encode_struct_call(call_id, name, args, kwargs, deadline):
+    # Only the most common call has binary representation.
+    if (name != 'get_value') or kwargs or (not args):
+        return None
+
+    parts = _encode_strings(args)
+    if parts is None:
+        return None
+    if deadline is None:
+        header = _STRUCT_GET_VALUE.pack(_TAG_GET_VALUE, call_id, len(args))
+    else:
+        header = _STRUCT_GET_VALUE_DEADLINE.pack(
+                _TAG_GET_VALUE_DEADLINE, call_id, deadline, len(args))
+    return header + six.binary_type().join(parts)
+
+
+def _decode_struct_call(packet):
+    tag = six.indexbytes(packet, 0)
+    if tag == _TAG_GET_VALUE:
+        _, call_id, n_args = _STRUCT_GET_VALUE.unpack_from(packet)
+        deadline = None
+        offset = _STRUCT_GET_VALUE.size
+    elif tag == _TAG_GET_VALUE_DEADLINE:
+        _, call_id, deadline, n_args = \
+            _STRUCT_GET_VALUE_DEADLINE.unpack_from(packet)
+        offset = _STRUCT_GET_VALUE_DEADLINE.size
+    else:
+        raise RuntimeError('Unknown RPC call tag: %d' % tag)
+    return call_id, 'get_value', _decode_strings(
+            packet, offset, n_args), {}, deadline
+
+
+def _encode_struct_result(call_id, result):
+    if (not isinstance(result, dict)) or (len(result) > 2):
+        return None
+
+    if len(result) == 1:
+        value = result.get('ui64')
+        if isinstance(value, six.integer_types) and \
+                (0 <= value <= _MAX_UI64):
+            return _STRUCT_UI64.pack(_TAG_UI64, call_id, value)
+
+        value = result.get('dbl')
+        if isinstance(value, float):
+            return _STRUCT_DBL.pack(_TAG_DBL, call_id, value)
+
+    successful = result.get('result', True)
+    for kind, (key, kind_successful) in enumerate(_STRING_KINDS):
+        if (key not in result) or (successful is not kind_successful):
+            continue
+        if len(result) != (1 if successful else 2):
+            return None
+        parts = _encode_strings((result[key], ))
+        if parts is None:
+            return None
+        return _STRUCT_STRING.pack(
+                _TAG_STRING, call_id, kind, successful,
+                len(parts[1])) + parts[1]
+
+    return None
 
-def _bytes_to_length(data):
-    return struct.unpack(_LENGTH, data)[0]
+
+def _decode_struct_reply(packet):
+    tag, call_id = _STRUCT_HEADER.unpack_from(packet)
+    if tag == _TAG_UI64:
+        result = {'ui64': _STRUCT_UI64.unpack_from(packet)[2]}
+    elif tag == _TAG_DBL:
+        result = {'dbl': _STRUCT_DBL.unpack_from(packet)[2]}
+    elif tag == _TAG_STRING:
+        _, _, kind, successful, length = _STRUCT_STRING.unpack_from(packet)
+        key, _ = _STRING_KINDS[kind]
+        offset = _STRUCT_STRING.size
+        result = {key: packet[offset:offset + length].decode('utf-8')}
+        if not successful:
+            result['result'] = False
+    else:
+        raise RuntimeError('Unknown RPC reply tag: %d' % tag)
+    return {'id': call_id, 'result': result}
+
+
+def invoke(target, name, args, kwargs, prefix=_RPC_PREFIX):
+    try:
+        return {
+            'result': getattr(target, prefix + name)(*args, **kwargs),
+        }
+    except BaseException as exc:
+        _log.exception('RPC call %r failed, sending exception string to '
+                       'remote end', (name, args, kwargs))
+        return {
+            'error': '%r' % exc,
+        }
+
+
+def get_deadline_reply():
+    return {
+        'error': 'Deadline exceeded',
+        'expired': True,
+    }
 
 
 class Server(object):
-    def __init__(self, stream, target):
+    def __init__(self, stream, target, max_frame_size=_MAX_FRAME_SIZE):
         self._stream = weakref.ref(stream)
         self._target = target
 
-        self._buffer = six.binary_type()
+        self._decoder = _FrameDecoder(max_frame_size)
+
+    def _packet_send(self, packet):
+        stream = self._stream()
+        if stream is None:
+            _log.warning('Stream closed, dropping RPC reply')
+            return
+        stream.raw_send_all(_frame(packet))
 
-    def _packet_send(self, data):
-        self._stream().raw_send_all(
-                _length_to_bytes(len(data)) + data.encode())
+    def _builtin_ping(self):
+        return True
 
-    def _remote_call(self, name, args, kwargs):
-        try:
-            result = {
-                'result': getattr(self._target, _RPC_PREFIX + name)(
-                        *args, **kwargs),
-            }
-        except BaseException as exc:
-            _log.exception('RPC call %r failed, sending exception string to '
-                           'remote end', (name, args, kwargs))
-            result = {
-                'error': '%r' % exc,
-            }
-        self._packet_send(json.dumps(result))
+    def _builtin_handshake(self, codecs):
+        for codec in codecs:
+            if codec in _CODECS:
+                return {'codec': codec}
+        return {'codec': CODEC_JSON}
+
+    def _invoke(self, name, args, kwargs):
+        if name.startswith(_BUILTIN_PREFIX):
+            return invoke(self, name[len(_BUILTIN_PREFIX):], args, kwargs,
+                          _BUILTIN_FN_PREFIX)
+        return invoke(self._target, name, args, kwargs)
+
+    def _reply_send(self, call_id, binary, reply):
+        # Binary calls are sent only by clients which negotiated "struct"
+        # codec, so reply could be binary too.
+        if binary and ('result' in reply):
+            packet = _encode_struct_result(call_id, reply['result'])
+            if packet is not None:
+                self._packet_send(packet)
+                return
+
+        if call_id is not None:
+            reply['id'] = call_id
+        self._packet_send(_json_packet(reply))
+
+    def _remote_call(self, name, args, kwargs, call_id=None, binary=False,
+                     deadline=None):
+        # Could be overridden to complete calls asynchronously, replies are
+        # matched with calls by ID on client side.
+        self._reply_send(call_id, binary, self._invoke(name, args, kwargs))
 
     def _on_packet_recv(self, packet):
-        call = json.loads(packet.decode())
-        self._remote_call(**call)
+        if _is_json_packet(packet):
+            call = json.loads(packet.decode())
+            call_id = call.get('id')
+            name = call['name']
+            args = call['args']
+            kwargs = call['kwargs']
+            deadline = call.get('deadline')
+            binary = False
+        else:
+            call_id, name, args, kwargs, deadline = _decode_struct_call(packet)
+            binary = True
 
-    def on_raw_recv(self, data):
-        self._buffer += data
-        if len(self._buffer) >= _LENGTH_LENGTH:
-            length = _bytes_to_length(self._buffer[:_LENGTH_LENGTH])
+        if (deadline is not None) and (deadline <= time.time()):
+            _log.warning('RPC call %r received after deadline, skipping',
+                         (name, args, kwargs))
+            self._reply_send(call_id, binary, get_deadline_reply())
         else:
-            return
+            self._remote_call(name, args, kwargs, call_id, binary, deadline)
 
-        if len(self._buffer) >= (_LENGTH_LENGTH + length):
-            packet = self._buffer[_LENGTH_LENGTH:_LENGTH_LENGTH + length]
-            self._buffer = self._buffer[_LENGTH_LENGTH + length:]
+    def on_raw_recv(self, data):
+        for packet in self._decoder.feed(data):
             self._on_packet_recv(packet)
+        if self._decoder.error is not None:
+            raise self._decoder.error
+
+
+class RemoteError(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
 
 
 class Client(object):
-    def __init__(self, stream):
+    def __init__(self, stream, timeout=None):
         self._stream = stream
+        self._timeout = timeout
+
+        self._last_call_id = 0
+        self.reset()
+
+    def reset(self):
+        # Should be called when underlying stream is reconnected: replies for
+        # calls in flight will never arrive.
+        self._decoder = _FrameDecoder()
+        self._packets = collections.deque()
+        self._pending = set()
+        self._replies = {}
+        # Negotiated on first call after reset.
+        self._codec = None
+        self._pipelining = False
+        # (call, call ID) of handshake sent in advance.
+        self._handshake_call = None
 
-    def _packet_send(self, data):
-        self._stream.raw_send_all(
-                _length_to_bytes(len(data)) + data.encode())
+    def _next_call_id(self):
+        self._last_call_id = (self._last_call_id + 1) & _MAX_CALL_ID
+        return self._last_call_id
 
-    def _raw_recv_all(self, size):
-        buf = six.binary_type()
-        while size:
-            chunk = self._stream.raw_recv(size)
+    def _get_deadline(self):
+        if self._timeout is None:
+            return None
+        return time.time() + self._timeout
+
+    def _packet_recv(self, deadline):
+        while not self._packets:
+            chunk = self._stream.raw_recv(_RECV_SIZE, deadline)
             if not chunk:
                 raise RuntimeError('Got unexpected EOF')
-            buf += chunk
-            size -= len(chunk)
+            self._packets.extend(self._decoder.feed(chunk))
+
+        return self._packets.popleft()
+
+    def _reply_recv(self, call_id, deadline):
+        reply = self._replies.pop(call_id, None) if self._replies else None
+        while reply is None:
+            packet = self._packet_recv(deadline)
+            if _is_json_packet(packet):
+                reply = json.loads(packet.decode())
+            else:
+                reply = _decode_struct_reply(packet)
+            # Replies without ID are from servers answering strictly in
+            # order, without pipelining.
+            reply_id = reply.pop('id', call_id)
+            if reply_id != call_id:
+                if reply_id in self._pending:
+                    self._replies[reply_id] = reply
+                else:
+                    _log.warning('Dropping RPC reply for unknown call %r',
+                                 reply_id)
+                reply = None
+
+        self._pending.discard(call_id)
+        return reply
+
+    def _call_frame(self, name, args, kwargs, deadline):
+        call_id = self._next_call_id()
+        self._pending.add(call_id)
+
+        packet = None
+        if self._codec == CODEC_STRUCT:
+            packet = _encode_struct_call(call_id, name, args, kwargs,
+                                         deadline)
+        if packet is None:
+            call = {
+                'name': name,
+                'args': args,
+                'kwargs': kwargs,
+            }
+            if self._pipelining:
+                call['id'] = call_id
+                if deadline is not None:
+                    call['deadline'] = deadline
+            packet = _json_packet(call)
+        return call_id, _frame(packet)
+
+    def _handshake_send(self, deadline):
+        # Sent without call ID, so older servers without pipelining and codecs
+        # support answer it with error instead of dropping connection.
+        call = (_BUILTIN_PREFIX + 'handshake', (_CODECS, ), {})
+        call_id, frame = self._call_frame(*(call + (deadline, )))
+        self._stream.raw_send_all(frame, deadline)
+        self._handshake_call = (call, call_id)
+
+    def _handshake(self, deadline):
+        if self._handshake_call is None:
+            self._handshake_send(deadline)
+        call, call_id = self._handshake_call
+        self._handshake_call = None
+
+        self._codec = CODEC_JSON
+        result = self._get_result(call, self._reply_recv(call_id, deadline))
+        if isinstance(result, RemoteError):
+            _log.info('RPC handshake failed, using "%s" codec without '
+                      'pipelining: %s', CODEC_JSON, result)
+            return
+
+        self._pipelining = True
+        if result['codec'] in _CODECS:
+            self._codec = result['codec']
 
-        return buf
+    def handshake_send(self):
+        """
+        Connects and sends handshake without waiting for reply, which is
+        received by handshake() or on first call. Allows to handshake with
+        several servers in parallel.
+        """
+        if (self._codec is not None) or (self._handshake_call is not None):
+            return
+        try:
+            self._handshake_send(self._get_deadline())
+        except:
+            self.reset()
+            raise
+
+    def handshake(self):
+        if self._codec is not None:
+            return
+        try:
+            self._handshake(self._get_deadline())
+        except:
+            self.reset()
+            raise
+
+    @staticmethod
+    def _get_result(call, reply):
+        if 'error' in reply:
+            if reply.get('expired'):
+                return DeadlineExceeded(
+                        'RPC call %r was not completed before deadline' % (
+                            call, ))
+            return RemoteError('RPC error %r -> %r' % (call, reply))
+        return reply['result']
 
-    def _packet_recv(self):
-        length = _bytes_to_length(
-                self._raw_recv_all(_LENGTH_LENGTH))
-        return self._raw_recv_all(length).decode()
+    def call_batch(self, calls):
+        """
+        Pipelines all calls through one stream. Returns list of results in
+        the order of calls, failed calls are represented by instances of
+        RemoteError or DeadlineExceeded. Whole batch shares one deadline.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+
+        deadline = self._get_deadline()
+        try:
+            if self._codec is None:
+                self._handshake(deadline)
+            if not self._pipelining:
+                return [self._call(name, args, kwargs, deadline)
+                        for name, args, kwargs in calls]
+
+            call_ids, frames = zip(*[
+                self._call_frame(name, args, kwargs, deadline)
+                for name, args, kwargs in calls])
+            self._stream.raw_send_all(six.binary_type().join(frames), deadline)
+            return [self._get_result(call, self._reply_recv(call_id, deadline))
+                    for call, call_id in zip(calls, call_ids)]
+        except:
+            self.reset()
+            raise
+
+    def _call(self, name, args, kwargs, deadline):
+        call_id, frame = self._call_frame(name, args, kwargs, deadline)
+        self._stream.raw_send_all(frame, deadline)
+        return self._get_result(
+                (name, args, kwargs), self._reply_recv(call_id, deadline))
 
     def _remote_call(self, name, *args, **kwargs):
-        self._packet_send(json.dumps({
-            'name': name,
-            'args': args,
-            'kwargs': kwargs,
-        }))
-        result = json.loads(self._packet_recv())
-        if 'error' in result:
-            raise RuntimeError(
-                    'RPC error %r -> %r' % ((name, args, kwargs), result))
-        return result['result']
+        deadline = self._get_deadline()
+        try:
+            if self._codec is None:
+                self._handshake(deadline)
+            result = self._call(name, args, kwargs, deadline)
+        except:
+            self.reset()
+            raise
+
+        if isinstance(result, (RemoteError, DeadlineExceeded)):
+            raise result
+        return result
 
     def __getattr__(self, name):
         if not name.startswith(_RPC_PREFIX):
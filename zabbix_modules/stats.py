@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+
+import bisect
+import functools
+import threading
+import time
+
+import trollius
+
+import zabbix_module.types as types
+import zabbix_modules.logging as logging
+
+
+# Upper bounds of histogram buckets: from 1 microsecond to ~95 seconds, each
+# bucket is sqrt(2) times wider than previous one.
+_BUCKET_BOUNDS = tuple(1e-6 * 2 ** (bucket_n / 2.0) for bucket_n in range(54))
+
+_PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(_BUCKET_BOUNDS, value)] += 1
+        self.total += 1
+
+
+def get_percentile(histograms, percentile):
+    """
+    Returns upper bound of bucket containing given percentile of values from
+    all histograms, or None if histograms are empty.
+    """
+    total = sum(histogram.total for histogram in histograms)
+    if not total:
+        return None
+
+    rank = total * percentile / 100.0
+    count = 0
+    for bucket_n, bucket_counts in enumerate(zip(
+            *[histogram.counts for histogram in histograms])):
+        count += sum(bucket_counts)
+        if count >= rank:
+            break
+    if bucket_n == len(_BUCKET_BOUNDS):
+        return float('inf')
+    return _BUCKET_BOUNDS[bucket_n]
+
+
+class KeyStats(object):
+    """
+    Counters are cumulative, latency percentiles are calculated over last one
+    or two windows.
+    """
+
+    def __init__(self, window, cur_time):
+        self._window = window
+
+        self.calls = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+        self._window_start = cur_time
+        self._histogram = Histogram()
+        self._prev_histogram = Histogram()
+
+    def _rotate(self, cur_time):
+        if cur_time - self._window_start < self._window:
+            return
+        if cur_time - self._window_start < 2 * self._window:
+            self._prev_histogram = self._histogram
+        else:
+            self._prev_histogram = Histogram()
+        self._histogram = Histogram()
+        self._window_start = cur_time
+
+    def record(self, duration, failed, cur_time):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.latency_sum += duration
+        if duration > self.latency_max:
+            self.latency_max = duration
+
+        self._rotate(cur_time)
+        self._histogram.add(duration)
+
+    def get_percentile(self, percentile, cur_time):
+        self._rotate(cur_time)
+        return get_percentile((self._prev_histogram, self._histogram),
+                              percentile)
+
+
+class Stats(object):
+    def __init__(self, window):
+        self._window = window
+
+        self.rpc_bytes_in = 0
+        self.rpc_bytes_out = 0
+
+        self._keys = {}
+        # Items may be executed in worker threads.
+        self._lock = threading.Lock()
+
+    def record(self, key, duration, failed):
+        cur_time = time.time()
+        with self._lock:
+            key_stats = self._keys.get(key)
+            if key_stats is None:
+                key_stats = self._keys[key] = KeyStats(self._window, cur_time)
+            key_stats.record(duration, failed, cur_time)
+
+    def get_keys(self):
+        with self._lock:
+            return list(self._keys)
+
+    def get(self, key, fn):
+        with self._lock:
+            key_stats = self._keys.get(key)
+            if key_stats is None:
+                return None
+            return fn(key_stats)
+
+
+def _no_data(key):
+    return {
+        'msg': 'No requests of item "%s" yet' % key,
+        'result': False,
+    }
+
+
+class InternalItems(object):
+    """
+    Wraps module and adds items with its own statistics:
+    "<prefix>calls[key]", "<prefix>latency.p99[key]" and so on.
+    """
+
+    def __init__(self, target, stats, prefix):
+        self._target = target
+        self._stats = stats
+        self._prefix = prefix
+
+        self._key_items = {
+            'calls': lambda key_stats: {'ui64': key_stats.calls},
+            'errors': lambda key_stats: {'ui64': key_stats.errors},
+            'latency.avg': lambda key_stats: {
+                'dbl': key_stats.latency_sum / key_stats.calls,
+            },
+            'latency.max': lambda key_stats: {'dbl': key_stats.latency_max},
+        }
+        for percentile in _PERCENTILES:
+            self._key_items['latency.p%d' % percentile] = functools.partial(
+                    self._get_percentile, percentile)
+
+        self._items = {
+            'rpc.bytes_in': lambda: {'ui64': self._stats.rpc_bytes_in},
+            'rpc.bytes_out': lambda: {'ui64': self._stats.rpc_bytes_out},
+            'log.dropped': functools.partial(
+                    self._get_log_stat, ('dropped_queue_full',
+                                         'dropped_rate_limit')),
+            'log.suppressed': functools.partial(
+                    self._get_log_stat, ('suppressed', )),
+            'items.discovery': lambda: {
+                'str': types.Discovery({
+                    'ZPM_ITEM_KEY': key,
+                } for key in self._stats.get_keys()).get_string(),
+            },
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    @staticmethod
+    def _get_percentile(percentile, key_stats):
+        value = key_stats.get_percentile(percentile, time.time())
+        if value is None:
+            return {
+                'msg': 'No requests during last statistics window',
+                'result': False,
+            }
+        # Bucket bound could be larger than any recorded value.
+        return {'dbl': min(value, key_stats.latency_max)}
+
+    @staticmethod
+    def _get_log_stat(names):
+        log_stats = logging.get_stats()
+        if log_stats is None:
+            return {'msg': 'Log queue is disabled', 'result': False}
+        return {'ui64': sum(log_stats[name] for name in names)}
+
+    def is_internal_item(self, key):
+        return key.startswith(self._prefix)
+
+    def is_blocking_item(self, key):
+        if self.is_internal_item(key):
+            return False
+        return self._target.is_blocking_item(key)
+
+    def _get_internal_value(self, key, params):
+        name = key[len(self._prefix):]
+        if name in self._items:
+            return self._items[name]()
+
+        if len(params) != 1:
+            raise RuntimeError('Item "%s" requires one parameter' % key)
+        result = self._stats.get(params[0], self._key_items[name])
+        if result is None:
+            return _no_data(params[0])
+        return result
+
+    def remote_item_list(self):
+        items = list(self._target.remote_item_list())
+        items.extend({
+            'key': self._prefix + name,
+            'flags': ('haveparams', ),
+            'test_param': None,
+        } for name in sorted(self._key_items))
+        items.extend({
+            'key': self._prefix + name,
+            'flags': (),
+            'test_param': None,
+        } for name in sorted(self._items))
+        return items
+
+    def remote_get_value(self, key, *params):
+        if self.is_internal_item(key):
+            return self._get_internal_value(key, params)
+        return self._target.remote_get_value(key, *params)
+
+    @trollius.coroutine
+    def _merge_values(self, results, target_results):
+        target_results = yield trollius.From(target_results)
+        raise trollius.Return(self._merge(results, target_results))
+
+    @staticmethod
+    def _merge(results, target_results):
+        target_results = iter(target_results)
+        return [next(target_results) if result is None else result
+                for result in results]
+
+    def remote_get_values(self, requests):
+        results = []
+        target_requests = []
+        for key, params in requests:
+            if self.is_internal_item(key):
+                try:
+                    results.append(self._get_internal_value(key, params))
+                except Exception as exc:
+                    results.append({'msg': 'Unable to get item: %r' % exc,
+                                    'result': False})
+            else:
+                results.append(None)
+                target_requests.append((key, params))
+
+        if not target_requests:
+            return results
+        target_results = self._target.remote_get_values(target_requests)
+        if trollius.iscoroutine(target_results):
+            return self._merge_values(results, target_results)
+        return self._merge(results, target_results)
+
+    def is_blocking_item(self, key):
+        if self.is_internal_item(key):
+            return False
+        return self._target.is_blocking_item(key)
@@ -0,0 +1,282 @@
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import six
+
+
+_MAGIC = b'ZPMV'
+_VERSION = 1
+
+# magic, version, number of slots, slot size, generation
+_HEADER = struct.Struct('=4sIIIQ')
+# sequence, key hash, timestamp, maximum age, value kind, key length, value
+# length. Key and value follow slot header.
+_SLOT_HEADER = struct.Struct('=IIddBHH')
+_SEQUENCE = struct.Struct('=I')
+_UI64 = struct.Struct('=Q')
+_DBL = struct.Struct('=d')
+
+DEFAULT_SLOT_SIZE = 256
+
+# Slots are looked up using linear probing.
+_MAX_PROBES = 16
+# Reader retries if slot is being written.
+_MAX_READ_RETRIES = 4
+
+# Value could not be stored in slot, reader should use RPC.
+_KIND_NONE = 0
+_KIND_UI64 = 1
+_KIND_DBL = 2
+_KIND_STR = 3
+_KIND_TEXT = 4
+_KIND_MSG = 5
+
+_STRING_KINDS = {
+    'str': _KIND_STR,
+    'text': _KIND_TEXT,
+    'msg': _KIND_MSG,
+}
+
+_MAX_UI64 = 0xffffffffffffffff
+
+# Reader checks whether file was replaced by restarted loader not more often
+# than this.
+_REOPEN_INTERVAL = 1.0  # seconds
+
+
+_log = logging.getLogger(__name__)
+
+
+def _encode_key(key, params):
+    return u'\0'.join((key, ) + tuple(params)).encode('utf-8')
+
+
+def _hash_key(key_bytes):
+    return zlib.crc32(key_bytes) & 0xffffffff
+
+
+def _encode_value(result):
+    if result.get('result', True):
+        if 'ui64' in result:
+            value = result['ui64']
+            if isinstance(value, six.integer_types) and \
+                    (0 <= value <= _MAX_UI64):
+                return _KIND_UI64, _UI64.pack(value)
+        elif 'dbl' in result:
+            return _KIND_DBL, _DBL.pack(result['dbl'])
+        for result_key in ('str', 'text'):
+            if result_key in result:
+                return _STRING_KINDS[result_key], \
+                    result[result_key].encode('utf-8')
+    elif 'msg' in result:
+        return _KIND_MSG, result['msg'].encode('utf-8')
+    return _KIND_NONE, b''
+
+
+def _decode_value(kind, value_bytes):
+    if kind == _KIND_UI64:
+        return {'ui64': _UI64.unpack(value_bytes)[0]}
+    if kind == _KIND_DBL:
+        return {'dbl': _DBL.unpack(value_bytes)[0]}
+    if kind == _KIND_STR:
+        return {'str': value_bytes.decode('utf-8')}
+    if kind == _KIND_TEXT:
+        return {'text': value_bytes.decode('utf-8')}
+    if kind == _KIND_MSG:
+        return {'msg': value_bytes.decode('utf-8'), 'result': False}
+    return None
+
+
+def _get_slot_offset(slot_n, slot_size):
+    return _HEADER.size + slot_n * slot_size
+
+
+class Writer(object):
+    """
+    Publishes values of asynchronous items into memory mapped file, so agent
+    processes could read them without RPC. Each slot is protected by sequence
+    lock: sequence number is odd while slot is being written. Layout is also
+    read by src/python_zabbix_modules.c.
+    """
+
+    def __init__(self, file_path, n_slots, slot_size=DEFAULT_SLOT_SIZE):
+        self._n_slots = n_slots
+        self._slot_size = slot_size
+
+        # key bytes -> slot number
+        self._slots = {}
+        self._used = set()
+        self._lock = threading.Lock()
+
+        size = _get_slot_offset(n_slots, slot_size)
+        # New file is created and renamed, so readers of file from previous
+        # run will notice replacement.
+        tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                os.ftruncate(fd, size)
+                self._mmap = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, n_slots,
+                              slot_size, _UI64.unpack(os.urandom(8))[0])
+            os.rename(tmp_path, file_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        self._mmap.close()
+
+    def _find_slot(self, key_bytes):
+        slot_n = self._slots.get(key_bytes)
+        if slot_n is not None:
+            return slot_n
+
+        key_hash = _hash_key(key_bytes)
+        for probe_n in range(_MAX_PROBES):
+            slot_n = (key_hash + probe_n) % self._n_slots
+            if slot_n not in self._used:
+                self._used.add(slot_n)
+                self._slots[key_bytes] = slot_n
+                return slot_n
+        return None
+
+    def publish(self, key, params, result, timestamp, max_age):
+        key_bytes = _encode_key(key, params)
+        kind, value_bytes = _encode_value(result)
+
+        if _SLOT_HEADER.size + len(key_bytes) > self._slot_size:
+            return False
+        if _SLOT_HEADER.size + len(key_bytes) + len(value_bytes) > \
+                self._slot_size:
+            # Reader will fall back to RPC.
+            kind, value_bytes = _KIND_NONE, b''
+
+        with self._lock:
+            slot_n = self._find_slot(key_bytes)
+            if slot_n is None:
+                return False
+
+            buf = self._mmap
+            offset = _get_slot_offset(slot_n, self._slot_size)
+            sequence = _SEQUENCE.unpack_from(buf, offset)[0]
+            _SEQUENCE.pack_into(buf, offset, (sequence + 1) & 0xffffffff)
+            _SLOT_HEADER.pack_into(
+                    buf, offset, (sequence + 1) & 0xffffffff,
+                    _hash_key(key_bytes), timestamp, max_age, kind,
+                    len(key_bytes), len(value_bytes))
+            data_offset = offset + _SLOT_HEADER.size
+            buf[data_offset:data_offset + len(key_bytes)] = key_bytes
+            data_offset += len(key_bytes)
+            buf[data_offset:data_offset + len(value_bytes)] = value_bytes
+            _SEQUENCE.pack_into(buf, offset, (sequence + 2) & 0xffffffff)
+        return True
+
+
+class Reader(object):
+    def __init__(self, file_path):
+        self._file_path = file_path
+
+        self._mmap = None
+        self._inode = None
+        self._n_slots = None
+        self._slot_size = None
+        self._next_check_time = 0.0
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._inode = None
+
+    def _open(self, inode):
+        fd = os.open(self._file_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size < _HEADER.size:
+                return
+            buf = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        magic, version, n_slots, slot_size, _ = _HEADER.unpack_from(buf, 0)
+        if (magic != _MAGIC) or (version != _VERSION) or \
+                (size < _get_slot_offset(n_slots, slot_size)):
+            _log.warning('Invalid value plane file "%s", ignoring',
+                         self._file_path)
+            buf.close()
+            return
+
+        self._mmap = buf
+        self._inode = inode
+        self._n_slots = n_slots
+        self._slot_size = slot_size
+
+    def _check(self):
+        cur_time = time.time()
+        if cur_time < self._next_check_time:
+            return
+        self._next_check_time = cur_time + _REOPEN_INTERVAL
+
+        try:
+            inode = os.stat(self._file_path).st_ino
+            if inode != self._inode:
+                self.close()
+                self._open(inode)
+        except (IOError, OSError, ValueError):
+            self.close()
+
+    def _lookup(self, key_bytes):
+        buf = self._mmap
+        key_hash = _hash_key(key_bytes)
+        for probe_n in range(_MAX_PROBES):
+            offset = _get_slot_offset((key_hash + probe_n) % self._n_slots,
+                                      self._slot_size)
+            for _ in range(_MAX_READ_RETRIES):
+                sequence, slot_hash, timestamp, max_age, kind, key_length, \
+                    value_length = _SLOT_HEADER.unpack_from(buf, offset)
+                if sequence & 1:
+                    continue
+                if not key_length:
+                    # Empty slot, end of probing chain.
+                    return None
+                if slot_hash != key_hash:
+                    break
+
+                data_offset = offset + _SLOT_HEADER.size
+                slot_key_bytes = buf[data_offset:data_offset + key_length]
+                data_offset += key_length
+                value_bytes = buf[data_offset:data_offset + value_length]
+                if _SEQUENCE.unpack_from(buf, offset)[0] != sequence:
+                    continue
+
+                if slot_key_bytes != key_bytes:
+                    break
+                if time.time() - timestamp > max_age:
+                    return None
+                return _decode_value(kind, value_bytes)
+            else:
+                # Slot is constantly being rewritten.
+                return None
+        return None
+
+    def get(self, key, params):
+        """
+        Returns result dictionary or None if value is missing or stale and
+        should be requested through RPC.
+        """
+        # Loader may have been restarted with new file, old one still has
+        # values which are not stale yet.
+        self._check()
+        if self._mmap is None:
+            return None
+        return self._lookup(_encode_key(key, params))
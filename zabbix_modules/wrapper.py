@@ -1,13 +1,20 @@
 from __future__ import absolute_import
 
+import array
 import collections
+import json
+import os
 import socket
+import threading
 import time
 
+import zabbix_modules.breaker as breaker
+import zabbix_modules.cache as cache
 import zabbix_modules.configuration as configuration
 import zabbix_modules.logging as logging
 import zabbix_modules.modules as modules
 import zabbix_modules.rpc as rpc
+import zabbix_modules.valueplane as valueplane
 
 
 # Native Zabbix module will initialize these with real values.
@@ -22,19 +29,58 @@ _SOCKET_CONNECTION_TIMEOUT = 4.0  # seconds
 
 _MODULE_CONNECTION_RETRY_SLEEP = 5.0  # seconds
 
+# Connect to modules on first request to each module.
+_PRECONNECT_NONE = 'none'
+# Connect and handshake with all modules in parallel after fork.
+_PRECONNECT_EAGER = 'eager'
+# Connect and send handshakes after fork, replies are received on first
+# request to each module.
+_PRECONNECT_BACKGROUND = 'background'
+_PRECONNECT_MODES = (
+    _PRECONNECT_NONE,
+    _PRECONNECT_EAGER,
+    _PRECONNECT_BACKGROUND,
+)
+
 
 _conf = configuration.CONF
 _log = None
 
 _modules = []
 _items = {}
+_items_cache_ttl = {}
+_items_asynchronous = set()
+_cache = None
+_item_list_time = None
+# value type -> list of modules
+_history_modules = {}
+
+HISTORY_TYPES = ('float', 'integer', 'string', 'text', 'log')
+
+# Typecodes of array.array for columns of history passed by native module.
+# Python 2 has no "Q" typecode, "L" is 64-bit on 64-bit Linux.
+_UINT64_TYPECODE = 'Q' if 'Q' in getattr(array, 'typecodes', '') else 'L'
+_HISTORY_COLUMN_TYPECODES = {
+    'itemid': _UINT64_TYPECODE,
+    'clock': 'i',
+    'ns': 'i',
+    'timestamp': 'i',
+    'logeventid': 'i',
+    'severity': 'i',
+}
+_HISTORY_VALUE_TYPECODES = {
+    'float': 'd',
+    'integer': _UINT64_TYPECODE,
+}
 
 
 class ZbxMetric(collections.namedtuple(
         'ZbxMetric', (
                 'key',
                 'flags',
-                'test_param'))):
+                'test_param',
+                'cache_ttl',
+                'asynchronous'))):
 
     @staticmethod
     def _get_supported_flags():
@@ -61,7 +107,9 @@ class ZbxMetric(collections.namedtuple(
             flags |= flag_val
 
         return super(cls, ZbxMetric).__new__(
-                cls, key, flags, from_dict.get('test_param'))
+                cls, key, flags, from_dict.get('test_param'),
+                from_dict.get('cache_ttl'),
+                from_dict.get('asynchronous', False))
 
 
 AgentRequest = collections.namedtuple(
@@ -98,13 +146,32 @@ class _ModuleConnectionError(RuntimeError):
     pass
 
 
+def _get_timeout(deadline):
+    timeout = deadline - time.time()
+    if timeout <= 0:
+        raise rpc.DeadlineExceeded('Deadline exceeded')
+    return timeout
+
+
 class _ModuleClient(object):
     def __init__(self, module_type, module_name):
         self.module_name = module_name
 
         self._sock_path = modules.get_sock_path(_conf, module_type, module_name)
+        self._breaker = breaker.CircuitBreaker(
+                module_name,
+                modules.get_breaker_state_path(
+                        _conf, module_type, module_name),
+                _conf['circuit_breaker_backoff_min'],
+                _conf['circuit_breaker_backoff_max'])
 
         self._sock = None
+        self.connect_stats = {
+            'connects': 0,
+            'failures': 0,
+            'time_total': 0.0,
+            'time_max': 0.0,
+        }
 
     def socket_close(self):
         if self._sock is None:
@@ -118,74 +185,135 @@ class _ModuleClient(object):
             finally:
                 self._sock = None
 
-    def _socket_connect(self):
+    def _socket_connect(self, timeout):
         _log.info('Connecting to "%s"...', self._sock_path)
 
         self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-        self._sock.settimeout(_SOCKET_CONNECTION_TIMEOUT)
+        self._sock.settimeout(timeout)
+        start_time = time.time()
         try:
             self._sock.connect(self._sock_path)
         except socket.error as exc:
             _log.error('Connection to "%s" failed: %r', self._sock_path, exc)
             self.socket_close()
+            self._breaker.on_failure()
+            self.connect_stats['failures'] += 1
         else:
+            connect_time = time.time() - start_time
+            self.connect_stats['connects'] += 1
+            self.connect_stats['time_total'] += connect_time
+            self.connect_stats['time_max'] = max(
+                    self.connect_stats['time_max'], connect_time)
             self._sock.settimeout(None)
-            _log.info('Successfully connected to "%s"', self._sock_path)
+            _log.info('Successfully connected to "%s" in %.6f seconds',
+                      self._sock_path, connect_time)
+            self._breaker.on_success()
 
-    def socket_touch(self):
+    def socket_touch(self, deadline=None):
         if self._sock is not None:
             return
-        self._socket_connect()
+
+        try:
+            self._breaker.check()
+        except breaker.CircuitOpenError as exc:
+            raise _ModuleConnectionError(str(exc))
+
+        timeout = _SOCKET_CONNECTION_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, _get_timeout(deadline))
+        self._socket_connect(timeout)
         if self._sock is None:
             raise _ModuleConnectionError(
                     'Connection to %s failed, will try again '
                     'later' % self._sock_path)
 
-    def raw_send_all(self, data):
-        self.socket_touch()
+    def _set_deadline(self, deadline):
+        if deadline is None:
+            self._sock.settimeout(None)
+        else:
+            self._sock.settimeout(_get_timeout(deadline))
+
+    def raw_send_all(self, data, deadline=None):
+        self.socket_touch(deadline)
 
         try:
+            self._set_deadline(deadline)
             self._sock.sendall(data)
+        except socket.timeout:
+            self.socket_close()
+            raise rpc.DeadlineExceeded(
+                    'Timed out sending to "%s"' % self._sock_path)
         except:
+            # Also on deadline: late reply must not be received by next call.
             self.socket_close()
             raise
 
-    def raw_recv(self, buf_size):
-        self.socket_touch()
+    def raw_recv(self, buf_size, deadline=None):
+        self.socket_touch(deadline)
 
         try:
+            self._set_deadline(deadline)
             return self._sock.recv(buf_size)
+        except socket.timeout:
+            self.socket_close()
+            raise rpc.DeadlineExceeded(
+                    'Timed out receiving from "%s"' % self._sock_path)
         except:
             self.socket_close()
             raise
 
 
 class _Module(rpc.Client):
-    def __init__(self, connection, module_name):
-        super(_Module, self).__init__(connection)
+    def __init__(self, connection, module_type, module_name):
+        super(_Module, self).__init__(connection, _conf['item_timeout'])
 
+        self.type = module_type
         self.name = module_name
+        self.sock_path = modules.get_sock_path(_conf, module_type, module_name)
+
+        self.catalogue_path = modules.get_catalogue_path(
+                _conf, module_type, module_name)
+        # Item list was loaded from catalogue and should be refreshed after
+        # fork.
+        self.catalogue_stale = False
+
+        self.value_plane_path = None
+        self.value_plane = None
+        if _conf['value_plane']:
+            self.value_plane_path = modules.get_value_plane_path(
+                    _conf, module_type, module_name)
+            self.value_plane = valueplane.Reader(self.value_plane_path)
 
 
 def _init(module_type):
     _log.info('Initializing (zabbix_%s)...' % module_type)
     _log.info('Configuration file: "%s"', configuration.CONF_FILE_PATH)
 
+    if _conf['preconnect'] not in _PRECONNECT_MODES:
+        raise RuntimeError('Unknown preconnect mode: "%s"' %
+                           _conf['preconnect'])
+
     _log.info('Locating modules...')
     for module_name in modules.find_enabled(_conf):
         _log.info('Found enabled module "%s"', module_name)
         client = _ModuleClient(module_type, module_name)
-        module = _Module(client, module_name)
+        module = _Module(client, module_type, module_name)
         _modules.append((client, module))
     _log.info('Found %u modules', len(_modules))
 
+    global _cache
+    _cache = cache.ResultCache(_conf['result_cache_size'])
+
 
 def init(module_type):
+    start_time = time.time()
     configuration.load_global(module_type)
+    conf_time = time.time()
 
     global _log
-    _log = logging.configure_file_logger(_conf['log_file'], _conf['log_level'])
+    _log = logging.configure_file_logger(
+            _conf['log_file'], _conf['log_level'], _conf['log_queue'])
 
     try:
         _init(module_type)
@@ -193,48 +321,184 @@ def init(module_type):
         _log.exception('Initialization failed')
         return ZBX_MODULE_FAIL
 
+    _log.info('Initialized in %.3f seconds (configuration %s in %.3f '
+              'seconds)', time.time() - start_time,
+              'loaded from cache' if configuration.CONF_CACHED else 'parsed',
+              conf_time - start_time)
     return ZBX_MODULE_OK
 
 
+def _preconnect():
+    start_time = time.time()
+    # Handshakes are sent to all modules before waiting for any reply.
+    connected_modules = []
+    for _, module in _modules:
+        try:
+            module.handshake_send()
+        except Exception as exc:
+            _log.info('Unable to connect to module "%s" in advance, will '
+                      'retry on first request: %r', module.name, exc)
+            continue
+        connected_modules.append(module)
+    if _conf['preconnect'] != _PRECONNECT_EAGER:
+        return
+
+    for module in connected_modules:
+        try:
+            module.handshake()
+        except Exception as exc:
+            _log.info('Handshake with module "%s" failed, will retry on '
+                      'first request: %r', module.name, exc)
+    _log.info('Connected to %u modules in %.3f seconds',
+              len(connected_modules), time.time() - start_time)
+
+
 def after_fork(parent):
     _log.info('Fork detected (parent == %r), resetting client sockets...',
               parent)
-    for module_connection, _ in _modules:
+    for module_connection, module in _modules:
         module_connection.socket_close()
+        module.reset()
 
+    if parent:
+        return
+    if _conf['preconnect'] != _PRECONNECT_NONE:
+        _preconnect()
+    if any(module.catalogue_stale for _, module in _modules):
+        thread = threading.Thread(
+                target=_refresh_catalogues, name='catalogue-refresh')
+        thread.daemon = True
+        thread.start()
 
-def _module_item_list(module_connection, module):
-    _log.info('Retrieving item list for module "%s"...', module.name)
 
-    # Ensure successful connection to module.
+def _load_catalogue(module):
+    try:
+        with open(module.catalogue_path) as catalogue_file:
+            return json.load(catalogue_file)
+    except (IOError, OSError, ValueError) as exc:
+        _log.info('Item catalogue of module "%s" is not available: %r',
+                  module.name, exc)
+        return None
+
+
+def _save_catalogue(module, item_dicts):
+    try:
+        modules.write_file_atomically(
+                module.catalogue_path, json.dumps(item_dicts))
+    except (IOError, OSError) as exc:
+        _log.warning('Unable to save item catalogue of module "%s": %r',
+                     module.name, exc)
+
+
+def _refresh_catalogue(module, deadline):
+    # Own connection, requests are served through module connection
+    # meanwhile.
+    module_connection = _ModuleClient(module.type, module.name)
+    client = rpc.Client(module_connection, _conf['item_list_timeout'])
+    try:
+        if os.path.getmtime(module.catalogue_path) >= _item_list_time:
+            # Already refreshed by another agent process.
+            return
+        _wait_connection(module_connection, module, deadline)
+        item_dicts = client.remote_item_list()
+        _save_catalogue(module, item_dicts)
+
+        keys = set(item_dict['key'] for item_dict in item_dicts)
+        if keys != set(key for key, key_module in _items.items()
+                       if key_module is module):
+            _log.warning('Item list of module "%s" changed, restart agent '
+                         'to apply changes', module.name)
+    except:
+        _log.exception('Unable to refresh item catalogue of module "%s"',
+                       module.name)
+    finally:
+        module_connection.socket_close()
+
+
+def _refresh_catalogues():
+    deadline = time.time() + _conf['item_list_timeout']
+    for _, module in _modules:
+        if module.catalogue_stale:
+            _refresh_catalogue(module, deadline)
+
+
+def _wait_connection(module_connection, module, deadline):
     while True:
         try:
             module_connection.socket_touch()
         except _ModuleConnectionError:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise
             _log.warning(
                     'Connection to module "%s" failed, sleeping and '
                     'retrying...', module.name)
-            time.sleep(_MODULE_CONNECTION_RETRY_SLEEP)
+            time.sleep(min(_MODULE_CONNECTION_RETRY_SLEEP, timeout))
             continue
         break
 
-    items = list(map(ZbxMetric, module.remote_item_list()))
-    _log.info('Found %u items for module "%s":', len(items), module.name)
-    for item in items:
-        _log.info('%r', item)
-    return items
+
+def _module_item_list(module_connection, module, deadline):
+    _log.info('Retrieving item list for module "%s"...', module.name)
+
+    _wait_connection(module_connection, module, deadline)
+    item_dicts = module.remote_item_list()
+    _save_catalogue(module, item_dicts)
+    return item_dicts
+
+
+def _fetch_item_list(module_connection, module, deadline, module_item_dicts):
+    try:
+        module_item_dicts[module] = _module_item_list(
+                module_connection, module, deadline)
+    except:
+        _log.exception('Retrieving supported items failed for module "%s"',
+                       module.name)
+
+
+def _get_item_dicts():
+    module_item_dicts = {}
+    threads = []
+    deadline = time.time() + _conf['item_list_timeout']
+    for module_connection, module in _modules:
+        item_dicts = _load_catalogue(module)
+        if item_dicts is not None:
+            _log.info('Using saved item catalogue of module "%s"',
+                      module.name)
+            module_item_dicts[module] = item_dicts
+            module.catalogue_stale = True
+            continue
+
+        # Live modules are queried in parallel.
+        thread = threading.Thread(
+                target=_fetch_item_list,
+                args=(module_connection, module, deadline, module_item_dicts))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return module_item_dicts
 
 
 def item_list():
     _log.info('Creating list of supported items...')
 
+    global _item_list_time
+    _item_list_time = time.time()
+    module_item_dicts = _get_item_dicts()
+
     for module_connection, module in _modules:
+        if module not in module_item_dicts:
+            continue
         try:
-            module_items = _module_item_list(module_connection, module)
+            module_items = list(map(ZbxMetric, module_item_dicts[module]))
         except:
-            _log.exception('Retrieving supported items failed for module "%s"',
-                           module.name)
+            _log.exception('Invalid item list of module "%s"', module.name)
             continue
+        _log.info('Found %u items for module "%s":', len(module_items),
+                  module.name)
+        for item in module_items:
+            _log.info('%r', item)
 
         for item in module_items:
             if item.key in _items:
@@ -246,38 +510,352 @@ def item_list():
 
         for item in module_items:
             _items[item.key] = module
+            if item.cache_ttl:
+                _items_cache_ttl[item.key] = item.cache_ttl
+            if item.asynchronous and (module.value_plane is not None):
+                _items_asynchronous.add(item.key)
             yield item
 
     _log.info('Total number of supported items: %u', len(_items))
 
 
-def get_value(request, result):
-    ret = SYSINFO_RET_OK
+def _set_result(result, result_dict):
+    result.fill_from_dict(result_dict)
+    if not result_dict.get('result', True):
+        return SYSINFO_RET_FAIL
+    return SYSINFO_RET_OK
+
+
+def _get_failure(key, module):
+    return {
+        'msg': 'Unable to get item "%s" from module "%s", see log for '
+               'details' % (key, module.name),
+        'result': False,
+    }
+
 
-    key = request.key
+def _get_connection_failure(key, module, exc):
+    _log.debug('Unable to get item "%s" from module "%s": %s',
+               key, module.name, exc)
+    return {'msg': str(exc), 'result': False}
 
-    if key not in _items:
+
+def _get_timeout_failure(key, module, exc):
+    _log.warning('Timed out getting item "%s" from module "%s": %s',
+                 key, module.name, exc)
+    return {
+        'msg': 'Timed out getting item "%s" from module "%s"' % (
+            key, module.name),
+        'result': False,
+    }
+
+
+def _cache_put(cache_key, result_dict):
+    # Failures are not cached, so they will be retried on next request.
+    if result_dict.get('result', True):
+        _cache.put(cache_key, result_dict, _items_cache_ttl[cache_key[0]])
+
+
+def _get_published_value(module, key, params):
+    # Values of asynchronous items are read from loader's shared memory if
+    # they are fresh enough, otherwise RPC is used.
+    if key not in _items_asynchronous:
+        return None
+    try:
+        return module.value_plane.get(key, params)
+    except:
+        _log.exception('Unable to read published value of item "%s" from '
+                       'module "%s"', key, module.name)
+        return None
+
+
+def _get_result_dict(key, params):
+    module = _items.get(key)
+    if module is None:
         raise RuntimeError('Unknown key: "%s"' % key)
 
-    module = _items[key]
+    result_dict = _get_published_value(module, key, params)
+    if result_dict is not None:
+        return result_dict
     try:
-        result_dict = module.remote_get_value(key, *request.params)
-        result.fill_from_dict(result_dict)
-        if not result_dict.get('result', True):
-            ret = SYSINFO_RET_FAIL
+        if key not in _items_cache_ttl:
+            return module.remote_get_value(key, *params)
+
+        cache_key = (key, tuple(params))
+        result_dict = _cache.get(cache_key)
+        if result_dict is None:
+            result_dict = module.remote_get_value(key, *params)
+            _cache_put(cache_key, result_dict)
+        return result_dict
+    except rpc.DeadlineExceeded as exc:
+        return _get_timeout_failure(key, module, exc)
+    except _ModuleConnectionError as exc:
+        return _get_connection_failure(key, module, exc)
     except:
         _log.exception('Unable to get item "%s" from module "%s"',
                        key, module.name)
-        result.msg = 'Unable to get item "%s" from module "%s", see log for ' \
-                     'details' % (key, module.name)
-        ret = SYSINFO_RET_FAIL
+        return _get_failure(key, module)
+
+
+def get_value(request, result):
+    return _set_result(result, _get_result_dict(request.key, request.params))
+
+
+def _get_result_tuple(result_dict):
+    get = result_dict.get
+    return (
+        SYSINFO_RET_OK if get('result', True) else SYSINFO_RET_FAIL,
+        get('ui64'), get('dbl'), get('str'), get('text'), get('msg'))
+
+
+def get_value_fast(key, params):
+    """
+    Same as get_value(), but takes key and tuple of parameters and returns
+    tuple (return code, ui64, dbl, str, text, msg), so native module does not
+    have to create request and result objects.
+    """
+    return _get_result_tuple(_get_result_dict(key, params))
+
+
+def get_native_routes():
+    """
+    Returns (timeout, [(module name, socket path, circuit breaker state path,
+    value plane path), ...], {key: module index}, {key: module index}) or
+    None. Items from the first dictionary are requested by native module from
+    module sockets without calling Python ("native_get_value" option), items
+    from the second one are read by native module from value plane first.
+    Items with cached values are still requested through get_value_fast(),
+    as are items of modules with connection failures recorded by circuit
+    breaker.
+    """
+    native_rpc = _conf['native_get_value']
+    if not (native_rpc or _items_asynchronous):
+        return None
+
+    module_ns = {}
+    native_modules = []
+    for _, module in _modules:
+        module_ns[module] = len(native_modules)
+        native_modules.append((
+            module.name, module.sock_path,
+            modules.get_breaker_state_path(_conf, module.type, module.name),
+            module.value_plane_path))
+
+    rpc_keys = {}
+    if native_rpc:
+        rpc_keys = dict(
+                (key, module_ns[module]) for key, module in _items.items()
+                if key not in _items_cache_ttl)
+    return (
+        _conf['item_timeout'],
+        native_modules,
+        rpc_keys,
+        dict((key, module_ns[_items[key]]) for key in _items_asynchronous))
+
+
+def decode_native_reply(key, packet):
+    """
+    Decodes JSON reply received by native module, returns tuple like
+    get_value_fast().
+    """
+    module = _items[key]
+    reply = json.loads(packet.decode())
+    if 'error' not in reply:
+        return _get_result_tuple(reply['result'])
+    if reply.get('expired'):
+        return _get_result_tuple(_get_timeout_failure(
+                key, module, 'RPC call was not completed before deadline'))
+    _log.error('Unable to get item "%s" from module "%s": %s',
+               key, module.name, reply['error'])
+    return _get_result_tuple(_get_failure(key, module))
+
+
+def _module_get_values(module, requests):
+    items = [(request.key, request.params) for request in requests]
+    try:
+        return module.remote_get_values(items)
+    except rpc.RemoteError:
+        # Module may be loaded by older version without batch support.
+        _log.warning('Batch request failed for module "%s", sending '
+                     'separate requests', module.name, exc_info=True)
+        return module.call_batch(
+                ('get_value', (key, ) + tuple(params), {})
+                for key, params in items)
+
+
+def get_values(requests, results):
+    """
+    Same as get_value(), but for sequence of requests. Items of one module are
+    requested in one RPC. Returns list of return codes.
+
+    Zabbix module API requests items one at a time, so native module does not
+    call this function. It is only a hook for callers able to batch requests.
+    """
+    rets = [SYSINFO_RET_FAIL] * len(requests)
+
+    module_requests = collections.OrderedDict()
+    for request_n, (request, result) in enumerate(zip(requests, results)):
+        module = _items.get(request.key)
+        if module is None:
+            result.msg = 'Unknown key: "%s"' % request.key
+            continue
+
+        result_dict = _get_published_value(
+                module, request.key, request.params)
+        if result_dict is not None:
+            rets[request_n] = _set_result(result, result_dict)
+            continue
+
+        if request.key in _items_cache_ttl:
+            result_dict = _cache.get((request.key, tuple(request.params)))
+            if result_dict is not None:
+                rets[request_n] = _set_result(result, result_dict)
+                continue
+
+        module_requests.setdefault(module, []).append(request_n)
+
+    for module, request_ns in module_requests.items():
+        try:
+            result_dicts = _module_get_values(
+                    module, [requests[request_n] for request_n in request_ns])
+        except (rpc.DeadlineExceeded, _ModuleConnectionError) as exc:
+            result_dicts = [exc] * len(request_ns)
+        except:
+            _log.exception('Unable to get items from module "%s"',
+                           module.name)
+            result_dicts = [None] * len(request_ns)
+
+        for request_n, result_dict in zip(request_ns, result_dicts):
+            key = requests[request_n].key
+            result = results[request_n]
+            if isinstance(result_dict, dict):
+                if key in _items_cache_ttl:
+                    _cache_put((key, tuple(requests[request_n].params)),
+                               result_dict)
+                rets[request_n] = _set_result(result, result_dict)
+            elif isinstance(result_dict, rpc.DeadlineExceeded):
+                rets[request_n] = _set_result(result, _get_timeout_failure(
+                        key, module, result_dict))
+            elif isinstance(result_dict, _ModuleConnectionError):
+                rets[request_n] = _set_result(
+                        result, _get_connection_failure(
+                                key, module, result_dict))
+            else:
+                if result_dict is not None:
+                    _log.error('Unable to get item "%s" from module "%s": %s',
+                               key, module.name, result_dict)
+                rets[request_n] = _set_result(
+                        result, _get_failure(key, module))
+
+    return rets
+
+
+def _fetch_history_types(module_connection, module, deadline, module_types):
+    try:
+        _wait_connection(module_connection, module, deadline)
+        module_types[module] = module.remote_history_types()
+    except rpc.RemoteError:
+        # Loader of older version.
+        module_types[module] = []
+    except:
+        _log.exception('Retrieving history types failed for module "%s"',
+                       module.name)
+
+
+def history_types():
+    """
+    Returns list of value types of history which modules want to receive
+    through history_write().
+    """
+    module_types = {}
+    deadline = time.time() + _conf['item_list_timeout']
+    threads = [
+        threading.Thread(
+                target=_fetch_history_types,
+                args=(module_connection, module, deadline, module_types))
+        for module_connection, module in _modules]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    _history_modules.clear()
+    for _, module in _modules:
+        for value_type in module_types.get(module, ()):
+            if value_type not in HISTORY_TYPES:
+                _log.error('Unknown history type "%s" requested by module '
+                           '"%s"', value_type, module.name)
+                continue
+            _history_modules.setdefault(value_type, []).append(module)
+            _log.info('Module "%s" will receive history of type "%s"',
+                      module.name, value_type)
+    return list(_history_modules)
+
+
+def _decode_history_column(value_type, name, column):
+    if isinstance(column, list):
+        return column
+    if name == 'value':
+        typecode = _HISTORY_VALUE_TYPECODES[value_type]
+    else:
+        typecode = _HISTORY_COLUMN_TYPECODES[name]
+    column_array = array.array(typecode)
+    if hasattr(column_array, 'frombytes'):
+        column_array.frombytes(column)
+    else:
+        column_array.fromstring(column)
+    return column_array.tolist()
+
+
+def history_write(value_type, columns):
+    """
+    Called by native module with batch of history values in columnar form:
+    dict {column name: column}. Numeric columns are packed into bytes
+    objects, string columns are lists.
+    """
+    history_modules = _history_modules.get(value_type)
+    if not history_modules:
+        return
+
+    columns = dict(
+            (name, _decode_history_column(value_type, name, column))
+            for name, column in columns.items())
+    for module in history_modules:
+        try:
+            module.remote_history_write(value_type, columns)
+        except _ModuleConnectionError as exc:
+            _log.warning('Unable to write history to module "%s": %s',
+                         module.name, exc)
+        except:
+            _log.exception('Unable to write history to module "%s"',
+                           module.name)
+
+
+def get_cache_stats():
+    return _cache.get_stats()
+
 
-    return ret
+def get_connect_stats():
+    return dict(
+            (module.name, dict(module_connection.connect_stats))
+            for module_connection, module in _modules)
 
 
 def uninit():
-    global _modules, _items
+    _log.info('Result cache statistics: %r', get_cache_stats())
+    _log.info('Connection statistics: %r', get_connect_stats())
+    log_stats = logging.get_stats()
+    if log_stats is not None:
+        _log.info('Logging statistics: %r', log_stats)
+
+    global _modules, _items, _items_cache_ttl, _items_asynchronous
+    for _, module in _modules:
+        if module.value_plane is not None:
+            module.value_plane.close()
     _modules = []
     _items = {}
+    _items_cache_ttl = {}
+    _items_asynchronous = set()
+    _history_modules.clear()
 
     return ZBX_MODULE_OK